@@ -0,0 +1,283 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from smart_tagging.startup import lazy_import, startup_report
+from smart_tagging.tflite import TFLiteSignature, tflite_path
+from smart_tagging.utils import load_config, load_exported_model
+
+tf = lazy_import('tensorflow')
+
+
+class Backend:
+    """
+    Runs one signature of an exported model.
+
+    Every backend is called like a saved model signature, with keyword
+    inputs, and returns a dict of tf.Tensor outputs with the same keys,
+    shapes and dtypes, so the model classes work unchanged on top of it.
+    Inputs are cast to the first supported dtype. If the model declares a
+    fixed batch dimension, it is the max_batch_size: larger batches are
+    split into several calls and smaller ones padded with zeros.
+
+    All backends accept the intra_op_threads and inter_op_threads options
+    of an ExecutionProfile, see smart_tagging.profiles.
+
+    Args:
+        export_dir (str/Path): Path to saved model
+        signature (str): Signature key, e.g. 'bboxes'
+        output_keys (Sequence[str]): Output names of the signature
+        config (Dict): Model configuration from init.json
+    """
+    name = ''
+    # Backends that can be traced into a tf.function.
+    traceable = False
+    supported_dtypes: Tuple[np.dtype, ...] = (np.dtype(np.float32),)
+
+    def __init__(
+        self,
+        export_dir: Union[str, Path],
+        signature: str,
+        output_keys: Sequence[str],
+        config: Dict,
+    ):
+        self.export_dir = Path(export_dir)
+        self.signature = signature
+        self.output_keys = tuple(output_keys)
+        self.config = config
+        self.max_batch_size: Optional[int] = None
+
+    def __call__(self, image, **inputs) -> Dict[str, 'tf.Tensor']:
+        """
+        Runs the signature.
+
+        Args:
+            image: Input images, shape (batch, height, width, 3)
+            inputs: Further inputs of the signature, e.g. threshold
+
+        Returns:
+            Dict[str, tf.Tensor]: Outputs of the signature
+        """
+        batch_size = image.shape[0]
+        limit = self.max_batch_size
+        if limit is None or batch_size == limit:
+            return self._run(image=self._cast(image), **inputs)
+        chunks = []
+        for i in range(0, batch_size, limit):
+            chunk = self._cast(image[i:i + limit])
+            size = chunk.shape[0]
+            if size < limit:
+                padding = np.zeros((limit - size, *chunk.shape[1:]),
+                                   chunk.dtype)
+                chunk = np.concatenate([chunk, padding], axis=0)
+            outputs = self._run(image=chunk, **inputs)
+            chunks.append(
+                {key: outputs[key][:size] for key in self.output_keys})
+        if len(chunks) == 1:
+            return chunks[0]
+        return {
+            key: tf.concat([chunk[key] for chunk in chunks], axis=0)
+            for key in self.output_keys}
+
+    @staticmethod
+    def fixed_batch_size(shape: Optional[Sequence]) -> Optional[int]:
+        """
+        Reads the batch dimension of a declared input shape.
+
+        Args:
+            shape (Sequence): Input shape, dynamic dimensions as None, -1 or
+                a name
+
+        Returns:
+            int: Batch size if it is fixed, None otherwise
+        """
+        if not shape:
+            return None
+        dim = shape[0]
+        if isinstance(dim, (int, np.integer)) and dim > 0:
+            return int(dim)
+        return None
+
+    def _cast(self, image) -> np.ndarray:
+        image = np.asarray(image)
+        if image.dtype in self.supported_dtypes:
+            return image
+        return image.astype(self.supported_dtypes[0])
+
+    def _run(self, **inputs) -> Dict[str, 'tf.Tensor']:
+        raise NotImplementedError
+
+
+class SavedModelBackend(Backend):
+    """
+    TensorFlow SavedModel, the default backend.
+    """
+    name = 'saved_model'
+    traceable = True
+
+    def __init__(
+        self, export_dir, signature, output_keys, config,
+        intra_op_threads: int = 0, inter_op_threads: int = 0,
+    ):
+        # The thread counts are process-wide, see configure_tensorflow.
+        super().__init__(export_dir, signature, output_keys, config)
+        # Model must be an attribute according to
+        # https://github.com/tensorflow/tensorflow/issues/46708
+        self.model, _ = load_exported_model(export_dir)
+        self.serve_fn = self.model.signatures[signature]
+
+    def __call__(self, image, **inputs) -> Dict[str, 'tf.Tensor']:
+        # Saved model signatures take tensors of any batch size and are
+        # called directly, so the call can be traced into a tf.function.
+        return self.serve_fn(image=image, **inputs)
+
+
+class TFLiteBackend(Backend):
+    """
+    TFLite model created by smart_tagging.quantize.
+
+    Args:
+        precision (str): 'float16' or 'int8'
+    """
+    name = 'tflite'
+
+    def __init__(
+        self, export_dir, signature, output_keys, config,
+        precision: str = 'float16',
+        intra_op_threads: int = 0, inter_op_threads: int = 0,
+    ):
+        super().__init__(export_dir, signature, output_keys, config)
+        path = tflite_path(export_dir, precision)
+        if not path.exists():
+            raise FileNotFoundError(
+                f'{path} does not exist, create it with '
+                f'"python -m smart_tagging.quantize"')
+        self.precision = precision
+        self.runner = TFLiteSignature(
+            path, signature, output_keys, num_threads=intra_op_threads)
+        self.max_batch_size = self.fixed_batch_size(
+            self.runner.input_shape('image'))
+
+    def _run(self, **inputs) -> Dict[str, 'tf.Tensor']:
+        return self.runner(**inputs)
+
+
+class ONNXBackend(Backend):
+    """
+    ONNX Runtime, requires onnxruntime. Expects the converted signature at
+    <export_dir>/model_<signature>.onnx, e.g. created with tf2onnx:
+
+        python -m tf2onnx.convert --saved-model <export_dir>
+            --signature_def <signature>
+            --output <export_dir>/model_<signature>.onnx
+
+    Args:
+        providers (Sequence[str]): ONNX Runtime execution providers
+    """
+    name = 'onnx'
+
+    def __init__(
+        self, export_dir, signature, output_keys, config,
+        providers: Sequence[str] = ('CPUExecutionProvider',),
+        intra_op_threads: int = 0, inter_op_threads: int = 0,
+    ):
+        super().__init__(export_dir, signature, output_keys, config)
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                'The onnx backend requires onnxruntime, '
+                'install it with "pip install onnxruntime".') from None
+
+        path = self.export_dir / f'model_{signature}.onnx'
+        with startup_report.timed('load', path.name):
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = intra_op_threads
+            options.inter_op_num_threads = inter_op_threads
+            self.session = onnxruntime.InferenceSession(
+                str(path), options, providers=list(providers))
+        names = [output.name for output in self.session.get_outputs()]
+        # Outputs keep their signature names if possible, otherwise the
+        # converter flattens them in sorted order.
+        if set(self.output_keys) <= set(names):
+            self.output_names = list(self.output_keys)
+        else:
+            self.output_names = [
+                names[sorted(self.output_keys).index(key)]
+                for key in self.output_keys]
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.max_batch_size = self.fixed_batch_size(next(
+            (i.shape for i in self.session.get_inputs() if 'image' in i.name),
+            None))
+
+    def _run(self, **inputs) -> Dict[str, 'tf.Tensor']:
+        feed = {}
+        for key, value in inputs.items():
+            name = next(n for n in self.input_names if key in n)
+            value = np.asarray(value)
+            if value.dtype == np.float64:
+                value = value.astype(np.float32)
+            feed[name] = value
+        outputs = self.session.run(self.output_names, feed)
+        return {
+            key: tf.constant(value)
+            for key, value in zip(self.output_keys, outputs)}
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (SavedModelBackend, TFLiteBackend, ONNXBackend)}
+
+
+def load_backend(
+    export_dir: Union[str, Path],
+    signature: str,
+    output_keys: Sequence[str],
+    backend: Optional[str] = None,
+    **options,
+) -> Tuple[Backend, Dict]:
+    """
+    Loads a signature of an exported model with the selected backend.
+
+    The backend is taken from the argument or otherwise from the "backend"
+    entry of init.json, either a name or a dict with a "name" and further
+    options of the backend. It defaults to the saved model.
+
+    Args:
+        export_dir (str/Path): Path to saved model
+        signature (str): Signature key
+        output_keys (Sequence[str]): Output names of the signature
+        backend (str): One of BACKENDS
+        options: Backend options, e.g. precision of the tflite backend
+
+    Returns:
+        Tuple[Backend, Dict]: Backend and configuration
+    """
+    config = load_config(Path(export_dir) / 'init.json')
+    declared = config.get('backend') or {}
+    if isinstance(declared, str):
+        declared = {'name': declared}
+    declared = dict(declared)
+    declared_name = declared.pop('name', SavedModelBackend.name)
+
+    name = backend or declared_name
+    if name not in BACKENDS:
+        raise ValueError(
+            f'Unknown backend {name!r}, expected one of {sorted(BACKENDS)}')
+    # Options from init.json only apply to the backend declared there.
+    kwargs = declared if name == declared_name else {}
+    kwargs.update(options)
+    return BACKENDS[name](
+        export_dir, signature, output_keys, config, **kwargs), config
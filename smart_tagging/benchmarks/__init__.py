@@ -0,0 +1,9 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
@@ -0,0 +1,199 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Pure-Python stand-in for the parts of the RTMaps python bridge used by the
+blocks, so they can be driven without an RTMaps installation.
+
+Only the behaviour the blocks rely on is reproduced: properties, inputs
+holding the latest ioelt, outputs counting written ioelts, and the
+drawing object types.
+"""
+
+import sys
+import time
+import types as _types
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+ANY = 'ANY'
+AUTO = 'AUTO'
+DRAWING_OBJECT = 'DRAWING_OBJECT'
+
+
+class Ioelt:
+    """
+    Timestamped data element.
+    """
+    def __init__(self):
+        self.ts = 0
+        self.data = None
+
+
+class Image:
+    """
+    Image input data, the pixels are read from image_data.
+    """
+    def __init__(self, image_data: np.ndarray):
+        self.image_data = image_data
+
+
+class DrawingObject:
+    def __init__(self):
+        self.kind = 0
+        self.color = 0
+        self.width = 0
+        self.data = None
+
+
+class Rectangle:
+    def __init__(self):
+        self.x1 = self.y1 = self.x2 = self.y2 = 0.
+
+
+class Text:
+    def __init__(self):
+        self.x = self.y = 0.
+        self.cwidth = self.cheight = 0
+        self.text = ''
+
+
+class Property:
+    def __init__(self, data: Any):
+        self.data = data
+
+
+class Input:
+    def __init__(self, name: str, kind: Any):
+        self.name = name
+        self.kind = kind
+        self.ioelt = Ioelt()
+
+
+class Output:
+    """
+    Output which keeps the number of written ioelts and the latest one.
+    """
+    def __init__(self, name: str, kind: Any, size: int):
+        self.name = name
+        self.kind = kind
+        self.size = size
+        self.num_written = 0
+        self.last: Optional[Ioelt] = None
+
+    def write(self, ioelt: Ioelt) -> None:
+        self.num_written += 1
+        self.last = ioelt
+
+
+class BaseComponent:
+    """
+    Stand-in of rtmaps.base_component.BaseComponent.
+
+    Property values passed to `configure` before Dynamic take precedence
+    over the defaults the block declares, like properties set in a
+    diagram.
+    """
+    def __init__(self):
+        self.properties: Dict[str, Property] = {}
+        self.inputs: Dict[str, Input] = {}
+        self.outputs: Dict[str, Output] = {}
+        self._overrides: Dict[str, Any] = {}
+
+    def configure(self, **properties) -> None:
+        self._overrides.update(properties)
+
+    def add_property(self, name: str, default: Any) -> None:
+        self.properties[name] = Property(self._overrides.get(name, default))
+
+    def add_input(self, name: str, kind: Any) -> None:
+        self.inputs[name] = Input(name, kind)
+
+    def add_output(self, name: str, kind: Any, size: int = 1) -> None:
+        self.outputs[name] = Output(name, kind, size)
+
+
+def install(force: bool = False) -> bool:
+    """
+    Registers the stand-in as the modules rtmaps, rtmaps.types and
+    rtmaps.base_component.
+
+    Args:
+        force (bool): Replace an installed RTMaps python bridge
+
+    Returns:
+        bool: True if the stand-in is used
+    """
+    if not force:
+        try:
+            import rtmaps.base_component  # noqa: F401
+            import rtmaps.types  # noqa: F401
+            return False
+        except ImportError:
+            pass
+
+    package = _types.ModuleType('rtmaps')
+    package.__path__ = []
+    types_module = _types.ModuleType('rtmaps.types')
+    for name in ('ANY', 'AUTO', 'DRAWING_OBJECT', 'Ioelt', 'Image',
+                 'DrawingObject', 'Rectangle', 'Text'):
+        setattr(types_module, name, globals()[name])
+    base_module = _types.ModuleType('rtmaps.base_component')
+    base_module.BaseComponent = BaseComponent
+    package.types = types_module
+    package.base_component = base_module
+    sys.modules['rtmaps'] = package
+    sys.modules['rtmaps.types'] = types_module
+    sys.modules['rtmaps.base_component'] = base_module
+    return True
+
+
+def set_input(
+    component: BaseComponent, name: str, timestamp: int, data: Any
+) -> None:
+    """
+    Sets the latest ioelt of an input, wrapping arrays into an Image.
+    """
+    ioelt = component.inputs[name].ioelt
+    ioelt.ts = timestamp
+    ioelt.data = Image(data) if isinstance(data, np.ndarray) else data
+
+
+def replay(
+    component: BaseComponent,
+    frames: Iterable[Dict[str, Any]],
+    period_us: int = 33333,
+) -> Tuple[int, float]:
+    """
+    Runs a component over a sequence of frames: Dynamic, Birth, one Core
+    per frame and Death.
+
+    Args:
+        component (BaseComponent): Configured block
+        frames (Iterable[Dict[str, Any]]): Input data by input name
+        period_us (int): Timestamp increment per frame in microseconds
+
+    Returns:
+        Tuple[int, float]: Number of frames and seconds from the first Core
+            until Death returned, i.e. without loading the model
+    """
+    component.Dynamic()
+    component.Birth()
+    num_frames = 0
+    start = time.perf_counter()
+    try:
+        for num_frames, frame in enumerate(frames, 1):
+            for name, data in frame.items():
+                set_input(component, name, num_frames * period_us, data)
+            component.Core()
+    finally:
+        component.Death()
+    return num_frames, time.perf_counter() - start
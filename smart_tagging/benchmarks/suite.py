@@ -0,0 +1,409 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Benchmarks the hot paths and the end-to-end throughput of the RTMaps
+blocks on synthetic models, without RTMaps or the downloaded models.
+
+Usage:
+    python -m smart_tagging.benchmarks.suite -o results.json
+    python -m smart_tagging.benchmarks.suite -o new.json --compare old.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from smart_tagging import __version__, project_root
+from smart_tagging.benchmarks import rtmaps_stub
+
+BATCH_SIZES = (1, 4, 16)
+DENSITIES = (0, 10, 100)
+
+
+def measure(
+    fn: Callable[[], object], repeat: int = 20, warmup: int = 2
+) -> Dict[str, float]:
+    """
+    Times repeated calls of a function.
+
+    Args:
+        fn (Callable): Benchmarked function without arguments
+        repeat (int): Number of timed calls
+        warmup (int): Number of untimed calls before
+
+    Returns:
+        Dict[str, float]: Median and minimum time per call in milliseconds
+            and calls per second based on the median
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {
+        'median_ms': median * 1000,
+        'min_ms': min(times) * 1000,
+        'per_s': 1 / median if median > 0 else float('inf'),
+    }
+
+
+class Suite:
+    """
+    Creates the synthetic models on demand and runs the benchmarks.
+
+    Args:
+        workdir (Path): Directory of the synthetic models
+        resolution (Tuple[int, int]): (height, width) of the frames
+        repeat (int): Timed calls per hot path benchmark
+        frames (int): Frames per end-to-end benchmark
+    """
+    def __init__(
+        self,
+        workdir: Path,
+        resolution: Tuple[int, int] = (480, 640),
+        repeat: int = 20,
+        frames: int = 50,
+    ):
+        self.workdir = Path(workdir)
+        self.resolution = resolution
+        self.repeat = repeat
+        self.frames = frames
+        self._models: Dict[str, Path] = {}
+        self._rng = np.random.default_rng(0)
+
+    def detection_model(self, density: int) -> Path:
+        key = f'detection_{density}'
+        if key not in self._models:
+            from smart_tagging.benchmarks.synthetic_models import (
+                make_detection_model,
+            )
+            self._models[key] = make_detection_model(
+                self.workdir / key, density, input_shape=self.resolution)
+        return self._models[key]
+
+    def novelty_model(self) -> Path:
+        if 'novelty' not in self._models:
+            from smart_tagging.benchmarks.synthetic_models import (
+                make_novelty_model,
+            )
+            self._models['novelty'] = make_novelty_model(
+                self.workdir / 'novelty', input_shape=self.resolution)
+        return self._models['novelty']
+
+    def images(self, num: int) -> np.ndarray:
+        return self._rng.integers(
+            0, 256, (num, *self.resolution, 3), dtype=np.uint8)
+
+    def run(self, only: Optional[str] = None) -> Dict[str, Dict]:
+        """
+        Runs all benchmarks whose name contains `only`.
+
+        Returns:
+            Dict[str, Dict]: Results by benchmark name
+        """
+        results = {}
+        for name, fn in self.benchmarks():
+            if only and only not in name:
+                continue
+            results[name] = fn()
+            print(f'{name}: {results[name]["median_ms"]:.3f} ms', flush=True)
+        return results
+
+    def benchmarks(self) -> Iterator[Tuple[str, Callable[[], Dict]]]:
+        for batch_size in BATCH_SIZES:
+            yield (f'ingest/images={batch_size}',
+                   lambda b=batch_size: self.bench_ingest(b))
+            for density in DENSITIES:
+                suffix = f'images={batch_size}/density={density}'
+                yield (f'decode_detections/{suffix}',
+                       lambda b=batch_size, d=density: self.bench_decode(b, d))
+                yield (f'statistics/{suffix}',
+                       lambda b=batch_size, d=density:
+                       self.bench_statistics(b, d))
+            yield (f'object_detection_model/images={batch_size}',
+                   lambda b=batch_size: self.bench_detection_model(b))
+            yield (f'novelty_model/batch={batch_size}',
+                   lambda b=batch_size: self.bench_novelty_model(b))
+        for density in DENSITIES:
+            yield (f'format/density={density}',
+                   lambda d=density: self.bench_format(d))
+            yield (f'tracking/density={density}',
+                   lambda d=density: self.bench_tracking(d))
+        for batch_size in BATCH_SIZES:
+            for density in DENSITIES:
+                yield (f'block/object_detection/images={batch_size}/'
+                       f'density={density}',
+                       lambda b=batch_size, d=density:
+                       self.bench_detection_block(b, d))
+        for pipelined, batch_size in ((False, 1), (True, 1), (True, 8)):
+            mode = 'pipelined' if pipelined else 'sync'
+            yield (f'block/novelty_detection/{mode}/batch={batch_size}',
+                   lambda p=pipelined, b=batch_size:
+                   self.bench_novelty_block(p, b))
+
+    # Hot paths.
+
+    def bench_ingest(self, num_images: int) -> Dict:
+        block = self._detection_block(num_images, 10, pipelined=True)
+        for i, image in enumerate(self.images(num_images)):
+            rtmaps_stub.set_input(block, f'image_in_{i}', 0, image)
+        result = measure(block.ingest, self.repeat)
+        block.Death()
+        return result
+
+    def bench_decode(self, batch_size: int, density: int) -> Dict:
+        import tensorflow as tf
+
+        from smart_tagging.object_detection.utils import decode_detections
+
+        max_boxes = 100
+        boxes = np.zeros((batch_size, max_boxes, 4), np.float32)
+        boxes[:, :density] = self._rng.uniform(0.1, 0.9, (density, 4))
+        scores = np.zeros((batch_size, max_boxes), np.float32)
+        scores[:, :density] = 0.5
+        classes = np.zeros((batch_size, max_boxes), np.float32)
+        classes[:, :density] = self._rng.integers(0, 7, density)
+        outputs = [tf.constant(x) for x in (
+            boxes, scores, classes, np.full(batch_size, density, np.float32))]
+        resolutions = [self.resolution] * batch_size
+        return measure(
+            lambda: decode_detections(*outputs, resolutions, 7), self.repeat)
+
+    def bench_statistics(self, num_images: int, density: int) -> Dict:
+        from smart_tagging.object_detection.statistics import (
+            DetectionStatistics,
+        )
+
+        stats = DetectionStatistics(
+            {i: str(i) for i in range(7)}, num_images)
+        counts = self._rng.multinomial(
+            density, [1 / 7] * 7, size=num_images)
+        timestamps = iter(range(0, 10 ** 12, 33333))
+        return measure(
+            lambda: stats.update(counts, next(timestamps)), self.repeat * 10)
+
+    def bench_detection_model(self, batch_size: int) -> Dict:
+        from smart_tagging.object_detection.model import ObjectDetection
+
+        model = ObjectDetection(self.detection_model(10))
+        images = self.images(batch_size)
+        return measure(lambda: model(images, 0.3), self.repeat)
+
+    def bench_novelty_model(self, batch_size: int) -> Dict:
+        from smart_tagging.novelty_detection.model import PairwiseFilter
+
+        model = PairwiseFilter(self.novelty_model())
+        images = self.images(batch_size)
+        return measure(
+            lambda: model.batch(images, batch_size), self.repeat)
+
+    def bench_format(self, density: int) -> Dict:
+        block = self._detection_block(1, density)
+        rtmaps_stub.set_input(block, 'image_in_0', 0, self.images(1)[0])
+        rtmaps_stub.set_input(block, 'threshold', 0, 30)
+        _, frame = block.ingest()
+        frame = block.infer(frame)
+        result = measure(
+            lambda: block.overlay.release(block.format(dict(frame))[0]),
+            self.repeat)
+        block.Death()
+        return result
+
+    def bench_tracking(self, density: int) -> Dict:
+        from smart_tagging.object_detection.tracking import IoUTracker
+        from smart_tagging.object_detection.utils import DETECTION_DTYPE
+
+        height, width = self.resolution
+        detections = np.zeros(density, dtype=DETECTION_DTYPE)
+        detections['xmin'] = self._rng.uniform(0, width - 50, density)
+        detections['ymin'] = self._rng.uniform(0, height - 50, density)
+        detections['xmax'] = detections['xmin'] + 40
+        detections['ymax'] = detections['ymin'] + 40
+        detections['score'] = 0.5
+        detections['class_id'] = self._rng.integers(0, 7, density)
+        tracker = IoUTracker(7)
+
+        def step():
+            # Objects move by a few pixels per frame.
+            for name in ('xmin', 'xmax'):
+                detections[name] += 2
+            tracker.step(detections)
+        return measure(step, self.repeat)
+
+    # End-to-end throughput, per frame of all inputs.
+
+    def bench_detection_block(self, num_images: int, density: int) -> Dict:
+        frames = self._replay_frames(
+            {f'image_in_{i}': None for i in range(num_images)},
+            threshold=30)
+        block = self._detection_block(num_images, density, birth=False)
+        return self._replay(block, frames)
+
+    def bench_novelty_block(self, pipelined: bool, batch_size: int) -> Dict:
+        from smart_tagging.examples.novelty_detection.novelty_detection \
+            import NoveltyFilter
+
+        block = NoveltyFilter()
+        block.configure(
+            model_path=str(self.novelty_model()),
+            pipelined=pipelined, batch_size=batch_size,
+            overload_policy='block', queue_size=max(2, batch_size))
+        return self._replay(block, self._replay_frames({'image_in': None}))
+
+    def _detection_block(
+        self,
+        num_images: int,
+        density: int,
+        pipelined: bool = False,
+        birth: bool = True,
+    ):
+        from smart_tagging.examples.object_detection.object_detection import (
+            ObjectDetectionBlock,
+        )
+
+        block = ObjectDetectionBlock()
+        block.configure(
+            model_path=str(self.detection_model(density)),
+            num_images=num_images, pipelined=pipelined,
+            overload_policy='block')
+        if birth:
+            block.Dynamic()
+            block.Birth()
+        return block
+
+    def _replay_frames(self, inputs: Dict, **constants) -> List[Dict]:
+        # A few distinct images, reused to keep memory bounded.
+        pool = self.images(4)
+        frames = []
+        for i in range(self.frames):
+            frame = {
+                name: pool[(i + j) % len(pool)]
+                for j, name in enumerate(inputs)}
+            frame.update(constants)
+            frames.append(frame)
+        return frames
+
+    def _replay(self, block, frames: Sequence[Dict]) -> Dict:
+        num_frames, elapsed = rtmaps_stub.replay(block, frames)
+        return {
+            'median_ms': elapsed / num_frames * 1000,
+            'min_ms': elapsed / num_frames * 1000,
+            'per_s': num_frames / elapsed,
+        }
+
+
+def metadata() -> Dict[str, str]:
+    """
+    Returns:
+        Dict[str, str]: Versions and commit the results were measured with
+    """
+    meta = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+    }
+    try:
+        import tensorflow as tf
+        meta['tensorflow'] = tf.__version__
+    except ImportError:
+        pass
+    try:
+        meta['commit'] = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=str(project_root),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return meta
+
+
+def compare(
+    results: Dict[str, Dict], baseline: Dict[str, Dict]
+) -> List[str]:
+    """
+    Compares the median times of two runs.
+
+    Returns:
+        List[str]: One line per benchmark of both runs, slower is positive
+    """
+    lines = [f'{"benchmark":<55} {"before":>10} {"after":>10} {"change":>8}']
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['median_ms'], result['median_ms']
+        change = (after - before) / before * 100 if before else 0.
+        lines.append(
+            f'{name:<55} {before:>8.3f}ms {after:>8.3f}ms {change:>+7.1f}%')
+    return lines
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m smart_tagging.benchmarks.suite',
+        description='Benchmarks the hot paths and the RTMaps blocks on '
+                    'synthetic models.')
+    parser.add_argument(
+        '-o', '--output', type=Path,
+        help='write the results to this .json file')
+    parser.add_argument(
+        '--compare', type=Path,
+        help='results .json file of an earlier run to compare against')
+    parser.add_argument(
+        '--only', help='only run benchmarks whose name contains this')
+    parser.add_argument(
+        '--resolution', default='480x640',
+        help='frame resolution as <height>x<width>')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument(
+        '--frames', type=int, default=50,
+        help='number of frames per end-to-end benchmark')
+    parser.add_argument(
+        '--workdir', type=Path,
+        help='directory for the synthetic models, temporary by default')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    from smart_tagging.startup import parse_resolution
+
+    args = parse_args(argv)
+    rtmaps_stub.install()
+    with tempfile.TemporaryDirectory() as tmp:
+        suite = Suite(
+            args.workdir or Path(tmp), parse_resolution(args.resolution),
+            args.repeat, args.frames)
+        results = suite.run(args.only)
+
+    report = {'meta': metadata(), 'results': results}
+    if args.output is not None:
+        with args.output.open('w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with args.compare.open('r') as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(results, baseline['results'])))
+
+
+if __name__ == '__main__':
+    main()
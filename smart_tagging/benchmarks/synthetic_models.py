@@ -0,0 +1,155 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Generates tiny SavedModels with the signatures and init.json of the
+downloaded models, so the package can be benchmarked without them.
+
+The models run a small strided convolution, so their latency depends on
+the input resolution, and emit a configurable number of detections.
+"""
+
+import json
+from pathlib import Path
+from typing import Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+
+CLASS_NAMES = (
+    'Car', 'Pedestrian', 'Truck', 'Small vehicle', 'Utility vehicle',
+    'Bicycle', 'Tractor')
+
+
+class _SyntheticDetector(tf.Module):
+    def __init__(self, num_detections: int, max_boxes: int, seed: int):
+        super().__init__()
+        rng = np.random.default_rng(seed)
+        self.kernel = tf.constant(
+            rng.normal(size=(8, 8, 3, 8)).astype(np.float32))
+        xy = rng.uniform(0., 0.8, size=(max_boxes, 2))
+        wh = rng.uniform(0.05, 0.2, size=(max_boxes, 2))
+        self.boxes = tf.constant(
+            np.concatenate([xy, xy + wh], axis=-1).astype(np.float32))
+        self.classes = tf.constant(
+            rng.integers(0, len(CLASS_NAMES), max_boxes).astype(np.float32))
+        # The first num_detections boxes always pass any threshold < 1.
+        scores = rng.uniform(0.5, 0.99, max_boxes)
+        scores[num_detections:] = 0.
+        self.scores = tf.constant(scores.astype(np.float32))
+
+    @tf.function(input_signature=[
+        tf.TensorSpec((None, None, None, 3), tf.float32, name='image'),
+        tf.TensorSpec((), tf.float32, name='threshold'),
+    ])
+    def bboxes(self, image, threshold):
+        activation = tf.nn.relu(tf.nn.conv2d(
+            image, self.kernel, strides=8, padding='SAME'))
+        # Tie the outputs to the input, so nothing is constant folded.
+        jitter = tf.reduce_mean(activation, axis=[1, 2, 3]) * 1e-6
+        batch_size = tf.shape(image)[0]
+        keep = tf.cast(self.scores >= threshold, tf.float32)
+        boxes = self.boxes[tf.newaxis] + jitter[:, tf.newaxis, tf.newaxis]
+        boxes = boxes * keep[tf.newaxis, :, tf.newaxis]
+        scores = tf.tile((self.scores * keep)[tf.newaxis], [batch_size, 1])
+        classes = tf.tile((self.classes * keep)[tf.newaxis], [batch_size, 1])
+        number = tf.fill([batch_size], tf.reduce_sum(keep))
+        return {
+            'bboxes': boxes,
+            'scores': scores,
+            'classes': classes,
+            'number': number,
+        }
+
+
+class _SyntheticEncoder(tf.Module):
+    def __init__(self, feature_dim: int, seed: int):
+        super().__init__()
+        rng = np.random.default_rng(seed)
+        self.kernel = tf.constant(
+            rng.normal(size=(8, 8, 3, 16)).astype(np.float32))
+        self.dense = tf.constant(
+            rng.normal(size=(16, feature_dim)).astype(np.float32))
+
+    @tf.function(input_signature=[
+        tf.TensorSpec((None, None, None, 3), tf.float32, name='image'),
+    ])
+    def features(self, image):
+        activation = tf.nn.relu(tf.nn.conv2d(
+            image, self.kernel, strides=8, padding='SAME'))
+        pooled = tf.reduce_mean(activation, axis=[1, 2])
+        return {'feature': tf.matmul(pooled, self.dense)}
+
+
+def _write_config(export_dir: Path, config: dict) -> None:
+    with (export_dir / 'init.json').open('w') as f:
+        json.dump(config, f, indent=2)
+
+
+def make_detection_model(
+    export_dir: Union[str, Path],
+    num_detections: int = 10,
+    max_boxes: int = 100,
+    input_shape: Tuple[int, int] = (480, 640),
+    seed: int = 0,
+) -> Path:
+    """
+    Writes a synthetic object detection model with a "bboxes" signature.
+
+    Args:
+        export_dir (str/Path): Output directory
+        num_detections (int): Detections per image above any threshold
+        max_boxes (int): Padded number of boxes per image
+        input_shape (Tuple[int, int]): Resolution declared in init.json
+        seed (int): Seed of the weights and boxes
+
+    Returns:
+        Path: Export directory
+    """
+    export_dir = Path(export_dir)
+    module = _SyntheticDetector(
+        min(num_detections, max_boxes), max_boxes, seed)
+    tf.saved_model.save(
+        module, str(export_dir), signatures={'bboxes': module.bboxes})
+    _write_config(export_dir, {
+        'model': {
+            'dict_class_names_to_ids': {
+                name: i for i, name in enumerate(CLASS_NAMES)},
+            'input_shape': list(input_shape),
+        },
+    })
+    return export_dir
+
+
+def make_novelty_model(
+    export_dir: Union[str, Path],
+    feature_dim: int = 128,
+    input_shape: Tuple[int, int] = (480, 640),
+    seed: int = 0,
+) -> Path:
+    """
+    Writes a synthetic novelty detection model with a "features"
+    signature.
+
+    Args:
+        export_dir (str/Path): Output directory
+        feature_dim (int): Length of the feature vectors
+        input_shape (Tuple[int, int]): Resolution declared in init.json
+        seed (int): Seed of the weights
+
+    Returns:
+        Path: Export directory
+    """
+    export_dir = Path(export_dir)
+    module = _SyntheticEncoder(feature_dim, seed)
+    tf.saved_model.save(
+        module, str(export_dir), signatures={'features': module.features})
+    _write_config(export_dir, {'model': {'input_shape': list(input_shape)}})
+    return export_dir
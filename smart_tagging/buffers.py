@@ -0,0 +1,160 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import threading
+import tracemalloc
+from typing import (
+    Any, Callable, Dict, List, NamedTuple, Sequence, Tuple, Union,
+)
+
+import numpy as np
+
+
+class BatchBuffer:
+    """
+    Preallocated image batches which are reused across frames.
+
+    A batch is allocated for the shape of the first frame and only
+    reallocated when the shape or dtype changes. A batch returned by
+    `acquire` or `stack` is owned by its frame until it is handed back with
+    `release`, e.g. once the frame was inferred or dropped, so it is never
+    overwritten while a pipeline stage still reads it. If all num_buffers
+    batches are owned, a new array is allocated instead, which is not
+    reused.
+
+    Batches are acquired and released from different threads.
+
+    Args:
+        num_buffers (int): Number of batches kept for reuse
+    """
+    def __init__(self, num_buffers: int = 1):
+        self.num_buffers = max(1, num_buffers)
+        self.num_allocations = 0
+        self._free: List[np.ndarray] = []
+        self._owned: Dict[int, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        """
+        Returns a free batch, reallocating it if the shape changed.
+
+        Args:
+            shape (Tuple[int, ...]): Batch shape
+            dtype (np.dtype): Batch dtype
+
+        Returns:
+            np.ndarray: Batch with undefined content
+        """
+        shape = tuple(shape)
+        with self._lock:
+            buffer = self._free.pop() if self._free else None
+            if (buffer is None or buffer.shape != shape
+                    or buffer.dtype != dtype):
+                self.num_allocations += 1
+                buffer = np.empty(shape, dtype=dtype)
+                if len(self._owned) >= self.num_buffers:
+                    # All batches are owned, the copy is not kept.
+                    return buffer
+            self._owned[id(buffer)] = buffer
+            return buffer
+
+    def release(self, batch: Union[np.ndarray, List[np.ndarray]]) -> None:
+        """
+        Hands a batch back for reuse. Arrays which were not acquired, e.g.
+        the copies of mixed shapes, are ignored.
+
+        Args:
+            batch (np.ndarray): Batch returned by `acquire` or `stack`
+        """
+        with self._lock:
+            buffer = self._owned.pop(id(batch), None)
+            if buffer is not None:
+                self._free.append(buffer)
+
+    def stack(
+        self, images: Sequence[np.ndarray]
+    ) -> Union[np.ndarray, List[np.ndarray]]:
+        """
+        Copies images into a free batch in place.
+
+        Images of different shapes cannot share a batch and are copied one
+        by one instead.
+
+        Args:
+            images (Sequence[np.ndarray]): Images, e.g. views of the RTMaps
+                input buffers
+
+        Returns:
+            np.ndarray/List[np.ndarray]: Batch, shape (images, *image.shape),
+                or list of copies for mixed shapes
+        """
+        first = images[0]
+        if any(image.shape != first.shape or image.dtype != first.dtype
+               for image in images[1:]):
+            self.num_allocations += len(images)
+            return [image.copy() for image in images]
+        batch = self.acquire((len(images), *first.shape), first.dtype)
+        for i, image in enumerate(images):
+            np.copyto(batch[i], image)
+        return batch
+
+
+class AllocationStats(NamedTuple):
+    """
+    Python and NumPy heap allocations of a function call.
+
+    Attributes:
+        peak_bytes (int): Peak of the traced memory during the call
+        num_blocks (int): Number of memory blocks allocated and still alive
+        allocated_bytes (int): Size of these blocks
+    """
+    peak_bytes: int
+    num_blocks: int
+    allocated_bytes: int
+
+
+def measure_allocations(
+    fn: Callable, *args, **kwargs
+) -> Tuple[Any, AllocationStats]:
+    """
+    Calls a function with tracemalloc enabled, which also traces NumPy
+    array allocations.
+
+    Args:
+        fn (Callable): Measured function
+        args, kwargs: Arguments of the function
+
+    Returns:
+        Tuple[Any, AllocationStats]: Result of the call and its allocations
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.clear_traces()
+    before = tracemalloc.take_snapshot()
+    if hasattr(tracemalloc, 'reset_peak'):
+        # Python >= 3.9, older versions report the peak since start.
+        tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    try:
+        result = fn(*args, **kwargs)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    diff = [
+        d for d in after.compare_to(before, 'traceback') if d.size_diff > 0]
+    return result, AllocationStats(
+        peak_bytes=max(0, peak - start),
+        num_blocks=sum(max(0, d.count_diff) for d in diff),
+        allocated_bytes=sum(d.size_diff for d in diff),
+    )
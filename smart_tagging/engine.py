@@ -0,0 +1,492 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Multi-process inference engine for many-core CPU nodes.
+
+A pool of worker processes loads the model once each. Input batches are
+split into one shard per worker and written into shared-memory slots,
+memory-mapped files under /dev/shm where available, so only small task
+descriptors are pickled. Outputs come back through a result queue and are
+reassembled in order.
+"""
+
+import mmap
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import weakref
+from collections import deque
+from pathlib import Path
+from typing import (
+    Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union,
+)
+
+import numpy as np
+
+from smart_tagging.profiles import ExecutionProfile
+from smart_tagging.startup import startup_report
+from smart_tagging.utils import load_config
+
+KINDS = ('object_detection', 'novelty_detection')
+
+# Seconds between liveness checks of the workers while waiting.
+POLL_INTERVAL = 0.1
+
+_SHM_DIR = '/dev/shm'
+
+
+class SharedSlot:
+    """
+    Memory-mapped file holding one input array, which worker processes open
+    by its path. The file is replaced by a larger one if an array does not
+    fit.
+
+    Args:
+        directory (str): Directory of the file, /dev/shm if it exists
+    """
+    def __init__(self, directory: Optional[str] = None):
+        if directory is None and os.path.isdir(_SHM_DIR):
+            directory = _SHM_DIR
+        self.directory = directory
+        self.path: Optional[str] = None
+        self.size = 0
+        self.map: Optional[mmap.mmap] = None
+
+    def write(self, array: np.ndarray) -> Tuple[str, Tuple[int, ...], str]:
+        """
+        Copies an array into the slot.
+
+        Returns:
+            Tuple[str, Tuple[int, ...], str]: Path, shape and dtype, which
+                describe the array to a worker
+        """
+        array = np.asarray(array)
+        if array.nbytes > self.size or self.map is None:
+            self._allocate(max(array.nbytes, 1))
+        view = np.ndarray(array.shape, array.dtype, buffer=self.map)
+        view[...] = array
+        return self.path, array.shape, array.dtype.str
+
+    def _allocate(self, size: int) -> None:
+        self.close()
+        fd, self.path = tempfile.mkstemp(
+            prefix='smart_tagging_', suffix='.frame', dir=self.directory)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self.size = 0
+
+
+class _SlotReader:
+    """
+    Maps the slots of the engine in a worker process.
+    """
+    def __init__(self):
+        self.maps: Dict[int, Tuple[str, mmap.mmap]] = {}
+
+    def read(
+        self, slot: int, path: str, shape: Tuple[int, ...], dtype: str
+    ) -> np.ndarray:
+        if slot not in self.maps or self.maps[slot][0] != path:
+            if slot in self.maps:
+                self.maps[slot][1].close()
+            with open(path, 'r+b') as f:
+                self.maps[slot] = (path, mmap.mmap(f.fileno(), 0))
+        return np.ndarray(shape, np.dtype(dtype), buffer=self.maps[slot][1])
+
+
+def _load_model(kind: str, model_path: str, options: Dict) -> Any:
+    if kind == 'object_detection':
+        from smart_tagging.object_detection.model import ObjectDetection
+        return ObjectDetection(model_path, **options)
+    from smart_tagging.novelty_detection.model import PairwiseFilter
+    return PairwiseFilter(model_path, **options)
+
+
+def _run_model(
+    kind: str, model: Any, x: np.ndarray, kwargs: Dict
+) -> Tuple[np.ndarray, ...]:
+    if kind == 'object_detection':
+        return tuple(np.asarray(output) for output in model(x, **kwargs))
+    return (model.extract_features(x).numpy(),)
+
+
+def _worker_main(
+    kind: str,
+    model_path: str,
+    options: Dict,
+    tasks: 'multiprocessing.Queue',
+    results: 'multiprocessing.Queue',
+    worker_id: int,
+) -> None:
+    try:
+        model = _load_model(kind, model_path, options)
+    except Exception as e:
+        results.put((None, worker_id, None, f'{type(e).__name__}: {e}'))
+        return
+    results.put((None, worker_id, None, None))
+
+    reader = _SlotReader()
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, op, slot, path, shape, dtype, kwargs = task
+        try:
+            if op == 'warm_up':
+                model.warm_up(shape)
+                outputs = ()
+            else:
+                x = reader.read(slot, path, shape, dtype)
+                outputs = _run_model(kind, model, x, kwargs)
+            results.put((task_id, worker_id, outputs, None))
+        except Exception as e:
+            results.put(
+                (task_id, worker_id, None, f'{type(e).__name__}: {e}'))
+
+
+def _concatenate(parts: List[np.ndarray]) -> np.ndarray:
+    if len(parts) == 1:
+        return parts[0]
+    # Shards may be padded to different numbers of boxes.
+    if parts[0].ndim > 1:
+        size = max(part.shape[1] for part in parts)
+        parts = [
+            np.pad(part, [(0, 0), (0, size - part.shape[1])]
+                   + [(0, 0)] * (part.ndim - 2))
+            if part.shape[1] < size else part
+            for part in parts]
+    return np.concatenate(parts, axis=0)
+
+
+def python_executable() -> Optional[str]:
+    """
+    Finds the Python interpreter of the worker processes. Embedded in a host
+    application, e.g. the RTMaps python bridge, sys.executable is the host
+    process, so the interpreter of sys.exec_prefix is used instead.
+
+    Returns:
+        str: Path of the interpreter, None if not found
+    """
+    if Path(sys.executable).name.lower().startswith('python'):
+        return sys.executable
+    for name in ('python.exe', 'bin/python3', 'bin/python'):
+        path = Path(sys.exec_prefix) / name
+        if path.is_file():
+            return str(path)
+    return None
+
+
+def _close_slots(slots: List[SharedSlot]) -> None:
+    for slot in slots:
+        slot.close()
+
+
+class ShardedEngine:
+    """
+    Runs a model on a pool of worker processes.
+
+    Every batch is split into up to num_workers shards along the batch
+    axis, which are inferred in parallel and concatenated in order. Each
+    worker runs with the given ExecutionProfile, by default with
+    threads_per_worker intra-op threads, which is the CPU count divided by
+    the number of workers if not set.
+
+    There are num_workers * depth shared-memory slots. A shard occupies a
+    slot until its result arrives, so callers block if all are in use. A
+    worker that dies is restarted, up to max_restarts times in total, and
+    its unfinished shards are sent to the new process once. A shard which
+    is lost a second time, e.g. because it crashes the model, fails like
+    errors raised by the model, with a RuntimeError in the caller.
+
+    Workers are started with the 'spawn' method by default, as forking a
+    process which has already imported TensorFlow is not safe. The spawned
+    interpreter is executable, by default found by python_executable. It
+    is set for the whole calling process, see
+    multiprocessing.set_executable.
+
+    Args:
+        kind (str): One of KINDS
+        model_path (str/Path): Exported model directory
+        options (Dict): Keyword arguments of the model class
+        num_workers (int): Number of worker processes
+        threads_per_worker (int): TensorFlow intra-op threads per worker
+        depth (int): Shared-memory slots per worker
+        max_restarts (int): Number of worker restarts before giving up
+        start_method (str): multiprocessing start method
+        directory (str): Directory of the shared-memory files
+        profile (ExecutionProfile): Execution profile of every worker
+        executable (str): Python interpreter of the workers
+    """
+    def __init__(
+        self,
+        kind: str,
+        model_path: Union[str, Path],
+        options: Optional[Dict] = None,
+        num_workers: int = 2,
+        threads_per_worker: Optional[int] = None,
+        depth: int = 2,
+        max_restarts: int = 3,
+        start_method: str = 'spawn',
+        directory: Optional[str] = None,
+        profile: Optional[ExecutionProfile] = None,
+        executable: Optional[str] = None,
+    ):
+        if kind not in KINDS:
+            raise ValueError(
+                f'Unknown model kind {kind!r}, expected one of {KINDS}')
+        self.kind = kind
+        self.model_path = str(model_path)
+        self.config = load_config(Path(model_path) / 'init.json')
+        self.num_workers = max(1, num_workers)
+        if profile is None:
+            threads = threads_per_worker or max(
+                1, (os.cpu_count() or 1) // self.num_workers)
+            profile = ExecutionProfile(threads, min(2, threads))
+        self.profile = profile
+        self.options = dict(options or {}, profile=profile)
+        self.depth = max(1, depth)
+        self.max_restarts = max_restarts
+        self.num_restarts = 0
+
+        self._context = multiprocessing.get_context(start_method)
+        if start_method != 'fork':
+            executable = executable or python_executable()
+            if executable is None:
+                raise RuntimeError(
+                    f'{sys.executable!r} is not a Python interpreter, set '
+                    f'the executable of the worker processes')
+            if executable != sys.executable:
+                self._context.set_executable(executable)
+        self._results = self._context.Queue()
+        self._slots = [
+            SharedSlot(directory)
+            for _ in range(self.num_workers * self.depth)]
+        self._finalizer = weakref.finalize(self, _close_slots, self._slots)
+        self._free: Deque[int] = deque(range(len(self._slots)))
+        self._next_task = 0
+        # task id -> [worker, task, attempts], task id -> (outputs, error)
+        self._pending: Dict[int, List] = {}
+        self._done: Dict[int, Tuple[Optional[Tuple], Optional[str]]] = {}
+        self._workers: List[Any] = [None] * self.num_workers
+        self._tasks: List[Any] = [None] * self.num_workers
+        self._closed = False
+
+        with startup_report.timed('load', f'{kind} workers'):
+            for i in range(self.num_workers):
+                self._start_worker(i)
+            num_ready = 0
+            while num_ready < self.num_workers:
+                num_ready += self._poll()
+
+    def _start_worker(self, index: int) -> None:
+        self._tasks[index] = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self.kind, self.model_path, self.options,
+                  self._tasks[index], self._results, index),
+            daemon=True)
+        process.start()
+        self._workers[index] = process
+
+    def _check_workers(self) -> None:
+        for i, process in enumerate(self._workers):
+            if process.is_alive():
+                continue
+            self.num_restarts += 1
+            if self.num_restarts > self.max_restarts:
+                raise RuntimeError(
+                    f'Worker {i} exited with code {process.exitcode}, '
+                    f'giving up after {self.max_restarts} restarts')
+            self._start_worker(i)
+            for task_id, entry in list(self._pending.items()):
+                worker, task, attempts = entry
+                if worker != i:
+                    continue
+                if attempts > 1:
+                    self._finish(task_id, None, (
+                        f'Worker {i} exited with code {process.exitcode}'))
+                else:
+                    entry[2] += 1
+                    self._tasks[i].put(task)
+
+    def _finish(
+        self, task_id: int, outputs: Optional[Tuple], error: Optional[str]
+    ) -> None:
+        _, task, _ = self._pending.pop(task_id)
+        if task[2] is not None:
+            self._free.append(task[2])
+        self._done[task_id] = (outputs, error)
+
+    def _poll(self) -> int:
+        """
+        Handles one message of the workers, or checks their liveness if
+        none arrives.
+
+        Returns:
+            int: 1 if a worker reported that it is ready, 0 otherwise
+        """
+        try:
+            task_id, worker, outputs, error = self._results.get(
+                timeout=POLL_INTERVAL)
+        except queue.Empty:
+            self._check_workers()
+            return 0
+        if task_id is None:
+            if error is not None:
+                self.close()
+                raise RuntimeError(
+                    f'Worker {worker} failed to load the model: {error}')
+            return 1
+        # Restarted workers may repeat a finished task.
+        if task_id in self._pending:
+            self._finish(task_id, outputs, error)
+        return 0
+
+    def _submit(
+        self,
+        op: str,
+        x: Optional[np.ndarray] = None,
+        kwargs: Optional[Dict] = None,
+        worker: Optional[int] = None,
+        shape: Optional[Tuple[int, ...]] = None,
+    ) -> int:
+        if self._closed:
+            raise RuntimeError('The engine is closed')
+        slot = path = dtype = None
+        if x is not None:
+            while not self._free:
+                self._poll()
+            slot = self._free.popleft()
+            path, shape, dtype = self._slots[slot].write(x)
+        if worker is None:
+            load = [0] * self.num_workers
+            for entry in self._pending.values():
+                load[entry[0]] += 1
+            worker = load.index(min(load))
+        task_id = self._next_task
+        self._next_task += 1
+        task = (task_id, op, slot, path, shape, dtype, kwargs or {})
+        self._pending[task_id] = [worker, task, 1]
+        self._tasks[worker].put(task)
+        return task_id
+
+    def _wait(self, task_ids: List[int]) -> List[Tuple[np.ndarray, ...]]:
+        # All tasks are collected before raising, so none stays in _done.
+        results = []
+        for task_id in task_ids:
+            while task_id not in self._done:
+                self._poll()
+            results.append(self._done.pop(task_id))
+        for _, error in results:
+            if error is not None:
+                raise RuntimeError(f'Inference failed in a worker: {error}')
+        return [outputs for outputs, _ in results]
+
+    def _shard_bounds(self, batch_size: int) -> np.ndarray:
+        num_shards = min(self.num_workers, max(1, batch_size))
+        return np.linspace(0, batch_size, num_shards + 1).astype(int)
+
+    def _submit_batch(self, x: np.ndarray, kwargs: Dict) -> List[int]:
+        bounds = self._shard_bounds(len(x))
+        return [
+            self._submit('run', x[start:stop], kwargs)
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def _gather(self, task_ids: List[int]) -> Tuple[np.ndarray, ...]:
+        shards = self._wait(task_ids)
+        return tuple(
+            _concatenate([shard[i] for shard in shards])
+            for i in range(len(shards[0])))
+
+    def run(self, x: np.ndarray, **kwargs) -> Tuple[np.ndarray, ...]:
+        """
+        Infers a batch, sharded over the workers.
+
+        Args:
+            x (np.ndarray): Input batch, shape (batch, height, width, 3)
+            **kwargs: Further inputs of the model call, e.g. threshold
+
+        Returns:
+            Tuple[np.ndarray, ...]: Model outputs
+        """
+        return self._gather(self._submit_batch(np.asarray(x), kwargs))
+
+    def imap(
+        self, batches: Iterable[np.ndarray], **kwargs
+    ) -> Iterator[Tuple[np.ndarray, ...]]:
+        """
+        Infers a stream of batches, keeping up to depth batches in flight,
+        and yields the outputs in order.
+        """
+        in_flight: Deque[List[int]] = deque()
+        for x in batches:
+            in_flight.append(self._submit_batch(np.asarray(x), kwargs))
+            if len(in_flight) > self.depth:
+                yield self._gather(in_flight.popleft())
+        while in_flight:
+            yield self._gather(in_flight.popleft())
+
+    def warm_up(self, shape: Tuple[int, ...]) -> None:
+        """
+        Warms up every worker with the shard sizes of a batch, as split by
+        run. Shards may be uneven, e.g. 2 and 3 images of 5, and go to the
+        least loaded worker, so every worker is warmed up with each size.
+
+        Args:
+            shape (Tuple[int, ...]): Input shape (batch, height, width, 3)
+        """
+        sizes = sorted(set(np.diff(self._shard_bounds(shape[0])).tolist()))
+        task_ids = [
+            self._submit('warm_up', worker=i, shape=(size, *shape[1:]))
+            for i in range(self.num_workers) for size in sizes]
+        with startup_report.timed('warmup', f'{self.kind} workers'):
+            self._wait(task_ids)
+
+    def close(self, timeout: float = 5.) -> None:
+        """
+        Stops the workers and releases the shared memory.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for tasks, process in zip(self._tasks, self._workers):
+            if process is not None and process.is_alive():
+                tasks.put(None)
+        for process in self._workers:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._finalizer()
+
+    def __enter__(self) -> 'ShardedEngine':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -8,72 +8,412 @@
 # either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+"""
+Downloads and extracts the models and sample data.
+
+Usage:
+    python -m smart_tagging.examples.download_examples [--mirror <dir/url>]
+
+Assets are streamed to disk in chunks, resumed with HTTP range requests
+after a dropped connection, verified against the SHA-256 digests of the
+manifest and downloaded in parallel. A mirror directory or URL holding
+<asset name>.zip files, e.g. served by a local HTTP server, replaces the
+original URLs; it can also be set with the SMART_TAGGING_MIRROR
+environment variable.
+"""
+
+import argparse
+import hashlib
+import json
 import os
-import tempfile
+import sys
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Dict, NamedTuple, Optional, Sequence, Union
 
 import requests
 
+base_dir = Path(os.path.abspath(os.path.dirname(__file__))).parent
+
+MANIFEST = base_dir / 'examples' / 'download_manifest.json'
+DOWNLOAD_DIR = base_dir / 'examples' / 'downloads'
+CHUNK_SIZE = 1 << 20
+
+
+class Asset(NamedTuple):
+    """
+    Zip archive extracted into target, relative to the package root. It is
+    installed if target contains the marker file or, without marker, any
+    file.
+    """
+    name: str
+    description: str
+    url: str
+    target: str
+    marker: Optional[str] = None
+
+
+ASSETS = (
+    Asset(
+        'object_detection_model', "'Object Detection' model",
+        'https://dl2.intempora.com/index.php/s/dE5paamcKQXPSda/download',
+        'object_detection/saved_model', 'saved_model.pb'),
+    Asset(
+        'novelty_detection_model', "'Novelty Detection' model",
+        'https://dl2.intempora.com/index.php/s/QRzst9k6DLmxGbK/download',
+        'novelty_detection/saved_model', 'saved_model.pb'),
+    Asset(
+        'object_detection_data', "'Object Detection' sample data",
+        'https://dl2.intempora.com/index.php/s/skMpebbdqZ8oGMs/download',
+        'examples/object_detection/datasets'),
+    Asset(
+        'novelty_detection_data', "'Novelty Detection' sample data",
+        'https://dl2.intempora.com/index.php/s/cFnZg4ooBziRQre/download',
+        'examples/novelty_detection/datasets'),
+)
+
+
+def is_installed(asset: Asset) -> bool:
+    target = base_dir / asset.target
+    if asset.marker is not None:
+        return (target / asset.marker).exists()
+    return target.is_dir() and any(target.iterdir())
+
+
+def load_manifest(path: Union[str, Path] = MANIFEST) -> Dict[str, Dict]:
+    """
+    Reads the expected SHA-256 digest of every asset.
+
+    Returns:
+        Dict[str, Dict]: {"sha256": str or None} by asset name
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def save_manifest(
+    manifest: Dict[str, Dict], path: Union[str, Path] = MANIFEST
+) -> None:
+    with Path(path).open('w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+class Progress:
+    """
+    Thread-safe progress of parallel downloads, printed at most once per
+    interval.
+    """
+    def __init__(self, interval: float = 1., file=sys.stdout):
+        self.interval = interval
+        self.file = file
+        self.done: Dict[str, int] = {}
+        self.total: Dict[str, Optional[int]] = {}
+        self.lock = threading.Lock()
+        self.next_report = 0.
+
+    def start(self, name: str, done: int, total: Optional[int]) -> None:
+        with self.lock:
+            self.done[name] = done
+            self.total[name] = total
+
+    def advance(self, name: str, num_bytes: int) -> None:
+        with self.lock:
+            self.done[name] += num_bytes
+            now = time.monotonic()
+            if now < self.next_report:
+                return
+            self.next_report = now + self.interval
+            print('  ' + self.summary(), file=self.file, flush=True)
+
+    def summary(self) -> str:
+        parts = []
+        for name, done in self.done.items():
+            total = self.total[name]
+            if total:
+                parts.append(
+                    f'{name} {100 * done / total:.0f}% of '
+                    f'{total / 1e6:.1f} MB')
+            else:
+                parts.append(f'{name} {done / 1e6:.1f} MB')
+        return ', '.join(parts)
+
+
+def _hash_file(path: Path, digest, chunk_size: int = CHUNK_SIZE) -> None:
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+
+def _is_url(source: str) -> bool:
+    return source.startswith(('http://', 'https://'))
+
+
+def _fetch_url(
+    url: str,
+    part: Path,
+    digest,
+    on_start: Callable[[int, Optional[int]], None],
+    on_chunk: Callable[[int], None],
+    chunk_size: int,
+    timeout: float,
+) -> None:
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with requests.get(
+            url, headers=headers, stream=True, timeout=timeout) as r:
+        # The part file is already complete.
+        if offset and r.status_code == 416:
+            _hash_file(part, digest, chunk_size)
+            on_start(offset, offset)
+            return
+        r.raise_for_status()
+        if r.status_code != 206:
+            # The server ignores range requests, start over.
+            offset = 0
+        elif offset:
+            _hash_file(part, digest, chunk_size)
+        length = r.headers.get('Content-Length')
+        on_start(offset, offset + int(length) if length else None)
+        with part.open('ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size):
+                f.write(chunk)
+                digest.update(chunk)
+                on_chunk(len(chunk))
+
+
+def _fetch_file(
+    path: Path,
+    part: Path,
+    digest,
+    on_start: Callable[[int, Optional[int]], None],
+    on_chunk: Callable[[int], None],
+    chunk_size: int,
+) -> None:
+    on_start(0, path.stat().st_size)
+    with path.open('rb') as src, part.open('wb') as dst:
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            dst.write(chunk)
+            digest.update(chunk)
+            on_chunk(len(chunk))
+
+
+def download(
+    source: str,
+    path: Path,
+    sha256: Optional[str] = None,
+    progress: Optional[Progress] = None,
+    retries: int = 5,
+    chunk_size: int = CHUNK_SIZE,
+    timeout: float = 30.,
+) -> str:
+    """
+    Streams a URL or local file to path in chunks.
+
+    The data is written to path + ".part" first and only renamed once it
+    is complete and verified. An interrupted HTTP download, also from an
+    earlier run, resumes from the end of the part file with a range
+    request.
+
+    Args:
+        source (str): http(s) URL or local file path
+        path (Path): Output file
+        sha256 (str): Expected SHA-256 hex digest, None to skip the check
+        progress (Progress): Progress report, keyed by the file name
+        retries (int): Number of resumes after a connection error
+        chunk_size (int): Bytes per read and write
+        timeout (float): Seconds to wait for the server
+
+    Returns:
+        str: SHA-256 hex digest of the file
+    """
+    path = Path(path)
+    part = path.with_name(path.name + '.part')
+    name = path.stem
+
+    def on_start(done: int, total: Optional[int]) -> None:
+        if progress is not None:
+            progress.start(name, done, total)
+
+    def on_chunk(num_bytes: int) -> None:
+        if progress is not None:
+            progress.advance(name, num_bytes)
+
+    for attempt in range(retries + 1):
+        digest = hashlib.sha256()
+        try:
+            if _is_url(source):
+                _fetch_url(source, part, digest, on_start, on_chunk,
+                           chunk_size, timeout)
+            else:
+                _fetch_file(Path(source[len('file://'):]
+                                 if source.startswith('file://')
+                                 else source),
+                            part, digest, on_start, on_chunk, chunk_size)
+            break
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+            time.sleep(min(2 ** attempt, 30))
+
+    hexdigest = digest.hexdigest()
+    if sha256 is not None and hexdigest != sha256.lower():
+        part.unlink()
+        raise IOError(
+            f'SHA-256 of {source} is {hexdigest}, expected {sha256}')
+    part.replace(path)
+    return hexdigest
+
+
+def asset_source(asset: Asset, mirror: Optional[str] = None) -> str:
+    """
+    Returns:
+        str: URL or local path of the asset, <mirror>/<name>.zip if a
+            mirror is given
+    """
+    if not mirror:
+        return asset.url
+    if _is_url(mirror) or mirror.startswith('file://'):
+        return f"{mirror.rstrip('/')}/{asset.name}.zip"
+    return str(Path(mirror) / f'{asset.name}.zip')
+
+
+def install(
+    asset: Asset,
+    manifest: Dict[str, Dict],
+    mirror: Optional[str] = None,
+    download_dir: Path = DOWNLOAD_DIR,
+    progress: Optional[Progress] = None,
+) -> str:
+    """
+    Downloads, verifies and extracts an asset. The archive is deleted
+    after extraction.
+
+    Returns:
+        str: SHA-256 hex digest of the archive
+    """
+    expected = manifest.get(asset.name, {}).get('sha256')
+    download_dir.mkdir(parents=True, exist_ok=True)
+    archive = download_dir / f'{asset.name}.zip'
+    digest = download(
+        asset_source(asset, mirror), archive, expected, progress)
+    if expected is None:
+        print(f'  {asset.name} is not pinned in the manifest, '
+              f'SHA-256 {digest}')
+    target = base_dir / asset.target
+    target.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(archive, 'r') as zf:
+        zf.extractall(target)
+    archive.unlink()
+    return digest
+
 
 def download_and_unzip(url: str, target: Path) -> None:
-    r = requests.get(url)
-    with tempfile.NamedTemporaryFile(mode='w+b', suffix='.zip') as tmpfile:
-        tmpfile.write(r.content)
-        with zipfile.ZipFile(tmpfile, 'r') as zf:
+    """
+    Streams a zip archive to a temporary file and extracts it.
+    """
+    target = Path(target)
+    target.mkdir(parents=True, exist_ok=True)
+    archive = target / 'download.zip'
+    try:
+        download(url, archive)
+        with zipfile.ZipFile(archive, 'r') as zf:
             zf.extractall(target)
+    finally:
+        if archive.exists():
+            archive.unlink()
+
+
+def check_and_install_exdata(
+    mirror: Optional[str] = None,
+    manifest_path: Union[str, Path] = MANIFEST,
+    jobs: int = 4,
+    download_dir: Path = DOWNLOAD_DIR,
+    update_manifest: bool = False,
+) -> Dict[str, str]:
+    """
+    Downloads and extracts all missing assets in parallel.
+
+    Args:
+        mirror (str): Directory or URL holding <asset name>.zip files,
+            defaults to the SMART_TAGGING_MIRROR environment variable
+        manifest_path (str/Path): JSON file with the expected digests
+        jobs (int): Number of parallel downloads
+        download_dir (Path): Directory of the archives and part files
+        update_manifest (bool): Record the digests of the downloaded
+            archives in the manifest
+
+    Returns:
+        Dict[str, str]: SHA-256 hex digest by name of the downloaded assets
+    """
+    mirror = mirror or os.environ.get('SMART_TAGGING_MIRROR')
+    manifest = load_manifest(manifest_path)
+    missing = [asset for asset in ASSETS if not is_installed(asset)]
+    for asset in missing:
+        print(f"{asset.description} missing. Starting download:")
+    if not missing:
+        return {}
+
+    progress = Progress()
+    digests, errors = {}, []
+    with ThreadPoolExecutor(max(1, jobs)) as executor:
+        futures = [
+            (asset, executor.submit(
+                install, asset, manifest, mirror, download_dir, progress))
+            for asset in missing]
+        for asset, future in futures:
+            try:
+                digests[asset.name] = future.result()
+                print(f"  Downloaded and extracted {asset.description}.")
+            except Exception as e:
+                print(f"  Failed to download {asset.description}: {e}",
+                      file=sys.stderr)
+                errors.append(e)
+
+    if update_manifest and digests:
+        for name, digest in digests.items():
+            manifest.setdefault(name, {})['sha256'] = digest
+        save_manifest(manifest, manifest_path)
+    if errors:
+        raise errors[0]
+    return digests
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m smart_tagging.examples.download_examples',
+        description='Downloads the models and sample data.')
+    parser.add_argument(
+        '--mirror',
+        help='directory or URL holding <asset name>.zip files, e.g. '
+             'http://localhost:8000, defaults to SMART_TAGGING_MIRROR')
+    parser.add_argument(
+        '--manifest', type=Path, default=MANIFEST,
+        help='JSON file with the SHA-256 digest of every asset')
+    parser.add_argument(
+        '--jobs', type=int, default=4, help='number of parallel downloads')
+    parser.add_argument(
+        '--download-dir', type=Path, default=DOWNLOAD_DIR,
+        help='directory of the archives while downloading')
+    parser.add_argument(
+        '--update-manifest', action='store_true',
+        help='record the digests of the downloaded archives')
+    return parser.parse_args(argv)
 
 
-def check_and_install_exdata() -> None:
-    # Download files
-    base_dir = Path(os.path.abspath(os.path.dirname(__file__))).parent
-
-    # Download object detection saved model
-    object_detection = base_dir / 'object_detection'
-    target = object_detection / 'saved_model'
-    if not (target / 'saved_model.pb').exists():
-        print("'Object Detection' model missing. Starting download:")
-        download_and_unzip(
-            'https://dl2.intempora.com/index.php/s/dE5paamcKQXPSda/download',
-            target
-        )
-        print("  Downloaded and extracted 'Object Detection' model.")
-
-    # Download novelty detection saved model
-    novelty_detection = base_dir / 'novelty_detection'
-    target = novelty_detection / 'saved_model'
-    if not (target / 'saved_model.pb').exists():
-        print("'Novelty Detection' model missing. Starting download:")
-        download_and_unzip(
-            'https://dl2.intempora.com/index.php/s/QRzst9k6DLmxGbK/download',
-            target
-        )
-        print("  Downloaded and extracted 'Novelty Detection' model.")
-
-    # Download object detection sample data
-    object_detection = base_dir / 'object_detection'
-    target = base_dir / 'examples' / 'object_detection' / 'datasets'
-    target.mkdir(exist_ok=True)
-    if len(list(target.iterdir())) == 0:
-        print("'Object Detection' sample data missing. Starting download:")
-        download_and_unzip(
-            'https://dl2.intempora.com/index.php/s/skMpebbdqZ8oGMs/download',
-            target
-        )
-        print("  Downloaded and extracted 'Object Detection' sample data.")
-
-    # Download novelty detection sample data
-    novelty_detection = base_dir / 'novelty_detection'
-    target = base_dir / 'examples' / 'novelty_detection' / 'datasets'
-    target.mkdir(exist_ok=True)
-    if len(list(target.iterdir())) == 0:
-        print("'Novelty Detection' sample data missing. Starting download:")
-        download_and_unzip(
-            'https://dl2.intempora.com/index.php/s/cFnZg4ooBziRQre/download',
-            target
-        )
-        print("  Downloaded and extracted 'Novelty Detection' sample data.")
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    check_and_install_exdata(
+        args.mirror, args.manifest, args.jobs, args.download_dir,
+        args.update_manifest)
 
 
 if __name__ == "__main__":
-    check_and_install_exdata()
+    main()
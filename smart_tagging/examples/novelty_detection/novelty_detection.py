@@ -8,46 +8,353 @@
 # either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import time
 from pathlib import Path
+from typing import List, Tuple
 
 import numpy as np
 import rtmaps.types
 from rtmaps.base_component import BaseComponent
 from smart_tagging import project_root
-from smart_tagging.novelty_detection.model import PairwiseFilter
+from smart_tagging.buffers import BatchBuffer
+from smart_tagging.instrumentation import Instrumentation, SnapshotWriter
+from smart_tagging.novelty_detection.feature_store import (
+    FeatureStore,
+    store_name,
+)
+from smart_tagging.novelty_detection.memory_bank import MemoryBank
+from smart_tagging.novelty_detection.segmentation import StreamingSegmenter
+from smart_tagging.novelty_detection.utils import similarity_to_rating
+from smart_tagging.pipeline import Pipeline
+from smart_tagging.profiles import parse_ranges, resolve_profile
+from smart_tagging.startup import (
+    BackgroundLoader,
+    declared_resolution,
+    lazy_import,
+    parse_resolution,
+    startup_report,
+)
 from smart_tagging.utils import get_ioelt
 
+# TensorFlow is only imported in Birth, not when RTMaps loads the block.
+model = lazy_import('smart_tagging.novelty_detection.model')
+
+# Stages of the "latency" output, 'inference' includes the model stages.
+LATENCY_STAGES = (
+    'ingest', 'inference', 'model.features', 'model.scoring', 'write')
+
 
 class NoveltyFilter(BaseComponent):
     """
     Inherits from the RTMaps python bridge template.
     Can be used as a single block in the RTMaps diagram.
+
+    If the "pipelined" property is set, the similarity is computed on a
+    worker thread and Core only copies the input image into a pool of
+    preallocated buffers. Otherwise the model reads the RTMaps input buffer
+    directly, which stays valid until Core returns.
+
+    If the "background_load" property is set, the model is loaded on a
+    background thread and frames are skipped until it is ready.
+
+    The "instrumentation", "metrics_file", "metrics_interval" and
+    "latency_output" properties work as in the object detection block.
+
+    With "workers" > 0, the features are extracted on that many worker
+    processes, see smart_tagging.engine. "python_executable" works as in
+    the object detection block.
+
+    The "execution_profile", "intra_op_threads", "inter_op_threads" and
+    "cpus" properties work as in the object detection block. The profile
+    is tuned for the "batch_size" property.
+
+    If the "segmentation" property is set, the similarity ratings are split
+    into scene segments by a StreamingSegmenter with the "segment_high",
+    "segment_low", "segment_min_length" and "keyframe_interval" properties.
+    For every frame, the "segment" output gives the index of its segment,
+    "boundary" and "keyframe" are 1 if a segment starts or a keyframe is
+    taken at the frame, and "data_reduction" the share of non-keyframes.
     """
     def __init__(self):
         BaseComponent.__init__(self)
         self.buffer_img = None
 
     def Dynamic(self):
+        self.add_property("pipelined", False)
+        self.add_property("overload_policy", "latest")
+        self.add_property("queue_size", 2)
+        self.add_property("batch_size", 1)
+        self.add_property("memory_size", 0)
+        self.add_property("memory_top_k", 1)
+        self.add_property("memory_policy", "ring")
+        self.add_property("memory_bank_file", "")
+        self.add_property("feature_store_dir", "")
+        self.add_property("recording_id", "")
+        self.add_property("model_path", "")
+        self.add_property("precision", "float32")
+        self.add_property("backend", "")
+        self.add_property("workers", 0)
+        self.add_property("python_executable", "")
+        self.add_property("execution_profile", "")
+        self.add_property("intra_op_threads", 0)
+        self.add_property("inter_op_threads", 0)
+        self.add_property("cpus", "")
+        self.add_property("warmup", True)
+        self.add_property("warmup_resolution", "")
+        self.add_property("background_load", False)
+        self.add_property("segmentation", False)
+        self.add_property("segment_high", 0.3)
+        self.add_property("segment_low", 0.1)
+        self.add_property("segment_min_length", 1.0)
+        self.add_property("keyframe_interval", 0.0)
+        self.add_property("instrumentation", False)
+        self.add_property("metrics_file", "")
+        self.add_property("metrics_interval", 10.0)
+        self.add_property("latency_output", False)
         self.add_input("image_in", rtmaps.types.ANY)
         self.add_output("similarity", rtmaps.types.AUTO, 1)
+        if self.properties["segmentation"].data:
+            self.add_output("segment", rtmaps.types.ANY, 1)
+            self.add_output("boundary", rtmaps.types.ANY, 1)
+            self.add_output("keyframe", rtmaps.types.ANY, 1)
+            self.add_output("data_reduction", rtmaps.types.ANY, 1)
+        if self.properties["latency_output"].data:
+            self.add_output(
+                "latency", rtmaps.types.ANY, 3 * len(LATENCY_STAGES))
 
     def Birth(self):
-        self.novelty_module = PairwiseFilter(
-            project_root / 'novelty_detection' / 'saved_model'
+        self.instrumentation = Instrumentation(
+            'novelty_detection', self.properties["instrumentation"].data)
+        enabled = self.instrumentation.enabled
+        self.snapshot_writer = None
+        if enabled and self.properties["metrics_file"].data:
+            self.snapshot_writer = SnapshotWriter(
+                self.properties["metrics_file"].data)
+        self.latency_output = (
+            enabled and self.properties["latency_output"].data)
+        self.next_metrics = time.monotonic()
+        self.num_dropped = 0
+
+        # Compare against a memory bank of past frames if requested.
+        self.memory_bank = None
+        self.memory_bank_file = self.properties["memory_bank_file"].data
+        if self.memory_bank_file and Path(self.memory_bank_file).exists():
+            self.memory_bank = MemoryBank.load(self.memory_bank_file)
+        elif self.properties["memory_size"].data > 0:
+            self.memory_bank = MemoryBank(
+                capacity=self.properties["memory_size"].data,
+                top_k=self.properties["memory_top_k"].data,
+                policy=self.properties["memory_policy"].data,
+            )
+
+        # Features are stored by timestamp, so every recording needs its
+        # own id to not return the features of another one.
+        if (self.properties["feature_store_dir"].data
+                and not self.properties["recording_id"].data):
+            raise ValueError(
+                'The feature store requires a unique recording_id')
+
+        self.segmenter = None
+        if self.properties["segmentation"].data:
+            self.segmenter = StreamingSegmenter(
+                high=self.properties["segment_high"].data,
+                low=self.properties["segment_low"].data,
+                min_length=self.properties["segment_min_length"].data,
+                keyframe_interval=self.properties["keyframe_interval"].data)
+
+        self.startup_reported = False
+        self.loader = None
+        if self.properties["background_load"].data:
+            self.loader = BackgroundLoader(self.load, 'novelty detection')
+        else:
+            self.load()
+
+        self.infer = self.instrumentation.wrap('inference', self.infer_batch)
+        # An image is owned by its frame until it is inferred or dropped:
+        # a batch is read by the inference stage while up to queue_size
+        # further images wait and Core fills the next one.
+        pipelined = self.properties["pipelined"].data
+        self.buffer = BatchBuffer(
+            self.properties["queue_size"].data
+            + self.properties["batch_size"].data + 1
+            if pipelined else 1)
+        self.pipeline = None
+        if pipelined:
+            self.pipeline = Pipeline(
+                [self.infer],
+                maxsize=self.properties["queue_size"].data,
+                policy=self.properties["overload_policy"].data,
+                batch_size=self.properties["batch_size"].data,
+                on_drop=self.drop,
+                on_error=self.drop,
+            )
+            self.pipeline.start()
+
+    def load(self) -> None:
+        """
+        Loads and warms up the model.
+        """
+        model_path = (self.properties["model_path"].data
+                      or project_root / 'novelty_detection' / 'saved_model')
+        options = {
+            'precision': self.properties["precision"].data,
+            'backend': self.properties["backend"].data or None,
+        }
+        # Reuse the features of earlier runs over the same recording.
+        self.feature_store = None
+        if self.properties["feature_store_dir"].data:
+            self.feature_store = FeatureStore(
+                self.properties["feature_store_dir"].data,
+                store_name(
+                    self.properties["recording_id"].data, model_path,
+                    **options))
+        self.profile = resolve_profile(
+            self.properties["execution_profile"].data, model_path,
+            parse_resolution(self.properties["warmup_resolution"].data),
+            batch_sizes=(max(1, self.properties["batch_size"].data),),
+            options=options,
+            intra_op_threads=self.properties["intra_op_threads"].data,
+            inter_op_threads=self.properties["inter_op_threads"].data,
+            cpus=parse_ranges(self.properties["cpus"].data),
+            executable=self.properties["python_executable"].data or None)
+        workers = self.properties["workers"].data
+        engine_options = {}
+        if workers > 0:
+            engine_options = {
+                'num_workers': workers,
+                'executable': self.properties["python_executable"].data
+                or None,
+            }
+        novelty_class = (model.ShardedPairwiseFilter if workers > 0
+                         else model.PairwiseFilter)
+        self.novelty_module = novelty_class(
+            model_path,
+            memory_bank=self.memory_bank,
+            feature_store=self.feature_store,
+            instrumentation=self.instrumentation,
+            profile=self.profile,
+            **options,
+            **engine_options,
         )
 
+        if self.properties["warmup"].data:
+            resolution = (
+                parse_resolution(self.properties["warmup_resolution"].data)
+                or declared_resolution(self.novelty_module.config))
+            if resolution is not None:
+                self.novelty_module.warm_up((1, *resolution, 3))
+
     def Core(self):
+        if self.loader is not None and not self.loader.ready:
+            return
 
-        image = self.inputs["image_in"].ioelt.data.image_data.copy()
-        input_ts = self.inputs["image_in"].ioelt.ts
+        instrumentation = self.instrumentation
+        with instrumentation.stage('ingest'):
+            image = self.inputs["image_in"].ioelt.data.image_data
+            input_ts = self.inputs["image_in"].ioelt.ts
+            if self.pipeline is not None:
+                image = self.buffer.stack([image])
+            else:
+                image = image[np.newaxis]
 
-        sim = self.novelty_module(image).numpy()
-        sim = 1. - np.arccos(sim) / np.pi * 2
-        sim = sim.astype(np.float32)
+        if self.pipeline is None:
+            sim = self.infer([(input_ts, image)])[0]
+            with instrumentation.stage('write'):
+                self.write(input_ts, sim)
+        else:
+            self.pipeline.submit(input_ts, (input_ts, image))
+            for ts, sim in self.pipeline.results():
+                with instrumentation.stage('write'):
+                    self.write(ts, sim)
+        if instrumentation.enabled:
+            instrumentation.count('frames')
+            self.report_metrics(input_ts)
 
+    def report_metrics(self, input_ts: int) -> None:
+        """
+        Writes the metrics snapshot and the latency output once per
+        metrics interval.
+        """
+        now = time.monotonic()
+        if now < self.next_metrics:
+            return
+        self.next_metrics = now + self.properties["metrics_interval"].data
+        if self.pipeline is not None:
+            self.instrumentation.count(
+                'dropped', self.pipeline.num_dropped - self.num_dropped)
+            self.num_dropped = self.pipeline.num_dropped
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.write(self.instrumentation)
+        if self.latency_output:
+            latency = np.array([
+                self.instrumentation.quantiles(stage)
+                for stage in LATENCY_STAGES]).ravel()
+            self.outputs["latency"].write(get_ioelt(input_ts, latency))
+
+    def infer_batch(
+        self, frames: List[Tuple[int, np.ndarray]]
+    ) -> List[np.ndarray]:
+        """
+        Computes the similarity ratings of consecutive (timestamp, image)
+        pairs, every image with a batch axis of one.
+        """
+        timestamps, batches = zip(*frames)
+        images = (batches[0] if len(batches) == 1
+                  else np.concatenate(batches, axis=0))
+        sims = self.novelty_module.batch(
+            images, batch_size=len(images),
+            keys=timestamps)
+        # Hand the images back, their buffers are reused. If the model
+        # fails, drop does.
+        for batch in batches:
+            self.buffer.release(batch)
+        return list(similarity_to_rating(sims.numpy())[:, np.newaxis])
+
+    def drop(self, frame: Tuple[int, np.ndarray]) -> None:
+        """
+        Hands back the image of a frame which was dropped or on which the
+        inference failed.
+        """
+        self.buffer.release(frame[1])
+
+    def write(self, input_ts: int, sim: np.ndarray) -> None:
+        """
+        Writes the similarity rating of a frame.
+        """
         similarity = get_ioelt(input_ts, sim)
 
         self.outputs["similarity"].write(similarity)
+        if self.segmenter is not None:
+            self.write_segments(input_ts, float(sim[0]))
+        if not self.startup_reported:
+            # Once, after the first inference, from the component thread.
+            self.startup_reported = True
+            print(startup_report.summary())
+
+    def write_segments(self, input_ts: int, rating: float) -> None:
+        """
+        Advances the segmenter and writes the segment outputs of a frame.
+        """
+        kinds = {
+            event.kind for event in self.segmenter.update(rating, input_ts)}
+        segmenter = self.segmenter
+        self.outputs["segment"].write(
+            get_ioelt(input_ts, segmenter.segment))
+        self.outputs["boundary"].write(
+            get_ioelt(input_ts, int('boundary' in kinds)))
+        self.outputs["keyframe"].write(
+            get_ioelt(input_ts, int('keyframe' in kinds)))
+        self.outputs["data_reduction"].write(
+            get_ioelt(input_ts, np.float32(segmenter.data_reduction)))
 
     def Death(self):
-        pass
+        if self.pipeline is not None:
+            # Write the frames which finished while draining.
+            for ts, sim in self.pipeline.stop():
+                self.write(ts, sim)
+        if hasattr(getattr(self, 'novelty_module', None), 'close'):
+            self.novelty_module.close()
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.write(self.instrumentation)
+        if self.memory_bank is not None and self.memory_bank_file:
+            self.memory_bank.save(self.memory_bank_file)
@@ -8,30 +8,190 @@
 # either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
 import numpy as np
 import rtmaps.types
 from rtmaps.base_component import BaseComponent
 from smart_tagging import project_root
-from smart_tagging.object_detection.model import ObjectDetection
-from smart_tagging.object_detection.utils import (
-    CLASS_IDS_TO_COLORS,
-    get_bbox_annotation,
-    get_rtmaps_bbox,
-    mask_padding,
+from smart_tagging.buffers import BatchBuffer
+from smart_tagging.gating import NoveltyGate
+from smart_tagging.instrumentation import Instrumentation, SnapshotWriter
+from smart_tagging.object_detection.batching import MixedResolutionBatcher
+from smart_tagging.object_detection.cache import (
+    CachedDetector,
+    DetectionCache,
+    model_fingerprint,
+)
+from smart_tagging.object_detection.overlay import OverlayPool
+from smart_tagging.object_detection.statistics import DetectionStatistics
+from smart_tagging.object_detection.tiling import TiledDetector, parse_roi
+from smart_tagging.object_detection.tracking import IoUTracker
+from smart_tagging.object_detection.utils import pack_detections
+from smart_tagging.pipeline import Pipeline
+from smart_tagging.profiles import parse_ranges, resolve_profile
+from smart_tagging.startup import (
+    BackgroundLoader,
+    declared_resolution,
+    lazy_import,
+    parse_resolution,
+    startup_report,
 )
+from smart_tagging.taglog import TagLog
 from smart_tagging.utils import get_ioelt
 
+# TensorFlow is only imported in Birth, not when RTMaps loads the block.
+model = lazy_import('smart_tagging.object_detection.model')
+novelty = lazy_import('smart_tagging.novelty_detection.model')
+
+# Output size of the bounding box overlays, in drawing objects.
+MAX_DRAWING_OBJECTS = 200
+
+# Output size of the per-class statistics, (classes, images) flattened.
+MAX_STATISTICS = 16 * 16
+
+# Stages of the "latency" output, 'inference' includes 'model.inference'.
+LATENCY_STAGES = ('ingest', 'inference', 'model.inference', 'format', 'write')
+
+# Properties which change the detections, cache entries are kept apart
+# by them and the model fingerprint.
+CACHE_KEY_PROPERTIES = (
+    'precision', 'backend', 'jit_compile', 'batching',
+    'letterbox_resolution', 'tiling', 'tile_size', 'tile_overlap',
+    'tile_roi', 'tile_merge', 'tile_iou_threshold')
+
+# Outputs of the last detected frame, which skipped frames re-emit.
+GATED_KEYS = ('detections', 'track_ids', 'unique_counts')
+
 
 class ObjectDetectionBlock(BaseComponent):
     """
     RTMaps python bridge that deploys the object detection algorithm
     and provides the detections as well as statistics.
+
+    If the "pipelined" property is set, inference and output formatting
+    run on worker threads and Core only copies the inputs into a pool of
+    preallocated batches. Otherwise the model reads the RTMaps input
+    buffers directly, which stay valid until Core returns.
+
+    If the "background_load" property is set, the model is loaded on a
+    background thread and frames are skipped until it is ready.
+
+    The "total_counts", "cur_counts", "rates" and "shares" outputs hold the
+    statistics of all classes as (classes, images) matrices flattened in
+    row-major order, i.e. indexed by class_id * num_images + image. Rates
+    are given in objects/s over the last "rate_window" frames.
+
+    If the "tiling" property is set, every image is cut into overlapping
+    tiles of "tile_size", which are detected in one model call with the
+    tiles of the other images, so small objects are not lost by
+    downscaling. Duplicates at the tile seams are merged by "tile_merge"
+    ("nms" or "fusion") above "tile_iou_threshold". The "roi" mode detects
+    the whole image letterboxed into one tile and only tiles "tile_roi"
+    (xmin,ymin,xmax,ymax as fractions, the road region by default), see
+    smart_tagging.object_detection.tiling.
+
+    If the "detection_cache" property is set, the detections of every
+    image are cached by a hash of its content and the threshold, so frozen
+    or repeated frames and re-runs of a replay skip the model. The cache
+    holds up to "cache_size_mb" in memory and, with "cache_dir", is also
+    stored on disk for later runs. "cache_perceptual" keys by a coarse
+    perceptual hash, so near-duplicate frames hit as well. See
+    smart_tagging.object_detection.cache.
+
+    If the "tracking" property is set, detections are tracked over frames
+    and the "unique_*" outputs count every tracked object once. With
+    "detect_every" N > 1, the detector only runs on every N-th frame and
+    the boxes of the frames in between are predicted by the trackers.
+
+    If the "novelty_gate" property is set, the novelty features of every
+    frame are computed first and the detector only runs if the similarity
+    rating to the last detected frame drops below "novelty_threshold" or
+    "max_staleness" seconds have passed. Other frames re-emit the outputs
+    of the last detected frame with their own timestamp. The "skip_ratio"
+    output gives the share of skipped frames.
+
+    With "workers" > 0, the models run on that many worker processes,
+    which share the CPU cores, see smart_tagging.engine. They run the
+    "python_executable" interpreter, by default the one of the python
+    bridge's installation.
+
+    The "execution_profile" property selects the thread counts and batch
+    size of the model: "saved" reads the profile stored next to its
+    init.json, "tune" benchmarks the model at Birth and stores the fastest
+    profile there. "intra_op_threads", "inter_op_threads" and "cpus" (e.g.
+    "0-3") take precedence over the profile, so two blocks in one RTMaps
+    process can be pinned to separate cores.
+
+    The "overlay" property sets the level of detail of the "bbox_*"
+    outputs: "labels" draws boxes with class, track id and score, "boxes"
+    boxes only and "none" removes the outputs, e.g. for headless runs. The
+    drawing objects are preallocated and updated in place, see
+    smart_tagging.object_detection.overlay.
+
+    If the "tag_log" property is set to a directory, the detections and
+    similarity ratings of every image are appended to a tag log there,
+    which can be queried by time range, class and count without re-running
+    the model, see smart_tagging.taglog. "tag_log_source" names the
+    recording in the log.
+
+    If the "instrumentation" property is set, the latency of every stage is
+    recorded. Every "metrics_interval" seconds, a snapshot is written to
+    "metrics_file" (.json or Prometheus text otherwise) and, with
+    "latency_output", the p50/p95/p99 latency in ms of LATENCY_STAGES to
+    the "latency" output.
     """
     def __init__(self):
         BaseComponent.__init__(self)
 
     def Dynamic(self):
         self.add_property("num_images", 1)
+        self.add_property("pipelined", False)
+        self.add_property("overload_policy", "latest")
+        self.add_property("queue_size", 2)
+        self.add_property("jit_compile", False)
+        self.add_property("model_path", "")
+        self.add_property("precision", "float32")
+        self.add_property("backend", "")
+        self.add_property("workers", 0)
+        self.add_property("python_executable", "")
+        self.add_property("execution_profile", "")
+        self.add_property("intra_op_threads", 0)
+        self.add_property("inter_op_threads", 0)
+        self.add_property("cpus", "")
+        self.add_property("overlay", "labels")
+        self.add_property("batching", "stack")
+        self.add_property("letterbox_resolution", "")
+        self.add_property("tiling", "")
+        self.add_property("tile_size", "512x512")
+        self.add_property("tile_overlap", 0.2)
+        self.add_property("tile_roi", "")
+        self.add_property("tile_merge", "nms")
+        self.add_property("tile_iou_threshold", 0.5)
+        self.add_property("detection_cache", False)
+        self.add_property("cache_size_mb", 64)
+        self.add_property("cache_dir", "")
+        self.add_property("cache_perceptual", False)
+        self.add_property("warmup", True)
+        self.add_property("warmup_resolution", "")
+        self.add_property("background_load", False)
+        self.add_property("rate_window", 100)
+        self.add_property("tracking", False)
+        self.add_property("detect_every", 1)
+        self.add_property("track_iou_threshold", 0.3)
+        self.add_property("track_min_hits", 2)
+        self.add_property("track_max_age", 5)
+        self.add_property("novelty_gate", False)
+        self.add_property("novelty_model_path", "")
+        self.add_property("novelty_threshold", 0.9)
+        self.add_property("max_staleness", 1.0)
+        self.add_property("tag_log", "")
+        self.add_property("tag_log_source", "")
+        self.add_property("instrumentation", False)
+        self.add_property("metrics_file", "")
+        self.add_property("metrics_interval", 10.0)
+        self.add_property("latency_output", False)
         if self.properties["num_images"].data < 1:
             self.properties["num_images"].data = 1
         if self.properties["num_images"].data > 16:
@@ -40,7 +200,10 @@ class ObjectDetectionBlock(BaseComponent):
             name_in = "image_in_" + str(i)
             name_out = "bbox_" + str(i)
             self.add_input(name_in, rtmaps.types.ANY)
-            self.add_output(name_out, rtmaps.types.DRAWING_OBJECT, 200)
+            if self.properties["overlay"].data != "none":
+                self.add_output(
+                    name_out, rtmaps.types.DRAWING_OBJECT,
+                    MAX_DRAWING_OBJECTS)
         self.add_input("threshold", rtmaps.types.ANY)
         self.add_output("total_num_objects", rtmaps.types.ANY, 16)
         self.add_output("total_num_cars", rtmaps.types.ANY, 16)
@@ -48,100 +211,476 @@ class ObjectDetectionBlock(BaseComponent):
         self.add_output("cur_num_objects", rtmaps.types.ANY, 16)
         self.add_output("cur_num_cars", rtmaps.types.ANY, 16)
         self.add_output("cur_num_trucks", rtmaps.types.ANY, 16)
+        self.add_output("total_counts", rtmaps.types.ANY, MAX_STATISTICS)
+        self.add_output("cur_counts", rtmaps.types.ANY, MAX_STATISTICS)
+        self.add_output("rates", rtmaps.types.ANY, MAX_STATISTICS)
+        self.add_output("shares", rtmaps.types.ANY, MAX_STATISTICS)
+        if self.properties["tracking"].data:
+            self.add_output("unique_num_objects", rtmaps.types.ANY, 16)
+            self.add_output("unique_num_cars", rtmaps.types.ANY, 16)
+            self.add_output("unique_num_trucks", rtmaps.types.ANY, 16)
+            self.add_output(
+                "unique_counts", rtmaps.types.ANY, MAX_STATISTICS)
+        if self.properties["novelty_gate"].data:
+            self.add_output("similarity", rtmaps.types.ANY, 16)
+            self.add_output("detected", rtmaps.types.ANY, 1)
+            self.add_output("skip_ratio", rtmaps.types.ANY, 1)
+        if self.properties["detection_cache"].data:
+            self.add_output("cache_hit_ratio", rtmaps.types.ANY, 1)
+        if self.properties["latency_output"].data:
+            self.add_output(
+                "latency", rtmaps.types.ANY, 3 * len(LATENCY_STAGES))
 
     def Birth(self):
-        self.objects = ObjectDetection(
-            project_root / 'object_detection' / 'saved_model')
         self.num_images = self.properties["num_images"].data
+        self.instrumentation = Instrumentation(
+            'object_detection', self.properties["instrumentation"].data)
+        enabled = self.instrumentation.enabled
+        self.snapshot_writer = None
+        if enabled and self.properties["metrics_file"].data:
+            self.snapshot_writer = SnapshotWriter(
+                self.properties["metrics_file"].data)
+        self.latency_output = (
+            enabled and self.properties["latency_output"].data)
+        self.next_metrics = time.monotonic()
+        self.num_dropped = 0
+        self.model_path = (
+            self.properties["model_path"].data
+            or project_root / 'object_detection' / 'saved_model')
+        self.tiler = None
+        if self.properties["tiling"].data:
+            self.tiler = self.batcher = TiledDetector(
+                self.properties["tiling"].data,
+                parse_resolution(self.properties["tile_size"].data),
+                self.properties["tile_overlap"].data,
+                parse_roi(self.properties["tile_roi"].data),
+                self.properties["tile_iou_threshold"].data,
+                self.properties["tile_merge"].data)
+        else:
+            self.batcher = MixedResolutionBatcher(
+                self.properties["batching"].data,
+                parse_resolution(
+                    self.properties["letterbox_resolution"].data))
+        self.cache = None
+        if self.properties["detection_cache"].data:
+            self.cache = DetectionCache(
+                self.properties["cache_size_mb"].data << 20,
+                self.properties["cache_dir"].data or None,
+                self.properties["cache_perceptual"].data,
+                '|'.join([model_fingerprint(self.model_path)] + [
+                    str(self.properties[name].data)
+                    for name in CACHE_KEY_PROPERTIES]))
+            self.batcher = CachedDetector(self.batcher, self.cache)
+        self.startup_reported = False
+        self.loader = None
+        if self.properties["background_load"].data:
+            self.loader = BackgroundLoader(self.load, 'object detection')
+        else:
+            self.load()
+
+        instrumentation = self.instrumentation
+        self.stages = [
+            instrumentation.wrap('inference', self.infer),
+            instrumentation.wrap('format', self.format),
+        ]
+        # A batch is owned by its frame until it is inferred or dropped:
+        # one is read by the inference stage while up to queue_size further
+        # frames wait and Core fills the next one.
+        pipelined = self.properties["pipelined"].data
+        depth = self.properties["queue_size"].data + 2 if pipelined else 1
+        self.buffer = BatchBuffer(depth)
+        self.pipeline = None
+        if pipelined:
+            self.pipeline = Pipeline(
+                self.stages,
+                maxsize=self.properties["queue_size"].data,
+                policy=self.properties["overload_policy"].data,
+                on_drop=self.drop,
+                on_error=self.drop,
+            )
+            self.pipeline.start()
+        # Likewise, the overlays of that many frames usually await writing;
+        # a frame hands its overlays back once Core has written it.
+        self.overlay = OverlayPool(
+            self.num_images, MAX_DRAWING_OBJECTS,
+            self.properties["overlay"].data, generations=depth)
+
+    def load(self) -> None:
+        """
+        Loads and warms up the models and resets the statistics.
+        """
+        model_path = self.model_path
+        options = {
+            'precision': self.properties["precision"].data,
+            'backend': self.properties["backend"].data or None,
+        }
+        # The model is always called with a batch of num_images.
+        self.profile = resolve_profile(
+            self.properties["execution_profile"].data, model_path,
+            parse_resolution(self.properties["warmup_resolution"].data),
+            batch_sizes=(self.num_images,), options=options,
+            intra_op_threads=self.properties["intra_op_threads"].data,
+            inter_op_threads=self.properties["inter_op_threads"].data,
+            cpus=parse_ranges(self.properties["cpus"].data),
+            executable=self.properties["python_executable"].data or None)
+        workers = self.properties["workers"].data
+        engine_options = {}
+        if workers > 0:
+            engine_options = {
+                'num_workers': workers,
+                'executable': self.properties["python_executable"].data
+                or None,
+            }
+        detection_class = (model.ShardedObjectDetection if workers > 0
+                           else model.ObjectDetection)
+        self.objects = detection_class(
+            model_path,
+            jit_compile=self.properties["jit_compile"].data,
+            instrumentation=self.instrumentation,
+            profile=self.profile,
+            **options,
+            **engine_options)
         self.labels = {
             v: k.lower()
             for k, v in self.objects.config['model'][
                 'dict_class_names_to_ids'].items()}
-        self.num_detections = {}
-        self.num_detections['total_detections'] = np.array(
-            [0] * self.num_images)
-        for k in self.objects.config['model']['dict_class_names_to_ids']:
-            self.num_detections[k.lower()] = np.array([0] * self.num_images)
+        self.num_classes = max(self.labels) + 1
+        self.tag_log = None
+        if self.properties["tag_log"].data:
+            self.tag_log = TagLog(self.properties["tag_log"].data, self.labels)
+        self.statistics = DetectionStatistics(
+            self.labels, self.num_images,
+            window=self.properties["rate_window"].data)
+        self.trackers = None
+        self.detect_every = 1
+        self.frame_index = 0
+        if self.properties["tracking"].data:
+            # Tracks age on every frame, max_age counts detection frames.
+            self.detect_every = max(1, self.properties["detect_every"].data)
+            self.trackers = [
+                IoUTracker(
+                    self.num_classes,
+                    self.properties["track_iou_threshold"].data,
+                    self.properties["track_max_age"].data
+                    * self.detect_every,
+                    self.properties["track_min_hits"].data)
+                for _ in range(self.num_images)]
+        self.gate = None
+        if self.properties["novelty_gate"].data:
+            novelty_class = (novelty.ShardedPairwiseFilter if workers > 0
+                             else novelty.PairwiseFilter)
+            self.novelty_module = novelty_class(
+                self.properties["novelty_model_path"].data
+                or project_root / 'novelty_detection' / 'saved_model',
+                profile=self.profile,
+                **options,
+                **engine_options)
+            self.gate = NoveltyGate(
+                self.properties["novelty_threshold"].data,
+                self.properties["max_staleness"].data)
+
+        if self.properties["warmup"].data:
+            resolution = (
+                parse_resolution(self.properties["warmup_resolution"].data)
+                or declared_resolution(self.objects.config))
+            if resolution is not None:
+                shape = (self.num_images, *resolution, 3)
+                if self.tiler is not None:
+                    # The model sees the tiles of all images in one batch.
+                    shape = (
+                        self.tiler.batch_size([resolution] * self.num_images),
+                        *self.tiler.tile_size, 3)
+                self.objects.warm_up(shape)
+                if self.gate is not None:
+                    self.novelty_module.warm_up(
+                        (self.num_images, *resolution, 3))
 
     def Core(self):
-        # Read inputs.
+        if self.loader is not None and not self.loader.ready:
+            return
+        instrumentation = self.instrumentation
+        with instrumentation.stage('ingest'):
+            input_ts, frame = self.ingest()
+        if self.pipeline is None:
+            formatted = frame
+            try:
+                for stage in self.stages:
+                    formatted = stage(formatted)
+            except Exception:
+                self.drop(frame)
+                raise
+            with instrumentation.stage('write'):
+                self.write(formatted)
+        else:
+            self.pipeline.submit(input_ts, frame)
+            for _, formatted in self.pipeline.results():
+                with instrumentation.stage('write'):
+                    self.write(formatted)
+        if instrumentation.enabled:
+            instrumentation.count('frames')
+            self.report_metrics(input_ts)
+
+    def report_metrics(self, input_ts: int) -> None:
+        """
+        Writes the metrics snapshot and the latency output once per
+        metrics interval.
+        """
+        now = time.monotonic()
+        if now < self.next_metrics:
+            return
+        self.next_metrics = now + self.properties["metrics_interval"].data
+        if self.pipeline is not None:
+            self.instrumentation.count(
+                'dropped', self.pipeline.num_dropped - self.num_dropped)
+            self.num_dropped = self.pipeline.num_dropped
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.write(self.instrumentation)
+        if self.latency_output:
+            latency = np.array([
+                self.instrumentation.quantiles(stage)
+                for stage in LATENCY_STAGES]).ravel()
+            self.outputs["latency"].write(get_ioelt(input_ts, latency))
+
+    def ingest(self) -> Tuple[int, Dict]:
+        """
+        Reads the inputs of the current frame.
+
+        The images are views of the RTMaps input buffers in synchronous
+        mode and only copied once, into a preallocated batch, otherwise.
+        """
         threshold = self.inputs["threshold"].ioelt.data
         images_in = []
-        boxes_out = []
+        timestamps = []
         resolutions = []
         for i in range(self.num_images):
             name_in = "image_in_" + str(i)
             input_data = self.inputs[name_in].ioelt.data
             input_ts = self.inputs[name_in].ioelt.ts
-            images_in.append(input_data.image_data.copy())
+            images_in.append(input_data.image_data)
             resolutions.append(input_data.image_data.shape[:2])
-            boxes_out.append(get_ioelt(input_ts, []))
-        images = np.stack(images_in, axis=0)
+            timestamps.append(input_ts)
+        if self.pipeline is not None or (
+                self.num_images > 1 and len(set(resolutions)) == 1):
+            images_in = self.buffer.stack(images_in)
+        frame = {
+            'threshold': threshold,
+            'images': images_in,
+            'resolutions': resolutions,
+            'timestamps': timestamps,
+        }
+        return input_ts, frame
+
+    def infer(self, frame: Dict) -> Dict:
+        """
+        Runs the object detection on a frame and decodes the predictions,
+        or with tracking on frames between two detections, predicts the
+        boxes of the tracked objects.
+        """
+        images = frame['images']
+        detect = self.gate is None or self.gate_frame(frame, images)
+        if detect:
+            self.detect_frame(frame, images)
+        # Hand the batch back, its buffer is reused for later frames. If
+        # a stage fails, drop does.
+        self.buffer.release(frame.pop('images'))
+        if detect and self.gate is not None:
+            self.previous = {
+                key: frame[key] for key in GATED_KEYS if key in frame}
+        return frame
+
+    def detect_frame(self, frame: Dict, images: Any) -> None:
+        """
+        Adds the detections of the images to the frame, predicted by the
+        trackers on frames between two detections.
+        """
+        detect = self.frame_index % self.detect_every == 0
+        self.frame_index += 1
+        if detect:
+            frame['detections'] = self.batcher(
+                self.objects, images, frame['threshold'] / 100,
+                self.num_classes)
+            if self.cache is not None:
+                frame['cache_hit_ratio'] = self.cache.hit_ratio
+        if self.trackers is not None:
+            self.track(frame, detect)
+
+    def drop(self, frame: Dict) -> None:
+        """
+        Hands back the batch and overlays still held by a frame which was
+        dropped or on which a stage failed.
+        """
+        images = frame.pop('images', None)
+        if images is not None:
+            self.buffer.release(images)
+        self.overlay.release(frame.pop('overlay_generation', None))
+
+    def gate_frame(self, frame: Dict, images: Any) -> bool:
+        """
+        Decides from the novelty features whether to detect a frame, and
+        otherwise re-uses the outputs of the last detected frame.
+        """
+        with self.instrumentation.stage('model.features'):
+            if isinstance(images, np.ndarray):
+                features = self.novelty_module.extract_features(
+                    images).numpy()
+            else:
+                features = np.concatenate([
+                    self.novelty_module.extract_features(
+                        image[np.newaxis]).numpy()
+                    for image in images])
+        detect, frame['similarity'] = self.gate.update(
+            features, frame['timestamps'][-1])
+        frame['detected'] = detect
+        frame['skip_ratio'] = self.gate.skip_ratio
+        if not detect:
+            frame.update(self.previous)
+            self.instrumentation.count('skipped')
+        return detect
 
-        # Perform object detection and format output.
-        boxes, scores, classes, num_detections = self.objects(
-            images, threshold=threshold / 100)
-        boxes, scores, classes, box_count_per_batch = mask_padding(
-            boxes, scores, classes)
+    def track(self, frame: Dict, detected: bool) -> None:
+        """
+        Advances the trackers and adds the track ids and unique counts to
+        the frame.
+        """
+        per_image, track_ids = [], []
+        for i, tracker in enumerate(self.trackers):
+            dets = frame['detections'].per_image[i] if detected else None
+            dets, ids = tracker.step(dets)
+            per_image.append(dets)
+            track_ids.append(ids)
+        if not detected:
+            frame['detections'] = pack_detections(per_image, self.num_classes)
+        frame['track_ids'] = track_ids
+        # Copied, as the trackers advance while the frame is formatted.
+        frame['unique_counts'] = np.stack(
+            [tracker.unique_counts for tracker in self.trackers], axis=1)
+
+    def format(self, frame: Dict) -> Tuple[Optional[int], Dict[str, Any]]:
+        """
+        Updates the statistics and creates the output elements of a frame.
+
+        Returns:
+            Tuple[Optional[int], Dict[str, Any]]: Overlay generation of the
+                frame, to be released once written, and output elements
+        """
+        detections = frame['detections']
+        timestamps = frame['timestamps']
+        input_ts = timestamps[-1]
 
         # Prepare bounding boxes.
-        old_statistic = self.num_detections.copy()
-        image_id = 0
-        id = 0
-        Y, X = resolutions[image_id]
-        for i in range(boxes.shape[0]):
-            id += 1
-
-            # Check to which image in the batch this detection belongs.
-            if id > box_count_per_batch[image_id]:
-                image_id += 1
-                id = 0
-                Y, X = resolutions[image_id]
-
-            # Create box and label for detection.
-            xmin, ymin, xmax, ymax = np.split(boxes[i], 4, axis=-1)
-            xmin, xmax = xmin[0] * X, xmax[0] * X
-            ymin, ymax = ymin[0] * Y, ymax[0] * Y
-            c = int(classes[i])
-            bbox = get_rtmaps_bbox(
-                xmin, ymin, xmax, ymax, color=CLASS_IDS_TO_COLORS[c]
-            )
-            annotation = get_bbox_annotation(
-                xmin, ymin - 20, self.labels[c], scores[i],
-                color=CLASS_IDS_TO_COLORS[c]
-            )
-            boxes_out[image_id].data.append(bbox)
-            boxes_out[image_id].data.append(annotation)
-            self.num_detections[self.labels[c]][image_id] += 1
+        overlays = []
+        generation = None
+        if self.overlay.enabled:
+            # Held by the frame until written, or released by drop.
+            generation = frame['overlay_generation'] = self.overlay.acquire()
+            for image_id, dets in enumerate(detections.per_image):
+                labels = (self.overlay_labels(frame, image_id, dets)
+                          if self.overlay.level == 'labels' else None)
+                overlays.append(
+                    self.overlay.build(generation, image_id, dets, labels))
+
+        if self.tag_log is not None:
+            self.log_tags(frame)
 
-        num_detections = num_detections.numpy()
-        self.num_detections['total_detections'] += num_detections
+        # Update statistics.
+        stats = self.statistics
+        stats.update(detections.class_counts, input_ts)
+        car, truck = stats.class_ids['car'], stats.class_ids['truck']
 
         # Create output elements.
-        num_objects = get_ioelt(
-            input_ts, self.num_detections['total_detections'])
-        num_cars = get_ioelt(input_ts, self.num_detections['car'])
-        num_trucks = get_ioelt(input_ts, self.num_detections['truck'])
-        cur_objects = get_ioelt(input_ts, num_detections)
-        cur_cars = get_ioelt(
-            input_ts, self.num_detections['car'] - old_statistic['car'])
-        cur_trucks = get_ioelt(
-            input_ts, self.num_detections['truck'] - old_statistic['truck'])
-
-        # Write output elements.
-        for i in range(self.num_images):
-            # If there are no detections for this frame, add an empty box.
-            if len(boxes_out[i].data) == 0:
-                bbox = get_rtmaps_bbox(0., 0., 0., 0.)
-                boxes_out[i].data.append(bbox)
-            name_out = "bbox_" + str(i)
-            self.outputs[name_out].write(boxes_out[i])
-        self.outputs["total_num_objects"].write(num_objects)
-        self.outputs["total_num_cars"].write(num_cars)
-        self.outputs["total_num_trucks"].write(num_trucks)
-        self.outputs["cur_num_objects"].write(cur_objects)
-        self.outputs["cur_num_cars"].write(cur_cars)
-        self.outputs["cur_num_trucks"].write(cur_trucks)
+        outputs = {}
+        for i, overlay in enumerate(overlays):
+            outputs["bbox_" + str(i)] = get_ioelt(timestamps[i], overlay)
+        outputs["total_num_objects"] = get_ioelt(
+            input_ts, stats.totals.sum(axis=0))
+        outputs["total_num_cars"] = get_ioelt(
+            input_ts, stats.totals[car].copy())
+        outputs["total_num_trucks"] = get_ioelt(
+            input_ts, stats.totals[truck].copy())
+        outputs["cur_num_objects"] = get_ioelt(input_ts, detections.number)
+        outputs["cur_num_cars"] = get_ioelt(
+            input_ts, stats.current[car].copy())
+        outputs["cur_num_trucks"] = get_ioelt(
+            input_ts, stats.current[truck].copy())
+        outputs["total_counts"] = get_ioelt(input_ts, stats.totals.flatten())
+        outputs["cur_counts"] = get_ioelt(input_ts, stats.current.flatten())
+        outputs["rates"] = get_ioelt(input_ts, stats.rates().ravel())
+        outputs["shares"] = get_ioelt(input_ts, stats.shares().ravel())
+        if 'unique_counts' in frame:
+            unique = frame['unique_counts']
+            outputs["unique_num_objects"] = get_ioelt(
+                input_ts, unique.sum(axis=0))
+            outputs["unique_num_cars"] = get_ioelt(input_ts, unique[car])
+            outputs["unique_num_trucks"] = get_ioelt(input_ts, unique[truck])
+            outputs["unique_counts"] = get_ioelt(input_ts, unique.ravel())
+        if 'similarity' in frame:
+            outputs["similarity"] = get_ioelt(input_ts, frame['similarity'])
+            outputs["detected"] = get_ioelt(input_ts, int(frame['detected']))
+            outputs["skip_ratio"] = get_ioelt(
+                input_ts, np.float32(frame['skip_ratio']))
+        if 'cache_hit_ratio' in frame:
+            outputs["cache_hit_ratio"] = get_ioelt(
+                input_ts, np.float32(frame['cache_hit_ratio']))
+        return generation, outputs
+
+    def overlay_labels(
+        self, frame: Dict, image_id: int, dets: np.ndarray
+    ) -> List[str]:
+        """
+        Returns the annotation labels of the drawn detections of an image.
+        """
+        dets = dets[:self.overlay.max_boxes]
+        if 'track_ids' not in frame:
+            return [self.labels[c] for c in dets['class_id'].tolist()]
+        return [
+            f'{self.labels[c]} #{track_id}' for c, track_id in zip(
+                dets['class_id'].tolist(),
+                frame['track_ids'][image_id].tolist())]
+
+    def log_tags(self, frame: Dict) -> None:
+        """
+        Appends the detections and similarity ratings of every image of a
+        frame to the tag log.
+        """
+        source = self.properties["tag_log_source"].data
+        for i, (ts, dets) in enumerate(zip(
+                frame['timestamps'], frame['detections'].per_image)):
+            self.tag_log.append(
+                ts, dets,
+                similarity=(frame['similarity'][i] if 'similarity' in frame
+                            else np.nan),
+                image=i,
+                source=source,
+                track_ids=(frame['track_ids'][i] if 'track_ids' in frame
+                           else None))
+
+    def write(
+        self, formatted: Tuple[Optional[int], Dict[str, Any]]
+    ) -> None:
+        """
+        Writes the output elements of a frame and hands its overlays back,
+        as RTMaps has copied them.
+        """
+        generation, outputs = formatted
+        for name_out, ioelt in outputs.items():
+            self.outputs[name_out].write(ioelt)
+        self.overlay.release(generation)
+        if not self.startup_reported:
+            # Once, after the first inference, from the component thread.
+            self.startup_reported = True
+            print(startup_report.summary())
 
     def Death(self):
-        pass
+        if self.pipeline is not None:
+            # Write the frames which finished while draining.
+            for _, formatted in self.pipeline.stop():
+                self.write(formatted)
+        # Stop the worker processes of the models, if any.
+        for name in ('objects', 'novelty_module'):
+            module = getattr(self, name, None)
+            if hasattr(module, 'close'):
+                module.close()
+        if getattr(self, 'tag_log', None) is not None:
+            self.tag_log.close()
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.write(self.instrumentation)
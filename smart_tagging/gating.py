@@ -0,0 +1,131 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from smart_tagging.novelty_detection.utils import similarity_to_rating
+
+
+class NoveltyGate:
+    """
+    Decides on which frames the object detection runs, based on the much
+    cheaper novelty features.
+
+    A frame is detected if the similarity rating of its features to the
+    features of the last detected frame drops below threshold, or if
+    max_staleness seconds have passed since that frame. All other frames
+    can re-use the detections of the last detected frame.
+
+    Comparing against the last detected frame instead of the prior one
+    also catches slow changes, which never lower the similarity of two
+    adjacent frames much.
+
+    Args:
+        threshold (float): Similarity rating in [-1, 1] below which a
+            frame is detected
+        max_staleness (float): Seconds after which a frame is detected in
+            any case, 0 to disable
+        time_scale (float): Seconds per timestamp unit, microseconds for
+            RTMaps timestamps
+    """
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        max_staleness: float = 1.,
+        time_scale: float = 1e-6,
+    ):
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self.time_scale = time_scale
+        self.num_frames = 0
+        self.num_detected = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forgets the last detected frame, e.g. at the start of a new
+        recording, so the next frame is detected. The skip ratio keeps
+        counting.
+        """
+        self.reference: Optional[np.ndarray] = None
+        self.reference_ts = 0
+
+    @property
+    def skip_ratio(self) -> float:
+        """
+        Share of the frames on which the detection was skipped.
+        """
+        if self.num_frames == 0:
+            return 0.
+        return 1. - self.num_detected / self.num_frames
+
+    def update(
+        self, features: np.ndarray, timestamp: int
+    ) -> Tuple[bool, np.ndarray]:
+        """
+        Decides whether to detect a frame.
+
+        Args:
+            features (np.ndarray): Features of the images of the frame,
+                shape (images, features)
+            timestamp (int): Timestamp of the frame
+
+        Returns:
+            Tuple[bool, np.ndarray]: Whether to detect the frame and the
+                similarity rating of every image to the last detected
+                frame, zero if there is none
+        """
+        features = np.asarray(features, dtype=np.float32)
+        features = features.reshape(-1, features.shape[-1])
+        features = features / np.maximum(
+            np.linalg.norm(features, axis=-1, keepdims=True), 1e-12)
+        self.num_frames += 1
+
+        if (self.reference is None
+                or self.reference.shape != features.shape):
+            rating = np.zeros(features.shape[0], np.float32)
+            detect = True
+        else:
+            rating = similarity_to_rating(
+                np.sum(features * self.reference, axis=-1))
+            stale = (
+                self.max_staleness > 0
+                and (timestamp - self.reference_ts) * self.time_scale
+                >= self.max_staleness)
+            detect = bool(stale or rating.min() < self.threshold)
+
+        if detect:
+            self.num_detected += 1
+            self.reference = features
+            self.reference_ts = timestamp
+        return detect, rating
+
+    def __call__(
+        self, features: np.ndarray, timestamps: Sequence[int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decides for a sequence of single-image frames in order.
+
+        Args:
+            features (np.ndarray): Features, shape (frames, features)
+            timestamps (Sequence[int]): Timestamp of every frame
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Boolean mask of the frames to
+                detect and their similarity ratings, shape (frames,)
+        """
+        detect = np.zeros(len(timestamps), dtype=bool)
+        ratings = np.zeros(len(timestamps), np.float32)
+        for i, (feature, ts) in enumerate(zip(features, timestamps)):
+            detect[i], rating = self.update(feature, int(ts))
+            ratings[i] = rating[0]
+        return detect, ratings
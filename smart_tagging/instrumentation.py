@@ -0,0 +1,314 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import functools
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
+
+QUANTILES = (0.5, 0.95, 0.99)
+SNAPSHOT_FORMATS = ('json', 'prometheus')
+
+# Log-spaced bucket bounds in seconds, eight per factor of two from 1 us
+# to about 70 s, which bounds the quantile error to ~9 %.
+BUCKET_BOUNDS = [1e-6 * 2 ** (i / 8) for i in range(8 * 26 + 1)]
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with fixed log-spaced buckets.
+
+    Recording is a binary search and an increment, and the memory does not
+    grow with the number of samples.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        """
+        Adds a sample.
+
+        Args:
+            seconds (float): Latency in seconds
+        """
+        bucket = bisect_left(BUCKET_BOUNDS, seconds)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile as the upper bound of its bucket.
+
+        Args:
+            q (float): Quantile in [0, 1]
+
+        Returns:
+            float: Latency in seconds, 0 without samples
+        """
+        with self._lock:
+            if self.count == 0:
+                return 0.
+            rank = max(1, math.ceil(q * self.count))
+            seen = 0
+            for bucket, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    break
+            if bucket == len(BUCKET_BOUNDS):
+                return self.max
+            return min(BUCKET_BOUNDS[bucket], self.max)
+
+    def as_dict(self) -> Dict[str, float]:
+        """
+        Returns:
+            Dict[str, float]: Sample count, mean, quantiles and maximum in
+                milliseconds
+        """
+        stats = {
+            'count': self.count,
+            'mean_ms': self.sum / self.count * 1000 if self.count else 0.,
+        }
+        for q in QUANTILES:
+            stats[f'p{round(q * 100)}_ms'] = self.quantile(q) * 1000
+        stats['max_ms'] = self.max * 1000
+        return stats
+
+
+class Instrumentation:
+    """
+    Per-stage latency histograms and counters of a block or model.
+
+    When disabled, `stage` returns a shared no-op context manager and
+    `count` returns immediately, so instrumented code runs at full speed.
+
+    Args:
+        name (str): Name of the instrumented component, e.g. the block
+        enabled (bool): Record latencies and counters
+    """
+    def __init__(self, name: str = '', enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self.stages: Dict[str, LatencyHistogram] = OrderedDict()
+        self.counters: Dict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """
+        Times the enclosed block as one sample of a stage.
+
+        Args:
+            name (str): Stage name, e.g. 'inference'
+        """
+        if not self.enabled:
+            return _DISABLED
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        """
+        Times every call of a function as one sample of a stage.
+
+        Args:
+            name (str): Stage name
+            fn (Callable): Function, e.g. a pipeline stage
+
+        Returns:
+            Callable: Timed function, or fn itself if disabled
+        """
+        if not self.enabled:
+            return fn
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return timed
+
+    def record(self, name: str, seconds: float) -> None:
+        """
+        Adds a latency sample to a stage.
+
+        Args:
+            name (str): Stage name
+            seconds (float): Latency in seconds
+        """
+        if not self.enabled:
+            return
+        histogram = self.stages.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(name, LatencyHistogram())
+        histogram.record(seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """
+        Increments a counter, e.g. of processed or dropped frames.
+
+        Args:
+            name (str): Counter name
+            n (int): Increment
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def quantiles(self, name: str) -> List[float]:
+        """
+        Args:
+            name (str): Stage name
+
+        Returns:
+            List[float]: QUANTILES of the stage latency in milliseconds,
+                zeros if the stage was not recorded yet
+        """
+        histogram = self.stages.get(name)
+        if histogram is None:
+            return [0.] * len(QUANTILES)
+        return [histogram.quantile(q) * 1000 for q in QUANTILES]
+
+    def snapshot(self) -> Dict:
+        """
+        Returns:
+            Dict: Latency statistics per stage and counters
+        """
+        with self._lock:
+            stages = list(self.stages.items())
+            counters = dict(self.counters)
+        return {
+            'name': self.name,
+            'stages': {name: h.as_dict() for name, h in stages},
+            'counters': counters,
+        }
+
+
+class _NullContext:
+    # contextlib.nullcontext requires Python >= 3.7.
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+_DISABLED = _NullContext()
+
+# Shared disabled instance, the default of the model classes.
+DISABLED = Instrumentation(enabled=False)
+
+
+def to_prometheus(snapshots: List[Dict]) -> str:
+    """
+    Formats snapshots in the Prometheus text exposition format.
+
+    Args:
+        snapshots (List[Dict]): Results of Instrumentation.snapshot
+
+    Returns:
+        str: Latencies as summaries in seconds, counters as counters
+    """
+    lines = ['# TYPE smart_tagging_stage_latency_seconds summary']
+    counters: Dict[str, List[str]] = OrderedDict()
+    for snapshot in snapshots:
+        component = snapshot['name']
+        for stage, stats in snapshot['stages'].items():
+            labels = f'component="{component}",stage="{stage}"'
+            for q in QUANTILES:
+                value = stats[f'p{round(q * 100)}_ms'] / 1000
+                lines.append(
+                    f'smart_tagging_stage_latency_seconds'
+                    f'{{{labels},quantile="{q}"}} {value:.9g}')
+            lines.append(
+                f'smart_tagging_stage_latency_seconds_sum{{{labels}}} '
+                f'{stats["mean_ms"] * stats["count"] / 1000:.9g}')
+            lines.append(
+                f'smart_tagging_stage_latency_seconds_count{{{labels}}} '
+                f'{stats["count"]}')
+        for counter, value in snapshot['counters'].items():
+            counters.setdefault(counter, []).append(
+                f'smart_tagging_{counter}_total'
+                f'{{component="{component}"}} {value}')
+    for counter, samples in counters.items():
+        lines.append(f'# TYPE smart_tagging_{counter}_total counter')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter:
+    """
+    Writes snapshots of several components to a local file, which is
+    replaced atomically, so it can be scraped at any time. The blocks write
+    one every "metrics_interval" seconds.
+
+    Args:
+        path (str/Path): Output file
+        fmt (str): One of SNAPSHOT_FORMATS, by default 'json' for .json
+            files and 'prometheus' otherwise
+    """
+    def __init__(
+        self,
+        path: Union[str, Path],
+        fmt: Optional[str] = None,
+    ):
+        self.path = Path(path)
+        self.fmt = fmt or (
+            'json' if self.path.suffix.lower() == '.json' else 'prometheus')
+        if self.fmt not in SNAPSHOT_FORMATS:
+            raise ValueError(
+                f'Unknown snapshot format {self.fmt!r}, '
+                f'expected one of {SNAPSHOT_FORMATS}')
+
+    def write(self, *components: Instrumentation) -> None:
+        """
+        Writes a snapshot of the components.
+        """
+        snapshots = [c.snapshot() for c in components if c.enabled]
+        if self.fmt == 'json':
+            text = json.dumps(
+                {'time': time.time(), 'components': snapshots}, indent=2)
+        else:
+            text = to_prometheus(snapshots)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(text)
+        os.replace(tmp, self.path)
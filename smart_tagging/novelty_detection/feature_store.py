@@ -0,0 +1,177 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+def content_key(image: np.ndarray) -> int:
+    """
+    Computes a 63 bit key from the content of an image.
+
+    Args:
+        image (np.ndarray): Image
+
+    Returns:
+        int: Key
+    """
+    digest = hashlib.blake2b(
+        np.ascontiguousarray(image).data, digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+def store_name(
+    recording: str,
+    model_path: Union[str, Path],
+    precision: str = 'float32',
+    backend: Optional[str] = None,
+) -> str:
+    """
+    Computes the name of the feature store of a recording from the
+    recording and the model settings which change the features, so runs
+    with another model, precision or backend do not share features.
+
+    Args:
+        recording (str): Resolved path or unique id of the recording
+        model_path (str/Path): Path of the novelty model
+        precision (str): Precision of the model
+        backend (str): Inference backend, None for the default
+
+    Returns:
+        str: Name of the store, readable prefix and hash
+    """
+    settings = '|'.join((
+        str(recording), str(Path(model_path).resolve()), precision,
+        str(backend)))
+    digest = hashlib.blake2b(settings.encode(), digest_size=8).hexdigest()
+    return f'{Path(recording).name}-{digest}'
+
+
+class FeatureStore:
+    """
+    Append-only on-disk store of the feature vectors of one recording.
+
+    Features are kept in a raw float32 file which is read through a memory
+    map, the int64 keys (timestamps or content keys) in a separate index
+    file in the same row order. A small JSON header holds the feature size.
+
+    Args:
+        root (str/Path): Directory of the store
+        recording_id (str): Name of the store, see store_name
+    """
+    def __init__(self, root: Union[str, Path], recording_id: str):
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        self.features_path = root / f'{recording_id}.f32'
+        self.index_path = root / f'{recording_id}.idx'
+        self.header_path = root / f'{recording_id}.json'
+
+        self.dim = None
+        if self.header_path.exists():
+            with self.header_path.open('r') as f:
+                self.dim = json.load(f)['dim']
+        keys = (np.fromfile(self.index_path, dtype=np.int64)
+                if self.index_path.exists() else np.zeros(0, np.int64))
+        self.rows = {int(key): row for row, key in enumerate(keys)}
+        self.num_rows = keys.shape[0]
+        self._features = None
+
+        # Drop features that were written without their key and partially
+        # written keys, e.g. after a crash, so the next append stays
+        # aligned.
+        sizes = [(self.index_path, self.num_rows * 8)]
+        if self.dim is not None:
+            sizes.append((self.features_path, self.num_rows * self.dim * 4))
+        for path, size in sizes:
+            if path.exists() and path.stat().st_size > size:
+                with path.open('r+b') as f:
+                    f.truncate(size)
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __contains__(self, key: int) -> bool:
+        return int(key) in self.rows
+
+    @property
+    def features(self) -> np.ndarray:
+        """
+        Memory map of all stored features, shape (rows, dim).
+        """
+        if self.num_rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        if self._features is None or len(self._features) != self.num_rows:
+            self._features = np.memmap(
+                self.features_path, dtype=np.float32, mode='r',
+                shape=(self.num_rows, self.dim))
+        return self._features
+
+    @property
+    def keys(self) -> np.ndarray:
+        """
+        Keys of all stored features in row order.
+        """
+        return np.fromfile(self.index_path, dtype=np.int64)[:self.num_rows]
+
+    def get(self, keys: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up the features of several keys.
+
+        Args:
+            keys (Sequence[int]): Keys
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Features of the hits, shape
+                (hits, dim), and the boolean hit mask, shape (keys,)
+        """
+        rows = [self.rows.get(int(key), -1) for key in keys]
+        rows = np.asarray(rows, dtype=np.int64)
+        hits = rows >= 0
+        if not hits.any():
+            return np.zeros((0, self.dim or 0), dtype=np.float32), hits
+        return np.asarray(self.features[rows[hits]]), hits
+
+    def put(self, keys: Sequence[int], features: np.ndarray) -> None:
+        """
+        Appends features. Keys which are already stored are skipped.
+
+        Args:
+            keys (Sequence[int]): Keys
+            features (np.ndarray): Features, shape (keys, dim)
+        """
+        features = np.asarray(features, dtype=np.float32)
+        features = features.reshape(features.shape[0], -1)
+        if self.dim is None:
+            self.dim = features.shape[1]
+            with self.header_path.open('w') as f:
+                json.dump({'dim': self.dim, 'dtype': 'float32'}, f)
+        elif features.shape[1] != self.dim:
+            raise ValueError(
+                f'Feature size {features.shape[1]} does not match the '
+                f'store ({self.dim})')
+
+        new = []
+        for i, key in enumerate(keys):
+            key = int(key)
+            if key not in self.rows:
+                self.rows[key] = self.num_rows + len(new)
+                new.append(i)
+        if not new:
+            return
+        with self.features_path.open('ab') as f:
+            f.write(np.ascontiguousarray(features[new]).tobytes())
+        with self.index_path.open('ab') as f:
+            f.write(np.asarray(keys, dtype=np.int64)[new].tobytes())
+        self.num_rows += len(new)
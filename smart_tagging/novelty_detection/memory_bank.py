@@ -0,0 +1,185 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+POLICIES = ('ring', 'reservoir')
+
+
+class MemoryBank:
+    """
+    Fixed-size bank of L2-normalized feature vectors of past frames.
+
+    A frame is scored against the whole bank with a single matrix-vector
+    product. With the 'ring' policy the oldest feature is overwritten,
+    with 'reservoir' the bank holds a uniform sample of all inserted
+    features. If `keyframe_threshold` is set, only frames whose similarity
+    drops below it are inserted, so the bank holds keyframes.
+
+    Args:
+        capacity (int): Number of stored features
+        top_k (int): Number of most similar features that are averaged
+        policy (str): 'ring' or 'reservoir'
+        keyframe_threshold (float): Insert only frames below this similarity
+        seed (int): Seed of the reservoir sampling
+    """
+    def __init__(
+        self,
+        capacity: int = 256,
+        top_k: int = 1,
+        policy: str = 'ring',
+        keyframe_threshold: Optional[float] = None,
+        seed: Optional[int] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(
+                f'Unknown policy {policy!r}, expected one of {POLICIES}')
+        self.capacity = max(1, capacity)
+        self.top_k = max(1, top_k)
+        self.policy = policy
+        self.keyframe_threshold = keyframe_threshold
+        self.rng = np.random.default_rng(seed)
+        self.features = None
+        self.size = 0
+        self.position = 0
+        self.num_seen = 0
+
+    def _normalize(self, feature: np.ndarray) -> np.ndarray:
+        feature = np.asarray(feature, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(feature)
+        return feature / norm if norm > 0 else feature
+
+    def score(self, feature: np.ndarray) -> float:
+        """
+        Computes the similarity of a feature to the bank.
+
+        Args:
+            feature (np.ndarray): Feature vector
+
+        Returns:
+            float: Mean cosine similarity of the top-k most similar features,
+                0 if the bank is empty
+        """
+        if self.size == 0:
+            return 0.
+        sims = self.features[:self.size] @ self._normalize(feature)
+        k = min(self.top_k, self.size)
+        if k == 1:
+            return float(sims.max())
+        return float(np.partition(sims, self.size - k)[-k:].mean())
+
+    def insert(self, feature: np.ndarray) -> None:
+        """
+        Inserts a feature in O(1).
+
+        Args:
+            feature (np.ndarray): Feature vector
+        """
+        feature = self._normalize(feature)
+        if self.features is None:
+            self.features = np.zeros(
+                (self.capacity, feature.shape[0]), dtype=np.float32)
+        self.num_seen += 1
+        if self.size < self.capacity:
+            index = self.size
+            self.size += 1
+        elif self.policy == 'ring':
+            index = self.position
+        else:
+            index = self.rng.integers(self.num_seen)
+            if index >= self.capacity:
+                return
+        self.features[index] = feature
+        self.position = (index + 1) % self.capacity
+
+    def update(self, feature: np.ndarray) -> float:
+        """
+        Scores a feature and inserts it afterwards.
+
+        Args:
+            feature (np.ndarray): Feature vector
+
+        Returns:
+            float: Similarity to the bank before insertion
+        """
+        sim = self.score(feature)
+        if (self.size == 0 or self.keyframe_threshold is None
+                or sim < self.keyframe_threshold):
+            self.insert(feature)
+        return sim
+
+    def reset(self) -> None:
+        """
+        Removes all features.
+        """
+        self.size = 0
+        self.position = 0
+        self.num_seen = 0
+
+    def save(self, path: Union[str, Path]) -> None:
+        """
+        Exports the bank, e.g. to resume a run or to share it between
+        recordings.
+
+        Args:
+            path (str/Path): .npz file
+        """
+        features = (self.features[:self.size] if self.features is not None
+                    else np.zeros((0, 0), dtype=np.float32))
+        with Path(path).open('wb') as f:
+            np.savez(
+                f,
+                features=features,
+                capacity=self.capacity,
+                top_k=self.top_k,
+                policy=self.policy,
+                position=self.position,
+                num_seen=self.num_seen,
+                keyframe_threshold=(
+                    np.nan if self.keyframe_threshold is None
+                    else self.keyframe_threshold),
+            )
+
+    @classmethod
+    def load(
+        cls, path: Union[str, Path], seed: Optional[int] = None
+    ) -> 'MemoryBank':
+        """
+        Loads an exported bank.
+
+        Args:
+            path (str/Path): .npz file
+            seed (int): Seed of the reservoir sampling
+
+        Returns:
+            MemoryBank: Bank with the exported features and settings
+        """
+        with np.load(path) as data:
+            threshold = float(data['keyframe_threshold'])
+            bank = cls(
+                capacity=int(data['capacity']),
+                top_k=int(data['top_k']),
+                policy=str(data['policy']),
+                keyframe_threshold=None if np.isnan(threshold) else threshold,
+                seed=seed,
+            )
+            features = data['features']
+            bank.position = int(data['position'])
+            bank.num_seen = int(data['num_seen'])
+        bank.size = features.shape[0]
+        if bank.size:
+            bank.features = np.zeros(
+                (bank.capacity, features.shape[1]), dtype=np.float32)
+            bank.features[:bank.size] = features
+        return bank
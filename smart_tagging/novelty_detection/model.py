@@ -9,25 +9,89 @@
 # governing permissions and limitations under the License.
 
 
+from itertools import islice
 from pathlib import Path
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
 
-from smart_tagging.utils import load_exported_model
+from smart_tagging.novelty_detection.feature_store import (
+    FeatureStore,
+    content_key,
+)
+from smart_tagging.novelty_detection.memory_bank import MemoryBank
+from smart_tagging.backends import TFLiteBackend, load_backend
+from smart_tagging.engine import ShardedEngine
+from smart_tagging.instrumentation import DISABLED, Instrumentation
+from smart_tagging.profiles import ExecutionProfile, apply_profile, pinned
+from smart_tagging.startup import startup_report
 
 
 class PairwiseFilter:
     """
     Compute pairwise similarity of two sequencial images.
+
+    If a memory bank is given, each image is compared to the features of
+    many past frames instead of the prior one only. If a feature store is
+    given, features are read from it where available and written to it
+    otherwise.
+
+    backend selects the inference runtime, see smart_tagging.backends. It
+    defaults to the backend declared in init.json or the saved model. A
+    precision other than float32 selects the float16 / int8 TFLite variants
+    created by smart_tagging.quantize.
+
+    If an Instrumentation is given, feature extraction and scoring are
+    recorded as stages 'model.features' and 'model.scoring'.
+
+    An ExecutionProfile sets the thread counts and CPU affinity of the
+    model, see smart_tagging.profiles.
     """
 
     def __init__(
         self,
-        model_path: Path
+        model_path: Path,
+        memory_bank: Optional[MemoryBank] = None,
+        feature_store: Optional[FeatureStore] = None,
+        precision: str = 'float32',
+        backend: Optional[str] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        profile: Optional[ExecutionProfile] = None,
     ):
-        self.model, self.config = load_exported_model(model_path)
-        self.serve_fn = self.model.signatures["features"]
+        self.precision = precision
+        self.buffer = None
+        self.memory_bank = memory_bank
+        self.feature_store = feature_store
+        self.instrumentation = instrumentation or DISABLED
+        self._first_call = True
+        self._load(model_path, precision, backend, profile)
+
+    def _load(
+        self,
+        model_path: Path,
+        precision: str,
+        backend: Optional[str],
+        profile: Optional[ExecutionProfile],
+    ) -> None:
+        """
+        Loads the model, sets serve_fn, model, config and profile.
+        """
+        options = {}
+        if precision != 'float32':
+            backend = backend or TFLiteBackend.name
+            options['precision'] = precision
+        self.profile = profile or ExecutionProfile()
+        options.update(apply_profile(self.profile, model_path))
+        with pinned(self.profile.cpus):
+            self.serve_fn, self.config = load_backend(
+                model_path, "features", ("feature",), backend, **options)
+        self.model = getattr(self.serve_fn, 'model', None)
+
+    def reset(self) -> None:
+        """
+        Forgets the prior image, e.g. at the start of a new recording.
+        """
         self.buffer = None
 
     def cosine_similarity(
@@ -47,24 +111,210 @@ class PairwiseFilter:
             axis=-1
         )
 
-    def __call__(self, x: np.ndarray) -> tf.Tensor:
+    def extract_features(
+        self, x: np.ndarray, keys: Optional[Sequence[int]] = None
+    ) -> tf.Tensor:
+        """
+        Computes the feature vectors of a batch of images.
+
+        Args:
+            x (np.ndarray): Input images, shape (batch, height, width, 3)
+            keys (Sequence[int]): Feature store keys of the images, e.g.
+                timestamps. Content keys are used if omitted.
+
+        Returns:
+            tf.Tensor: Features, shape (batch, features)
+        """
+        if self.feature_store is None:
+            return self._infer(x)
+
+        if keys is None:
+            keys = [content_key(image) for image in x]
+        cached, hits = self.feature_store.get(keys)
+        if hits.all():
+            return tf.constant(cached)
+        misses = np.flatnonzero(~hits)
+        computed = self._infer(x[misses]).numpy()
+        self.feature_store.put([keys[i] for i in misses], computed)
+        features = np.empty((len(keys), computed.shape[1]), np.float32)
+        features[hits] = cached
+        features[misses] = computed
+        return tf.constant(features)
+
+    def warm_up(self, shape: Tuple[int, ...]) -> None:
+        """
+        Runs the model once without touching the prior image, the memory
+        bank or the feature store.
+
+        Args:
+            shape (Tuple[int, ...]): Input shape (batch, height, width, 3)
+        """
+        self._first_call = False
+        with startup_report.timed('warmup', 'novelty_detection'):
+            self._infer(np.zeros(shape, dtype=np.uint8))
+        self._first_call = True
+
+    def _infer(self, x: np.ndarray) -> tf.Tensor:
+        h = tf.cast(x, tf.float32) / 255.
+        if self._first_call:
+            self._first_call = False
+            with startup_report.timed('first_inference', 'novelty_detection'):
+                return self.serve_fn(image=h)['feature']
+        return self.serve_fn(image=h)['feature']
+
+    def __call__(
+        self, x: np.ndarray, key: Optional[int] = None
+    ) -> tf.Tensor:
         """
         Computes similarity of the prior an current image.
 
         Args:
             x (tf.Tensor): Input image
+            key (int): Feature store key of the image
 
         Returns:
             tf.Tensor: Similarity
         """
-        h = tf.cast(tf.expand_dims(x, axis=0), tf.float32) / 255.
+        return self.batch(
+            x[np.newaxis], keys=None if key is None else [key])
+
+    def batch(
+        self,
+        frames: Union[np.ndarray, Iterable[np.ndarray]],
+        batch_size: int = 8,
+        keys: Optional[Iterable[int]] = None,
+    ) -> tf.Tensor:
+        """
+        Computes the similarity of a sequence of images to their prior
+        images.
+
+        Features are extracted batch_size images at a time and all
+        adjacent-frame similarities of a batch are computed at once. The
+        result equals calling the filter on every image in order: the last
+        feature is carried over to the next call and the very first image
+        gets a similarity of zero.
+
+        Args:
+            frames (np.ndarray/Iterable): Stack or iterator of images
+            batch_size (int): Number of images per model call
+            keys (Iterable[int]): Feature store keys of the images
+
+        Returns:
+            tf.Tensor: Similarities, shape (frames,)
+        """
+        keys = None if keys is None else iter(keys)
+        sims = [tf.zeros((0,))]
+        for images in _batches(frames, batch_size):
+            batch_keys = (None if keys is None
+                          else list(islice(keys, images.shape[0])))
+            with self.instrumentation.stage('model.features'):
+                features = self.extract_features(images, batch_keys)
+            with self.instrumentation.stage('model.scoring'):
+                sims.append(self.score_features(features))
+        return tf.concat(sims, axis=0)
+
+    def score_features(
+        self, features: Union[tf.Tensor, np.ndarray]
+    ) -> tf.Tensor:
+        """
+        Computes the similarities of a sequence of feature vectors, e.g.
+        to re-score a recording from a feature store without inference.
+
+        Args:
+            features (tf.Tensor/np.ndarray): Features, shape
+                (frames, features)
+
+        Returns:
+            tf.Tensor: Similarities, shape (frames,)
+        """
+        features = tf.convert_to_tensor(features, dtype=tf.float32)
+        if features.shape[0] == 0:
+            return tf.zeros((0,))
+
+        if self.memory_bank is not None:
+            return tf.constant([
+                self.memory_bank.update(f)
+                for f in features.numpy()], dtype=tf.float32)
 
         if self.buffer is None:
-            features = self.serve_fn(image=h)
-            self.buffer = features['feature']
-            return tf.zeros((1,))
+            sim = self.cosine_similarity(features[1:], features[:-1])
+            sim = tf.concat([tf.zeros((1,)), sim], axis=0)
         else:
-            features = self.serve_fn(image=h)['feature']
-            sim = self.cosine_similarity(features, self.buffer)
-            self.buffer = features
-            return sim
+            prior = tf.concat([self.buffer, features[:-1]], axis=0)
+            sim = self.cosine_similarity(features, prior)
+        self.buffer = features[-1:]
+        return sim
+
+
+class ShardedPairwiseFilter(PairwiseFilter):
+    """
+    PairwiseFilter which extracts the features on a pool of worker
+    processes, see smart_tagging.engine.ShardedEngine. Scoring, the memory
+    bank and the feature store stay in the calling process.
+    """
+    def __init__(
+        self,
+        model_path: Path,
+        memory_bank: Optional[MemoryBank] = None,
+        feature_store: Optional[FeatureStore] = None,
+        precision: str = 'float32',
+        backend: Optional[str] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        num_workers: int = 2,
+        threads_per_worker: Optional[int] = None,
+        profile: Optional[ExecutionProfile] = None,
+        **engine_options,
+    ):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.engine_options = engine_options
+        super().__init__(
+            model_path, memory_bank, feature_store, precision, backend,
+            instrumentation, profile)
+
+    def _load(
+        self,
+        model_path: Path,
+        precision: str,
+        backend: Optional[str],
+        profile: Optional[ExecutionProfile],
+    ) -> None:
+        self.engine = ShardedEngine(
+            'novelty_detection', model_path,
+            {'precision': precision, 'backend': backend},
+            self.num_workers, self.threads_per_worker, profile=profile,
+            **self.engine_options)
+        self.profile = self.engine.profile
+        self.serve_fn = None
+        self.config = self.engine.config
+        self.model = None
+        # The workers time their first inference.
+        self._first_call = False
+
+    def warm_up(self, shape: Tuple[int, ...]) -> None:
+        self.engine.warm_up(shape)
+
+    def _infer(self, x: np.ndarray) -> tf.Tensor:
+        return tf.constant(self.engine.run(x)[0])
+
+    def close(self) -> None:
+        """
+        Stops the worker processes.
+        """
+        self.engine.close()
+
+
+def _batches(
+    frames: Union[np.ndarray, Iterable[np.ndarray]], batch_size: int
+) -> Iterator[np.ndarray]:
+    batch_size = max(1, batch_size)
+    if isinstance(frames, np.ndarray):
+        for i in range(0, frames.shape[0], batch_size):
+            yield frames[i:i + batch_size]
+        return
+    frames = iter(frames)
+    while True:
+        images = list(islice(frames, batch_size))
+        if not images:
+            return
+        yield np.stack(images, axis=0)
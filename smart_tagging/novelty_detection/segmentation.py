@@ -0,0 +1,186 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import math
+from typing import List, NamedTuple, Optional, Sequence
+
+
+class SegmentEvent(NamedTuple):
+    """
+    Event of the StreamingSegmenter.
+
+    Attributes:
+        kind (str): 'boundary' if a segment starts at this frame,
+            'keyframe' if the frame represents its segment
+        timestamp (int): Timestamp of the frame
+        segment (int): Index of the segment of the frame
+        num_frames (int): For a boundary, the number of frames of the
+            segment which ended, 0 for the first segment
+    """
+    kind: str
+    timestamp: int
+    segment: int
+    num_frames: int = 0
+
+
+class StreamingSegmenter:
+    """
+    Splits a stream of novelty similarity ratings into scene segments and
+    picks keyframes, in constant time and memory per frame.
+
+    Changes are detected by a leaky CUSUM of the novelty 1 - rating above
+    its running baseline: the statistic accumulates novelty exceeding the
+    baseline by more than drift, so a hard cut triggers at once and a
+    steady pan after a few frames, and leaks by the factor leak per frame.
+    With hysteresis, a boundary is emitted when the statistic rises above
+    high, and no further boundary until it has fallen below low again. A
+    boundary less than min_length seconds after the last one is
+    suppressed.
+
+    The first frame of a segment on which the statistic is below low,
+    i.e. the scene has settled, is its keyframe. In long segments, a
+    further keyframe is emitted every keyframe_interval seconds.
+
+    Args:
+        high (float): Statistic above which a boundary is emitted
+        low (float): Statistic below which the next boundary is armed
+        drift (float): Novelty above the baseline which is tolerated
+        leak (float): Factor of the statistic per frame in (0, 1]
+        min_length (float): Minimum segment length in seconds
+        keyframe_interval (float): Seconds between keyframes of a segment,
+            0 for one keyframe per segment
+        baseline_rate (float): Weight of a frame in the running baseline
+        time_scale (float): Seconds per timestamp unit, microseconds for
+            RTMaps timestamps
+    """
+    def __init__(
+        self,
+        high: float = 0.3,
+        low: float = 0.1,
+        drift: float = 0.02,
+        leak: float = 0.9,
+        min_length: float = 1.,
+        keyframe_interval: float = 0.,
+        baseline_rate: float = 0.02,
+        time_scale: float = 1e-6,
+    ):
+        if not 0 <= low < high:
+            raise ValueError(
+                f'Expected 0 <= low < high, got low={low}, high={high}')
+        self.high = high
+        self.low = low
+        self.drift = drift
+        self.leak = leak
+        self.min_length = min_length
+        self.keyframe_interval = keyframe_interval
+        self.baseline_rate = baseline_rate
+        self.time_scale = time_scale
+        self.num_frames = 0
+        self.num_keyframes = 0
+        self.num_segments = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Starts a new stream, e.g. a new recording. The next frame starts
+        a segment. The counters keep counting.
+        """
+        self.statistic = 0.
+        self.baseline: Optional[float] = None
+        self.armed = True
+        self.segment = -1
+        self.segment_start = 0
+        self.segment_frames = 0
+        self.keyframe_ts: Optional[int] = None
+        self.first = True
+
+    @property
+    def data_reduction(self) -> float:
+        """
+        Share of the frames which are not keyframes.
+        """
+        if self.num_frames == 0:
+            return 0.
+        return 1. - self.num_keyframes / self.num_frames
+
+    def _boundary(self, timestamp: int) -> SegmentEvent:
+        event = SegmentEvent(
+            'boundary', timestamp, self.segment + 1, self.segment_frames)
+        self.segment += 1
+        self.num_segments += 1
+        self.segment_start = timestamp
+        self.segment_frames = 0
+        self.keyframe_ts = None
+        return event
+
+    def update(self, rating: float, timestamp: int) -> List[SegmentEvent]:
+        """
+        Processes the similarity rating of the next frame.
+
+        Args:
+            rating (float): Similarity rating in [-1, 1] to the prior
+                frame, ignored for the first frame of a stream
+            timestamp (int): Timestamp of the frame
+
+        Returns:
+            List[SegmentEvent]: Events of the frame, in order
+        """
+        self.num_frames += 1
+        events = []
+        if self.first:
+            self.first = False
+            events.append(self._boundary(timestamp))
+        elif not math.isnan(rating):
+            novelty = 1. - rating
+            if self.baseline is None:
+                self.baseline = novelty
+            self.statistic = max(0., self.leak * self.statistic + novelty
+                                 - self.baseline - self.drift)
+            if self.armed and self.statistic > self.high:
+                self.armed = False
+                long_enough = (
+                    (timestamp - self.segment_start) * self.time_scale
+                    >= self.min_length)
+                if long_enough:
+                    events.append(self._boundary(timestamp))
+            elif self.statistic < self.low:
+                self.armed = True
+            # Sustained novelty, e.g. of a long pan, becomes the new
+            # baseline, so the next boundary gets armed again.
+            self.baseline += self.baseline_rate * (novelty - self.baseline)
+        self.segment_frames += 1
+
+        if self.armed and (
+                self.keyframe_ts is None
+                or self.keyframe_interval > 0
+                and (timestamp - self.keyframe_ts) * self.time_scale
+                >= self.keyframe_interval):
+            self.keyframe_ts = timestamp
+            self.num_keyframes += 1
+            events.append(SegmentEvent('keyframe', timestamp, self.segment))
+        return events
+
+    def __call__(
+        self, ratings: Sequence[float], timestamps: Sequence[int]
+    ) -> List[SegmentEvent]:
+        """
+        Processes a sequence of frames in order, e.g. offline.
+
+        Args:
+            ratings (Sequence[float]): Similarity rating of every frame
+            timestamps (Sequence[int]): Timestamp of every frame
+
+        Returns:
+            List[SegmentEvent]: Events of all frames, in order
+        """
+        events = []
+        for rating, ts in zip(ratings, timestamps):
+            events.extend(self.update(float(rating), int(ts)))
+        return events
@@ -0,0 +1,27 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import numpy as np
+
+
+def similarity_to_rating(sim: np.ndarray) -> np.ndarray:
+    """
+    Maps the cosine similarity to the angular rating in [-1, 1], which is
+    reported by the novelty detection block.
+
+    Args:
+        sim (np.ndarray): Cosine similarity
+
+    Returns:
+        np.ndarray: Similarity rating
+    """
+    sim = np.clip(sim, -1., 1.)
+    sim = 1. - np.arccos(sim) / np.pi * 2
+    return sim.astype(np.float32)
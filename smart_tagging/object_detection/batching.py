@@ -0,0 +1,203 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from collections import OrderedDict
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from smart_tagging.object_detection.utils import (
+    Detections,
+    decode_detections,
+)
+from smart_tagging.startup import lazy_import
+
+tf = lazy_import('tensorflow')
+
+STRATEGIES = ('stack', 'group', 'letterbox')
+
+
+class Letterbox(NamedTuple):
+    """
+    Placement of an image inside the letterbox canvas.
+
+    Attributes:
+        scale (float): Resize factor of the image
+        pad_x (int): Left padding in pixels
+        pad_y (int): Top padding in pixels
+        height (int): Original height
+        width (int): Original width
+    """
+    scale: float
+    pad_x: int
+    pad_y: int
+    height: int
+    width: int
+
+
+def letterbox(
+    images: Sequence[np.ndarray], size: Tuple[int, int]
+) -> Tuple[np.ndarray, List[Letterbox]]:
+    """
+    Resizes images of any resolution into a common canvas, keeping their
+    aspect ratio and centering them on a black background.
+
+    Args:
+        images (Sequence[np.ndarray]): uint8 images
+        size (Tuple[int, int]): (height, width) of the canvas
+
+    Returns:
+        Tuple[np.ndarray, List[Letterbox]]: Batch, shape
+            (images, height, width, 3), and the placement of every image
+    """
+    height, width = size
+    batch = np.zeros((len(images), height, width, 3), dtype=np.uint8)
+    placements = []
+    for i, image in enumerate(images):
+        h, w = image.shape[:2]
+        scale = min(height / h, width / w)
+        new_h, new_w = int(round(h * scale)), int(round(w * scale))
+        if (new_h, new_w) != (h, w):
+            image = tf.image.resize(
+                image, (new_h, new_w), antialias=scale < 1.)
+            image = tf.cast(tf.round(image), tf.uint8).numpy()
+        pad_y, pad_x = (height - new_h) // 2, (width - new_w) // 2
+        batch[i, pad_y:pad_y + new_h, pad_x:pad_x + new_w] = image
+        placements.append(Letterbox(scale, pad_x, pad_y, h, w))
+    return batch, placements
+
+
+def unletterbox(detections: np.ndarray, placement: Letterbox) -> np.ndarray:
+    """
+    Maps detections from canvas pixels back to the original image.
+
+    Args:
+        detections (np.ndarray): DETECTION_DTYPE array in canvas pixels
+        placement (Letterbox): Placement of the image
+
+    Returns:
+        np.ndarray: DETECTION_DTYPE array in original image pixels
+    """
+    detections = detections.copy()
+    for name, pad, limit in (
+        ('xmin', placement.pad_x, placement.width),
+        ('xmax', placement.pad_x, placement.width),
+        ('ymin', placement.pad_y, placement.height),
+        ('ymax', placement.pad_y, placement.height),
+    ):
+        detections[name] = np.clip(
+            (detections[name] - pad) / placement.scale, 0, limit)
+    return detections
+
+
+def merge_detections(
+    parts: Sequence[Tuple[Sequence[int], Detections]], num_images: int
+) -> Detections:
+    """
+    Merges the detections of several model calls in input order.
+
+    Args:
+        parts (Sequence): (indices of the images in the input, Detections)
+        num_images (int): Number of input images
+
+    Returns:
+        Detections: Detections of all images
+    """
+    per_image: List[Optional[np.ndarray]] = [None] * num_images
+    class_counts, number = None, np.zeros(num_images, dtype=np.int32)
+    for indices, detections in parts:
+        if class_counts is None:
+            class_counts = np.zeros(
+                (num_images, detections.class_counts.shape[1]), np.int64)
+        indices = np.asarray(indices)
+        class_counts[indices] = detections.class_counts
+        number[indices] = detections.number
+        for i, dets in zip(indices, detections.per_image):
+            per_image[i] = dets
+    return Detections(per_image, class_counts, number)
+
+
+class MixedResolutionBatcher:
+    """
+    Runs the object detection on images of different resolutions and maps
+    all boxes back to the pixel coordinates of their original image.
+
+    Strategies:
+        stack: all images share one resolution, one model call
+        group: one model call per distinct resolution
+        letterbox: all images are letterboxed into a common canvas, one
+            model call. The canvas defaults to the largest height and width
+            of the inputs, so no image is downscaled.
+
+    Args:
+        strategy (str): One of STRATEGIES
+        size (Tuple[int, int]): (height, width) of the letterbox canvas
+    """
+    def __init__(
+        self, strategy: str = 'group', size: Optional[Tuple[int, int]] = None
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError(
+                f'Unknown strategy {strategy!r}, '
+                f'expected one of {STRATEGIES}')
+        self.strategy = strategy
+        self.size = size
+
+    def __call__(
+        self,
+        model: Callable,
+        images: Sequence[np.ndarray],
+        threshold: float,
+        num_classes: int,
+    ) -> Detections:
+        """
+        Args:
+            model (Callable): ObjectDetection or compatible
+            images (Sequence[np.ndarray]): uint8 images, or a batch of
+                images of one resolution which is passed on without copy
+            threshold (float): Score threshold of the NMS surpression
+            num_classes (int): Number of classes known to the model
+
+        Returns:
+            Detections: Detections in original image pixels
+        """
+        resolutions = [image.shape[:2] for image in images]
+        if self.strategy == 'letterbox':
+            size = self.size or tuple(
+                int(d) for d in np.max(resolutions, axis=0))
+            batch, placements = letterbox(images, size)
+            detections = decode_detections(
+                *model(batch, threshold=threshold),
+                [size] * len(images), num_classes)
+            per_image = [
+                unletterbox(dets, placement)
+                for dets, placement in zip(detections.per_image, placements)]
+            return detections._replace(per_image=per_image)
+
+        groups = OrderedDict()
+        for i, resolution in enumerate(resolutions):
+            groups.setdefault(tuple(resolution), []).append(i)
+        if self.strategy == 'stack' and len(groups) > 1:
+            raise ValueError(
+                'All images must share one resolution with the stack '
+                'strategy, use group or letterbox')
+
+        parts = []
+        for resolution, indices in groups.items():
+            if isinstance(images, np.ndarray):
+                batch = images
+            elif len(indices) == 1:
+                batch = images[indices[0]][np.newaxis]
+            else:
+                batch = np.stack([images[i] for i in indices], axis=0)
+            parts.append((indices, decode_detections(
+                *model(batch, threshold=threshold),
+                [resolution] * len(indices), num_classes)))
+        return merge_detections(parts, len(images))
@@ -0,0 +1,319 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from smart_tagging.object_detection.utils import (
+    DETECTION_DTYPE,
+    Detections,
+    pack_detections,
+)
+
+# Row of the on-disk index, the detections of a key are stored at
+# data[offset:offset + count].
+INDEX_DTYPE = np.dtype([
+    ('key', np.int64),
+    ('offset', np.int64),
+    ('count', np.int64),
+])
+
+# Approximate memory of an entry besides its detections, so frames without
+# detections count against the bound as well.
+ENTRY_OVERHEAD = 256
+
+# Files of an exported model whose changes invalidate cached detections.
+MODEL_FILES = (
+    'init.json', 'saved_model.pb', 'variables/variables.index',
+    'model_*.tflite', 'model_*.onnx')
+
+
+def model_fingerprint(model_path: Union[str, Path]) -> str:
+    """
+    Fingerprints the files of an exported model by their size and
+    modification time, so the cache namespace changes when a model is
+    replaced at the same path, e.g. after retraining or a new download.
+
+    Args:
+        model_path (str/Path): Exported model directory
+
+    Returns:
+        str: Hex digest, the same as long as no model file changes
+    """
+    root = Path(model_path)
+    digest = hashlib.blake2b(str(root.resolve()).encode(), digest_size=16)
+    for pattern in MODEL_FILES:
+        for path in sorted(root.glob(pattern)):
+            stat = path.stat()
+            digest.update(
+                f'|{path.name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+
+def perceptual_hash(image: np.ndarray, size: int = 8) -> bytes:
+    """
+    Computes a coarse average hash of an image: the mean brightness of
+    size x size blocks, one bit per block above the overall mean. Frames
+    which only differ by sensor or compression noise share the hash.
+
+    Args:
+        image (np.ndarray): Image, shape (height, width, channels)
+        size (int): Blocks per axis
+
+    Returns:
+        bytes: Hash of size * size bits
+    """
+    height, width = image.shape[:2]
+    if height < size or width < size:
+        return np.ascontiguousarray(image).tobytes()
+    step_y, step_x = height // size, width // size
+    blocks = image[:step_y * size, :step_x * size].reshape(
+        size, step_y, size, step_x, -1)
+    # Every fourth row and column of a block suffice for its mean.
+    means = blocks[:, ::4, :, ::4].mean(axis=(1, 3, 4), dtype=np.float32)
+    return np.packbits(means > means.mean()).tobytes()
+
+
+class DetectionCache:
+    """
+    LRU cache of the decoded detections of images, keyed by a hash of the
+    image content and the score threshold.
+
+    The in-memory entries are bounded by max_bytes, the least recently used
+    ones are evicted first. With a directory, all entries are also appended
+    to an on-disk store there, which is read on misses, so the cache
+    survives between runs. Entries are never removed from disk.
+
+    Keys are salted with a namespace, e.g. the model_fingerprint and the
+    model settings, so one store can hold the results of several models
+    without mixing them up.
+
+    Args:
+        max_bytes (int): Memory bound of the in-memory entries
+        root (str/Path): Directory of the on-disk store, None for memory
+            only
+        perceptual (bool): Key by a coarse perceptual hash instead of the
+            exact image bytes, so also near-duplicate frames hit
+        namespace (str): Salt of the keys
+    """
+    def __init__(
+        self,
+        max_bytes: int = 64 << 20,
+        root: Optional[Union[str, Path]] = None,
+        perceptual: bool = False,
+        namespace: str = '',
+    ):
+        self.max_bytes = max_bytes
+        self.perceptual = perceptual
+        self.namespace = namespace
+        self.entries: 'OrderedDict[int, np.ndarray]' = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._salts: Dict[float, bytes] = {}
+
+        self.data_path = self.index_path = None
+        self.rows: Dict[int, Tuple[int, int]] = {}
+        self.num_stored = 0
+        if root is not None:
+            root = Path(root)
+            root.mkdir(parents=True, exist_ok=True)
+            self.data_path = root / 'detections.bin'
+            self.index_path = root / 'index.bin'
+            self._open_store()
+
+    def _open_store(self) -> None:
+        index = (np.fromfile(self.index_path, dtype=INDEX_DTYPE)
+                 if self.index_path.exists() else np.zeros(0, INDEX_DTYPE))
+        self.rows = {
+            int(key): (int(offset), int(count))
+            for key, offset, count in index.tolist()}
+        self.num_stored = int(
+            (index['offset'] + index['count']).max()) if len(index) else 0
+        # Drop detections that were written without their index row, e.g.
+        # after a crash, so the next append stays aligned with the index.
+        size = self.num_stored * DETECTION_DTYPE.itemsize
+        if self.data_path.exists() and self.data_path.stat().st_size > size:
+            with self.data_path.open('r+b') as f:
+                f.truncate(size)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        """
+        Share of the lookups which were answered from the cache.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def key(self, image: np.ndarray, threshold: float) -> int:
+        """
+        Computes the 63 bit key of an image from its content, the
+        threshold and the namespace.
+
+        Args:
+            image (np.ndarray): Image
+            threshold (float): Score threshold of the detections
+
+        Returns:
+            int: Key
+        """
+        salt = self._salts.get(threshold)
+        if salt is None:
+            salt = hashlib.blake2b(
+                f'{self.namespace}|{threshold!r}'.encode(),
+                digest_size=32).digest()
+            self._salts[threshold] = salt
+        digest = hashlib.blake2b(digest_size=8, key=salt)
+        if self.perceptual:
+            digest.update(perceptual_hash(image))
+        else:
+            # A collision would return, and persist, the detections of
+            # another frame, so the image bytes get a cryptographic hash,
+            # which is still cheap next to the inference.
+            digest.update(np.array(image.shape, np.int64).tobytes())
+            digest.update(np.ascontiguousarray(image).data)
+        return int.from_bytes(digest.digest(), 'little') >> 1
+
+    def get(self, key: int) -> Optional[np.ndarray]:
+        """
+        Looks up the detections of a key and counts the hit or miss.
+
+        Args:
+            key (int): Key
+
+        Returns:
+            np.ndarray: DETECTION_DTYPE array, None if not cached
+        """
+        detections = self.entries.get(key)
+        if detections is not None:
+            self.entries.move_to_end(key)
+        elif key in self.rows:
+            offset, count = self.rows[key]
+            detections = np.fromfile(
+                self.data_path, dtype=DETECTION_DTYPE, count=count,
+                offset=offset * DETECTION_DTYPE.itemsize)
+            self._insert(key, detections)
+        if detections is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return detections
+
+    def put(self, key: int, detections: np.ndarray) -> None:
+        """
+        Stores the detections of a key.
+
+        Args:
+            key (int): Key
+            detections (np.ndarray): DETECTION_DTYPE array
+        """
+        detections = np.array(detections, dtype=DETECTION_DTYPE)
+        self._insert(key, detections)
+        if self.data_path is None or key in self.rows:
+            return
+        with self.data_path.open('ab') as f:
+            f.write(detections.tobytes())
+        row = np.array([(key, self.num_stored, len(detections))], INDEX_DTYPE)
+        with self.index_path.open('ab') as f:
+            f.write(row.tobytes())
+        self.rows[key] = (self.num_stored, len(detections))
+        self.num_stored += len(detections)
+
+    def _insert(self, key: int, detections: np.ndarray) -> None:
+        # Shared by all hits, so nobody may modify it.
+        detections.flags.writeable = False
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous.nbytes + ENTRY_OVERHEAD
+        self.entries[key] = detections
+        self.nbytes += detections.nbytes + ENTRY_OVERHEAD
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes + ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Drops the in-memory entries, the on-disk store is kept.
+        """
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """
+        Returns:
+            Dict: Hit and miss counters and the memory usage
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+            'stored': len(self.rows),
+        }
+
+
+class CachedDetector:
+    """
+    Answers the object detection of images from a DetectionCache and only
+    runs the model on the misses.
+
+    If all images of a call hit, the model and TensorFlow are not touched.
+
+    Args:
+        detector (Callable): MixedResolutionBatcher, TiledDetector or
+            compatible
+        cache (DetectionCache): Cache
+    """
+    def __init__(self, detector: Callable, cache: DetectionCache):
+        self.detector = detector
+        self.cache = cache
+
+    def __call__(
+        self,
+        model: Callable,
+        images: Sequence[np.ndarray],
+        threshold: float,
+        num_classes: int,
+    ) -> Detections:
+        """
+        Args:
+            model (Callable): ObjectDetection or compatible
+            images (Sequence[np.ndarray]): uint8 images
+            threshold (float): Score threshold of the NMS surpression
+            num_classes (int): Number of classes known to the model
+
+        Returns:
+            Detections: Detections in original image pixels
+        """
+        keys = [self.cache.key(image, threshold) for image in images]
+        per_image = [self.cache.get(key) for key in keys]
+        misses = [i for i, dets in enumerate(per_image) if dets is None]
+        if misses:
+            if isinstance(images, np.ndarray):
+                batch = images if len(misses) == len(images) else (
+                    images[misses])
+            else:
+                batch = [images[i] for i in misses]
+            detections = self.detector(model, batch, threshold, num_classes)
+            for i, dets in zip(misses, detections.per_image):
+                self.cache.put(keys[i], dets)
+                per_image[i] = dets
+        return pack_detections(per_image, num_classes)
@@ -0,0 +1,96 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from typing import Dict, Sequence
+
+import numpy as np
+
+from smart_tagging.object_detection.utils import box_iou, detection_boxes
+
+
+def average_precision(
+    predictions: Sequence[np.ndarray],
+    ground_truth: Sequence[np.ndarray],
+    class_id: int,
+    iou_threshold: float = 0.5,
+) -> float:
+    """
+    Computes the all-point interpolated average precision of one class.
+
+    Args:
+        predictions (Sequence[np.ndarray]): DETECTION_DTYPE arrays per image
+        ground_truth (Sequence[np.ndarray]): DETECTION_DTYPE arrays per image
+        class_id (int): Evaluated class
+        iou_threshold (float): Minimum IoU of a true positive
+
+    Returns:
+        float: Average precision, nan if the class has no ground truth
+    """
+    scores, matches = [], []
+    num_gt = 0
+    for pred, gt in zip(predictions, ground_truth):
+        pred = pred[pred['class_id'] == class_id]
+        gt = gt[gt['class_id'] == class_id]
+        num_gt += len(gt)
+        if len(pred) == 0:
+            continue
+        pred = pred[np.argsort(-pred['score'], kind='stable')]
+        iou = box_iou(detection_boxes(pred), detection_boxes(gt))
+        matched = np.zeros(len(gt), dtype=bool)
+        for i in range(len(pred)):
+            j = int(np.argmax(iou[i])) if len(gt) else -1
+            hit = j >= 0 and iou[i, j] >= iou_threshold and not matched[j]
+            if hit:
+                matched[j] = True
+            matches.append(hit)
+        scores.append(pred['score'])
+    if num_gt == 0:
+        return float('nan')
+    if not matches:
+        return 0.
+
+    order = np.argsort(-np.concatenate(scores), kind='stable')
+    tp = np.asarray(matches)[order]
+    tp_cum = np.cumsum(tp)
+    recall = tp_cum / num_gt
+    precision = tp_cum / np.arange(1, len(tp) + 1)
+    recall = np.concatenate([[0.], recall, [1.]])
+    precision = np.concatenate([[0.], precision, [0.]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    steps = np.flatnonzero(recall[1:] != recall[:-1])
+    return float(np.sum((recall[steps + 1] - recall[steps])
+                        * precision[steps + 1]))
+
+
+def mean_average_precision(
+    predictions: Sequence[np.ndarray],
+    ground_truth: Sequence[np.ndarray],
+    num_classes: int,
+    iou_threshold: float = 0.5,
+) -> Dict[str, float]:
+    """
+    Computes the box mAP over all classes with ground truth.
+
+    Args:
+        predictions (Sequence[np.ndarray]): DETECTION_DTYPE arrays per image
+        ground_truth (Sequence[np.ndarray]): DETECTION_DTYPE arrays per image
+        num_classes (int): Number of classes
+        iou_threshold (float): Minimum IoU of a true positive
+
+    Returns:
+        Dict[str, float]: 'mAP' and the AP of every class id
+    """
+    aps = {
+        str(c): average_precision(
+            predictions, ground_truth, c, iou_threshold)
+        for c in range(num_classes)}
+    valid = [ap for ap in aps.values() if not np.isnan(ap)]
+    aps['mAP'] = float(np.mean(valid)) if valid else float('nan')
+    return aps
@@ -10,26 +10,117 @@
 
 
 from pathlib import Path
-from typing import Tuple
+from typing import Callable, Optional, Tuple
 
 import numpy as np
 import tensorflow as tf
 
-from smart_tagging.utils import load_exported_model
+from smart_tagging.backends import TFLiteBackend, load_backend
+from smart_tagging.engine import ShardedEngine
+from smart_tagging.instrumentation import DISABLED, Instrumentation
+from smart_tagging.profiles import ExecutionProfile, apply_profile, pinned
+from smart_tagging.startup import startup_report
+
+OUTPUT_KEYS = ('bboxes', 'scores', 'classes', 'number')
 
 
 class ObjectDetection:
     """
     Deploys the exported model and handles preprocessing steps.
+
+    With compiled=True, normalization and inference are traced into one
+    tf.function that takes the raw uint8 images. A concrete function is
+    traced once per input shape and cached. jit_compile additionally
+    compiles the graph with XLA.
+
+    backend selects the inference runtime, see smart_tagging.backends. It
+    defaults to the backend declared in init.json or the saved model. A
+    precision other than float32 selects the float16 / int8 TFLite variants
+    created by smart_tagging.quantize. Only the saved model can be compiled.
+
+    If an Instrumentation is given, every call is recorded as stage
+    'model.inference'.
+
+    An ExecutionProfile sets the thread counts and CPU affinity of the
+    model, see smart_tagging.profiles.
     """
     def __init__(
         self,
         model_path: Path,
+        compiled: bool = True,
+        jit_compile: bool = False,
+        precision: str = 'float32',
+        backend: Optional[str] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        profile: Optional[ExecutionProfile] = None,
     ):
+        options = {}
+        if precision != 'float32':
+            backend = backend or TFLiteBackend.name
+            options['precision'] = precision
+        self.profile = profile or ExecutionProfile()
+        options.update(apply_profile(self.profile, model_path))
+        with pinned(self.profile.cpus):
+            self.serve_fn, self.config = load_backend(
+                model_path, "bboxes", OUTPUT_KEYS, backend, **options)
         # Model must be an attribute of the class according to
         # https://github.com/tensorflow/tensorflow/issues/46708
-        self.model, self.config = load_exported_model(model_path)
-        self.serve_fn = self.model.signatures["bboxes"]
+        self.model = getattr(self.serve_fn, 'model', None)
+        self.precision = precision
+        self.compiled = compiled and self.serve_fn.traceable
+        self.jit_compile = jit_compile
+        self._fused_fn = None
+        self._concrete_fns = {}
+        self._threshold = None
+        self.instrumentation = instrumentation or DISABLED
+        self._first_call = True
+
+    def _preprocess_and_serve(
+        self, x: tf.Tensor, threshold: tf.Tensor
+    ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+        h = tf.cast(x, tf.float32) / 255.
+        h = tf.clip_by_value(h, 0., 1.)
+        h = self.serve_fn(image=h, threshold=threshold)
+        return h['bboxes'], h['scores'], h['classes'], h['number']
+
+    def get_concrete_function(
+        self, shape: Tuple[int, ...], dtype: tf.DType = tf.uint8
+    ) -> Callable:
+        """
+        Returns the traced preprocessing and inference graph for an input
+        shape, tracing it on first use.
+
+        Args:
+            shape (Tuple[int, ...]): Input shape (batch, height, width, 3)
+            dtype (tf.DType): Input dtype
+
+        Returns:
+            ConcreteFunction: Graph taking the images and the threshold
+        """
+        key = (tuple(shape), tf.as_dtype(dtype))
+        if key not in self._concrete_fns:
+            if self._fused_fn is None:
+                # TF 2.4 only knows the experimental name of the argument.
+                self._fused_fn = tf.function(
+                    self._preprocess_and_serve,
+                    experimental_compile=self.jit_compile or None)
+            self._concrete_fns[key] = self._fused_fn.get_concrete_function(
+                tf.TensorSpec(shape, dtype), tf.TensorSpec((), tf.float32))
+        return self._concrete_fns[key]
+
+    def warm_up(self, shape: Tuple[int, ...]) -> None:
+        """
+        Traces and runs the model once, so the first frame does not pay the
+        tracing and graph optimization cost.
+
+        Args:
+            shape (Tuple[int, ...]): Input shape (batch, height, width, 3)
+        """
+        # Served directly, so neither the inference histogram nor the
+        # first inference of the startup report count the warm-up.
+        self._set_threshold(0.5)
+        with startup_report.timed('warmup', 'object_detection'):
+            self._serve(np.zeros(shape, dtype=np.uint8))
 
     def __call__(
         self, x: np.ndarray, threshold: float
@@ -43,7 +134,67 @@ class ObjectDetection:
         Returns:
             Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
         """
-        h = tf.cast(x, tf.float32) / 255.
-        h = tf.clip_by_value(h, 0., 1.)
-        h = self.serve_fn(image=h, threshold=tf.constant(threshold))
-        return h['bboxes'], h['scores'], h['classes'], h['number']
+        self._set_threshold(threshold)
+        if self._first_call:
+            self._first_call = False
+            with startup_report.timed('first_inference', 'object_detection'):
+                return self._serve(x)
+        with self.instrumentation.stage('model.inference'):
+            return self._serve(x)
+
+    def _set_threshold(self, threshold: float) -> None:
+        if self._threshold is None or self._threshold[0] != threshold:
+            self._threshold = (
+                threshold, tf.constant(threshold, dtype=tf.float32))
+
+    def _serve(
+        self, x: np.ndarray
+    ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+        if not self.compiled:
+            return self._preprocess_and_serve(x, self._threshold[1])
+        fn = self.get_concrete_function(x.shape, x.dtype)
+        return fn(tf.convert_to_tensor(x), self._threshold[1])
+
+
+class ShardedObjectDetection(ShardedEngine):
+    """
+    ObjectDetection on a pool of worker processes, with the same call
+    interface, see smart_tagging.engine.ShardedEngine.
+
+    Every batch is split into one shard per worker, so batches of at least
+    num_workers images use all workers.
+    """
+    def __init__(
+        self,
+        model_path: Path,
+        num_workers: int = 2,
+        threads_per_worker: Optional[int] = None,
+        jit_compile: bool = False,
+        precision: str = 'float32',
+        backend: Optional[str] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        **engine_options,
+    ):
+        super().__init__(
+            'object_detection', model_path,
+            {'jit_compile': jit_compile, 'precision': precision,
+             'backend': backend},
+            num_workers, threads_per_worker, **engine_options)
+        self.precision = precision
+        self.instrumentation = instrumentation or DISABLED
+
+    def __call__(
+        self, x: np.ndarray, threshold: float
+    ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+        """
+
+        Args:
+            x (np.ndarray): Input images
+            threshold (float): Score threshold of the NMS surpression
+
+        Returns:
+            Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+        """
+        with self.instrumentation.stage('model.inference'):
+            outputs = self.run(x, threshold=float(threshold))
+        return tuple(tf.convert_to_tensor(output) for output in outputs)
@@ -0,0 +1,174 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from smart_tagging.object_detection.utils import (
+    CLASS_IDS_TO_COLORS,
+    get_bbox_annotation,
+    get_rtmaps_bbox,
+)
+
+if TYPE_CHECKING:
+    import rtmaps.types
+
+# Levels of detail of the overlay, from most to least detailed.
+OVERLAY_LEVELS = ('labels', 'boxes', 'none')
+
+# Formatted annotation texts which are kept for re-use.
+MAX_TEXTS = 4096
+
+
+class OverlayPool:
+    """
+    Builds the bounding box overlays of the detections from preallocated
+    RTMaps drawing objects, which are updated in place instead of being
+    created for every box and frame.
+
+    Every output owns capacity drawing objects, the declared size of its
+    output buffer, so at most capacity boxes, or capacity / 2 boxes with
+    labels, are drawn per image. Detections beyond are dropped.
+
+    A drawing object may only be changed once RTMaps has copied it into
+    the output buffer. Every frame therefore acquires a generation of
+    objects, which it owns until Core has written it and hands it back by
+    release. generations are preallocated; if more frames await writing,
+    e.g. while Core is not called, further ones are allocated.
+
+    Levels:
+        labels: boxes and an annotation with class, track id and score
+        boxes: boxes only
+        none: no drawing objects at all, e.g. for headless runs
+
+    Args:
+        num_outputs (int): Number of overlay outputs
+        capacity (int): Drawing objects per output
+        level (str): One of OVERLAY_LEVELS
+        generations (int): Number of generations to preallocate
+    """
+    def __init__(
+        self,
+        num_outputs: int,
+        capacity: int = 200,
+        level: str = 'labels',
+        generations: int = 1,
+    ):
+        if level not in OVERLAY_LEVELS:
+            raise ValueError(
+                f'Unknown overlay level {level!r}, expected one of '
+                f'{OVERLAY_LEVELS}')
+        self.level = level
+        self.per_box = 2 if level == 'labels' else 1
+        self.max_boxes = capacity // self.per_box
+        self.num_outputs = num_outputs
+        self._texts: Dict[Tuple[str, int], str] = {}
+        self.pools: List[List[List['rtmaps.types.DrawingObject']]] = []
+        self.empty: List[List['rtmaps.types.DrawingObject']] = []
+        self._free: List[int] = []
+        self._lock = threading.Lock()
+        if level == 'none':
+            return
+        for _ in range(max(1, generations)):
+            self._free.append(self._allocate())
+
+    @property
+    def enabled(self) -> bool:
+        return self.level != 'none'
+
+    def _allocate(self) -> int:
+        pool, empty = [], []
+        for _ in range(self.num_outputs):
+            objects = []
+            for _ in range(self.max_boxes):
+                objects.append(get_rtmaps_bbox(0., 0., 0., 0.))
+                if self.level == 'labels':
+                    objects.append(get_bbox_annotation(0., 0., '', 0.))
+            pool.append(objects)
+            empty.append([get_rtmaps_bbox(0., 0., 0., 0.)])
+        self.pools.append(pool)
+        self.empty.append(empty)
+        return len(self.pools) - 1
+
+    def acquire(self) -> int:
+        """
+        Returns a generation of objects for the overlays of a frame, owned
+        by the caller until it is released.
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            return self._allocate()
+
+    def release(self, generation: Optional[int]) -> None:
+        """
+        Hands a generation back once its overlays are written. None, for a
+        frame without overlays, is ignored.
+        """
+        if generation is None:
+            return
+        with self._lock:
+            self._free.append(generation)
+
+    def text(self, label: str, score: float) -> str:
+        """
+        Returns the annotation text of a detection, formatted once per
+        label and score percentage.
+        """
+        key = (label, int(score * 100))
+        text = self._texts.get(key)
+        if text is None:
+            if len(self._texts) >= MAX_TEXTS:
+                self._texts.clear()
+            text = self._texts[key] = f'{label} - {key[1]}'
+        return text
+
+    def build(
+        self,
+        generation: int,
+        output: int,
+        detections: np.ndarray,
+        labels: Optional[Sequence[str]] = None,
+    ) -> List['rtmaps.types.DrawingObject']:
+        """
+        Updates the drawing objects of an output to the detections of its
+        image.
+
+        Args:
+            generation (int): Generation acquired for the frame
+            output (int): Index of the output
+            detections (np.ndarray): DETECTION_DTYPE array
+            labels (Sequence[str]): Label of every detection, required for
+                the labels level
+
+        Returns:
+            List[rtmaps.types.DrawingObject]: Overlay, a single empty box
+                if there are no detections, as RTMaps expects data
+        """
+        if len(detections) == 0:
+            return self.empty[generation][output]
+        objects = self.pools[generation][output]
+        num_boxes = min(len(detections), self.max_boxes)
+        rows = detections[:num_boxes].tolist()
+        for i, (xmin, ymin, xmax, ymax, score, c) in enumerate(rows):
+            color = CLASS_IDS_TO_COLORS[c]
+            bbox = objects[i * self.per_box]
+            bbox.color = color
+            rect = bbox.data
+            rect.x1, rect.y1, rect.x2, rect.y2 = xmin, ymin, xmax, ymax
+            if self.per_box == 2:
+                annotation = objects[i * 2 + 1]
+                annotation.color = color
+                text = annotation.data
+                text.x, text.y = xmin, ymin - 20
+                text.text = self.text(labels[i], score)
+        return objects[:num_boxes * self.per_box]
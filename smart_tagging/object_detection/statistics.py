@@ -0,0 +1,165 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from typing import Dict
+
+import numpy as np
+
+
+class DetectionStatistics:
+    """
+    Cumulative, per-frame and sliding-window detection counts of every
+    class and input image.
+
+    All counters are preallocated (classes, images) matrices. A frame is
+    added with the class counts of decode_detections, so the statistics
+    cost one bincount and a few in-place additions per frame regardless
+    of the number of boxes.
+
+    Args:
+        labels (Dict[int, str]): Class names by class id
+        num_images (int): Number of input images per frame
+        window (int): Number of frames of the sliding window
+        time_scale (float): Seconds per timestamp unit, microseconds for
+            RTMaps timestamps
+    """
+    def __init__(
+        self,
+        labels: Dict[int, str],
+        num_images: int = 1,
+        window: int = 100,
+        time_scale: float = 1e-6,
+    ):
+        self.labels = dict(labels)
+        self.class_ids = {label: c for c, label in self.labels.items()}
+        self.num_classes = max(self.labels) + 1
+        self.num_images = num_images
+        self.window = max(1, window)
+        self.time_scale = time_scale
+
+        shape = (self.num_classes, num_images)
+        self.totals = np.zeros(shape, dtype=np.int64)
+        self.current = np.zeros(shape, dtype=np.int64)
+        self.window_totals = np.zeros(shape, dtype=np.int64)
+        self._window_counts = np.zeros((self.window, *shape), dtype=np.int64)
+        self._window_timestamps = np.zeros(self.window, dtype=np.int64)
+        self._index = 0
+        self.num_frames = 0
+        self.window_frames = 0
+
+    def update(self, class_counts: np.ndarray, timestamp: int) -> None:
+        """
+        Adds the detections of a frame.
+
+        Args:
+            class_counts (np.ndarray): Detections per image and class,
+                shape (images, classes), see Detections.class_counts
+            timestamp (int): Timestamp of the frame
+        """
+        np.copyto(self.current, class_counts.T)
+        self.totals += self.current
+        # Replace the oldest frame of the window.
+        slot = self._window_counts[self._index]
+        self.window_totals -= slot
+        self.window_totals += self.current
+        np.copyto(slot, self.current)
+        self._window_timestamps[self._index] = timestamp
+        self._index = (self._index + 1) % self.window
+        self.num_frames += 1
+        self.window_frames = min(self.window_frames + 1, self.window)
+
+    def reset(self, window_only: bool = False) -> None:
+        """
+        Clears the sliding window, e.g. at the start of a new recording,
+        and the cumulative counts unless window_only is set.
+        """
+        self.current[:] = 0
+        self.window_totals[:] = 0
+        self._window_counts[:] = 0
+        self._index = 0
+        self.window_frames = 0
+        if not window_only:
+            self.totals[:] = 0
+            self.num_frames = 0
+
+    @property
+    def window_seconds(self) -> float:
+        """
+        Time between the oldest and the latest frame of the window.
+        """
+        if self.window_frames < 2:
+            return 0.
+        latest = self._window_timestamps[self._index - 1]
+        oldest = self._window_timestamps[self._oldest]
+        return float(latest - oldest) * self.time_scale
+
+    @property
+    def _oldest(self) -> int:
+        return self._index if self.window_frames == self.window else 0
+
+    def rates(self) -> np.ndarray:
+        """
+        Detections per second over the sliding window.
+
+        The counts of the oldest frame in the window are left out, as they
+        were detected before the measured time span.
+
+        Returns:
+            np.ndarray: Rates, shape (classes, images), zero until the
+                window spans any time
+        """
+        seconds = self.window_seconds
+        if seconds <= 0:
+            return np.zeros(self.totals.shape, dtype=np.float64)
+        return (
+            self.window_totals - self._window_counts[self._oldest]) / seconds
+
+    def shares(self) -> np.ndarray:
+        """
+        Share of every class in the detections of the sliding window.
+
+        Returns:
+            np.ndarray: Shares, shape (classes, images), which sum up to one
+                per image with any detections
+        """
+        objects = self.window_totals.sum(axis=0)
+        return np.divide(
+            self.window_totals, objects,
+            out=np.zeros(self.totals.shape, dtype=np.float64),
+            where=objects > 0)
+
+    def as_dict(self) -> Dict[str, Dict]:
+        """
+        Exports the statistics of every class and of all objects.
+
+        Returns:
+            Dict[str, Dict]: Lists per input image of the cumulative
+                ("total") and latest ("current") counts, the rate in
+                objects/s and the share of the sliding window, per label
+                and for "objects"
+        """
+        rates, shares = self.rates(), self.shares()
+        stats = {
+            'objects': {
+                'total': self.totals.sum(axis=0).tolist(),
+                'current': self.current.sum(axis=0).tolist(),
+                'rate': rates.sum(axis=0).tolist(),
+                'share': (self.window_totals.sum(axis=0) > 0).astype(
+                    np.float64).tolist(),
+            }
+        }
+        for c, label in sorted(self.labels.items()):
+            stats[label] = {
+                'total': self.totals[c].tolist(),
+                'current': self.current[c].tolist(),
+                'rate': rates[c].tolist(),
+                'share': shares[c].tolist(),
+            }
+        return stats
@@ -0,0 +1,382 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from smart_tagging.object_detection.batching import letterbox, unletterbox
+from smart_tagging.object_detection.utils import (
+    BOX_FIELDS,
+    DETECTION_DTYPE,
+    Detections,
+    box_iou,
+    decode_detections,
+    detection_boxes,
+    pack_detections,
+)
+
+TILING_MODES = ('tiles', 'roi')
+MERGE_METHODS = ('nms', 'fusion')
+MATCH_METRICS = ('iou', 'ios')
+
+# Road region of A2D2 front camera images, (xmin, ymin, xmax, ymax) as
+# fractions of the image size.
+DEFAULT_ROI = (0., 0.35, 1., 0.75)
+
+
+class Tile(NamedTuple):
+    """
+    Placement of a tile in its image.
+
+    Attributes:
+        image (int): Index of the image in the input
+        x (int): Left edge in image pixels
+        y (int): Top edge in image pixels
+        height (int): Height of the image content, at most the tile height
+        width (int): Width of the image content, at most the tile width
+    """
+    image: int
+    x: int
+    y: int
+    height: int
+    width: int
+
+
+def parse_roi(roi: str) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Parses a "<xmin>,<ymin>,<xmax>,<ymax>" property of fractions of the
+    image size, e.g. "0,0.35,1,0.75".
+
+    Args:
+        roi (str): Region of interest, empty for none
+
+    Returns:
+        Tuple[float, float, float, float]: Region of interest or None
+    """
+    if not roi:
+        return None
+    values = tuple(float(v) for v in roi.split(','))
+    if (len(values) != 4 or not 0. <= values[0] < values[2] <= 1.
+            or not 0. <= values[1] < values[3] <= 1.):
+        raise ValueError(
+            f'Invalid region of interest {roi!r}, expected '
+            f'"xmin,ymin,xmax,ymax" in [0, 1]')
+    return values
+
+
+def tile_offsets(start: int, stop: int, size: int, stride: int) -> List[int]:
+    """
+    Computes the tile offsets along one axis. The last tile is aligned to
+    stop, so the tiles never reach past the region.
+
+    Args:
+        start (int): First pixel of the region
+        stop (int): End of the region, exclusive
+        size (int): Tile size
+        stride (int): Distance of two adjacent tiles
+
+    Returns:
+        List[int]: Offsets of the tiles
+    """
+    if stop - start <= size:
+        return [start]
+    offsets = list(range(start, stop - size, stride))
+    offsets.append(stop - size)
+    return offsets
+
+
+def tile_grid(
+    resolution: Tuple[int, int],
+    tile_size: Tuple[int, int],
+    overlap: float = 0.2,
+    roi: Optional[Tuple[float, float, float, float]] = None,
+) -> List[Tuple[int, int, int, int]]:
+    """
+    Covers an image, or the region of interest of it, with overlapping
+    tiles.
+
+    Args:
+        resolution (Tuple[int, int]): (height, width) of the image
+        tile_size (Tuple[int, int]): (height, width) of the tiles
+        overlap (float): Overlap of adjacent tiles as fraction of the tile
+            size in [0, 1)
+        roi (Tuple): (xmin, ymin, xmax, ymax) as fractions of the image
+            size, None for the whole image
+
+    Returns:
+        List[Tuple[int, int, int, int]]: (x, y, height, width) of every
+            tile, clipped to the image
+    """
+    height, width = resolution
+    xmin, ymin, xmax, ymax = roi or (0., 0., 1., 1.)
+    xs = tile_offsets(
+        int(xmin * width), int(round(xmax * width)), tile_size[1],
+        max(1, int(tile_size[1] * (1. - overlap))))
+    ys = tile_offsets(
+        int(ymin * height), int(round(ymax * height)), tile_size[0],
+        max(1, int(tile_size[0] * (1. - overlap))))
+    # Tiles of a region smaller than a tile extend it within the image.
+    xs = [max(0, min(x, width - tile_size[1])) for x in xs]
+    ys = [max(0, min(y, height - tile_size[0])) for y in ys]
+    return [
+        (x, y, min(tile_size[0], height - y), min(tile_size[1], width - x))
+        for y in ys for x in xs]
+
+
+def cut_tiles(
+    images: Sequence[np.ndarray],
+    tile_size: Tuple[int, int],
+    overlap: float = 0.2,
+    roi: Optional[Tuple[float, float, float, float]] = None,
+) -> Tuple[np.ndarray, List[Tile]]:
+    """
+    Cuts all images into tiles of one batch. Tiles of images smaller than
+    the tile size are padded with black.
+
+    Args:
+        images (Sequence[np.ndarray]): uint8 images
+        tile_size (Tuple[int, int]): (height, width) of the tiles
+        overlap (float): Overlap of adjacent tiles, see tile_grid
+        roi (Tuple): Region of interest, see tile_grid
+
+    Returns:
+        Tuple[np.ndarray, List[Tile]]: Batch, shape
+            (tiles, height, width, 3), and the placement of every tile
+    """
+    tiles = [
+        Tile(i, *grid)
+        for i, image in enumerate(images)
+        for grid in tile_grid(image.shape[:2], tile_size, overlap, roi)]
+    batch = np.zeros((len(tiles), *tile_size, 3), dtype=np.uint8)
+    for batch_image, tile in zip(batch, tiles):
+        batch_image[:tile.height, :tile.width] = images[tile.image][
+            tile.y:tile.y + tile.height, tile.x:tile.x + tile.width]
+    return batch, tiles
+
+
+def untile(detections: np.ndarray, tile: Tile) -> np.ndarray:
+    """
+    Maps detections from tile pixels to the pixels of its image.
+
+    Args:
+        detections (np.ndarray): DETECTION_DTYPE array in tile pixels
+        tile (Tile): Placement of the tile
+
+    Returns:
+        np.ndarray: DETECTION_DTYPE array in image pixels
+    """
+    detections = detections.copy()
+    for name, offset, limit in (
+        ('xmin', tile.x, tile.width),
+        ('xmax', tile.x, tile.width),
+        ('ymin', tile.y, tile.height),
+        ('ymax', tile.y, tile.height),
+    ):
+        detections[name] = np.clip(detections[name], 0, limit) + offset
+    return detections
+
+
+def box_overlap(boxes: np.ndarray, metric: str = 'iou') -> np.ndarray:
+    """
+    Computes the pairwise overlap of a set of boxes.
+
+    Args:
+        boxes (np.ndarray): Boxes (xmin, ymin, xmax, ymax), shape (n, 4)
+        metric (str): 'iou' for the intersection over union, 'ios' for the
+            intersection over the smaller box, which also matches a box
+            cut by a tile seam with the full box
+
+    Returns:
+        np.ndarray: Overlap matrix, shape (n, n)
+    """
+    if metric == 'iou':
+        return box_iou(boxes, boxes)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    top_left = np.maximum(boxes[:, np.newaxis, :2], boxes[np.newaxis, :, :2])
+    bottom_right = np.minimum(
+        boxes[:, np.newaxis, 2:], boxes[np.newaxis, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+    area = np.prod(boxes[:, 2:] - boxes[:, :2], axis=-1)
+    smaller = np.minimum(area[:, np.newaxis], area[np.newaxis, :])
+    return np.where(smaller > 0, inter / np.maximum(smaller, 1e-12), 0.)
+
+
+def merge_duplicates(
+    detections: np.ndarray,
+    iou_threshold: float = 0.5,
+    method: str = 'nms',
+    metric: str = 'iou',
+) -> np.ndarray:
+    """
+    Merges duplicate detections of one class, e.g. of an object seen by
+    two overlapping tiles.
+
+    As in greedy NMS, a detection is a duplicate if it overlaps a kept
+    detection of the same class with a higher score by more than
+    iou_threshold, so a duplicate does not suppress further boxes. The
+    detections are visited in score order, each kept one suppressing its
+    duplicates at once from its row of the overlap matrix.
+
+    Methods:
+        nms: duplicates are dropped
+        fusion: every duplicate is assigned to the kept detection it
+            overlaps most, and the box of that detection becomes the
+            score-weighted mean of the boxes assigned to it
+
+    Args:
+        detections (np.ndarray): DETECTION_DTYPE array of one image
+        iou_threshold (float): Overlap above which detections are merged
+        method (str): One of MERGE_METHODS
+        metric (str): One of MATCH_METRICS, see box_overlap
+
+    Returns:
+        np.ndarray: DETECTION_DTYPE array sorted by descending score
+    """
+    if len(detections) < 2:
+        return detections
+    detections = detections[np.argsort(-detections['score'], kind='stable')]
+    boxes = detection_boxes(detections)
+    classes = detections['class_id']
+    overlap = box_overlap(boxes, metric)
+    overlap[classes[:, np.newaxis] != classes[np.newaxis, :]] = 0.
+    # Row i holds the overlap of detection i with all lower-scored ones.
+    overlap = np.triu(overlap, k=1)
+    keep = np.ones(len(detections), dtype=bool)
+    for i in range(len(detections)):
+        if keep[i]:
+            keep[i + 1:] &= overlap[i, i + 1:] <= iou_threshold
+    if method == 'nms':
+        return detections[keep]
+
+    # Assign every detection to the kept detection it overlaps most, kept
+    # detections to themselves.
+    overlap[~keep] = 0.
+    overlap[np.diag_indices_from(overlap)] = np.where(keep, np.inf, 0.)
+    owner = overlap.argmax(axis=0)
+    assigned = overlap[owner, np.arange(len(owner))] > iou_threshold
+    owner, weights = owner[assigned], detections['score'][assigned]
+    fused = detections[keep].copy()
+    total = np.bincount(owner, weights, minlength=len(keep))[keep]
+    for name, column in zip(BOX_FIELDS, boxes[assigned].T):
+        fused[name] = np.bincount(
+            owner, weights * column, minlength=len(keep))[keep] / total
+    return fused
+
+
+class TiledDetector:
+    """
+    Runs the object detection on overlapping tiles of the images, so small
+    objects are detected at full resolution, and maps all boxes back to the
+    pixel coordinates of their original image.
+
+    The tiles of all images are batched into one model call. Objects seen
+    by several tiles are merged by merge_duplicates.
+
+    Modes:
+        tiles: the whole image is tiled
+        roi: the whole image is letterboxed into one tile, for large
+            objects, and only the region of interest, e.g. the road, is
+            tiled at full resolution
+
+    The TiledDetector is called like a MixedResolutionBatcher.
+
+    Args:
+        mode (str): One of TILING_MODES
+        tile_size (Tuple[int, int]): (height, width) of the tiles
+        overlap (float): Overlap of adjacent tiles as fraction of the tile
+            size
+        roi (Tuple): (xmin, ymin, xmax, ymax) of the tiled region as
+            fractions of the image size, for the roi mode
+        iou_threshold (float): Overlap above which detections are merged
+        method (str): One of MERGE_METHODS
+        metric (str): One of MATCH_METRICS
+    """
+    def __init__(
+        self,
+        mode: str = 'tiles',
+        tile_size: Tuple[int, int] = (512, 512),
+        overlap: float = 0.2,
+        roi: Optional[Tuple[float, float, float, float]] = None,
+        iou_threshold: float = 0.5,
+        method: str = 'nms',
+        metric: str = 'iou',
+    ):
+        for name, value, choices in (
+            ('tiling mode', mode, TILING_MODES),
+            ('merge method', method, MERGE_METHODS),
+            ('match metric', metric, MATCH_METRICS),
+        ):
+            if value not in choices:
+                raise ValueError(
+                    f'Unknown {name} {value!r}, expected one of {choices}')
+        if not 0. <= overlap < 1.:
+            raise ValueError(f'Tile overlap {overlap} not in [0, 1)')
+        self.mode = mode
+        self.tile_size = tuple(tile_size)
+        self.overlap = overlap
+        self.roi = (roi or DEFAULT_ROI) if mode == 'roi' else None
+        self.iou_threshold = iou_threshold
+        self.method = method
+        self.metric = metric
+
+    def batch_size(self, resolutions: Sequence[Tuple[int, int]]) -> int:
+        """
+        Args:
+            resolutions (Sequence): (height, width) of every image
+
+        Returns:
+            int: Number of tiles of one model call, e.g. for the warm up
+        """
+        return sum(
+            len(tile_grid(resolution, self.tile_size, self.overlap, self.roi))
+            + (self.mode == 'roi')
+            for resolution in resolutions)
+
+    def __call__(
+        self,
+        model: Callable,
+        images: Sequence[np.ndarray],
+        threshold: float,
+        num_classes: int,
+    ) -> Detections:
+        """
+        Args:
+            model (Callable): ObjectDetection or compatible
+            images (Sequence[np.ndarray]): uint8 images of any resolution
+            threshold (float): Score threshold of the NMS surpression
+            num_classes (int): Number of classes known to the model
+
+        Returns:
+            Detections: Detections in original image pixels
+        """
+        batch, tiles = cut_tiles(
+            images, self.tile_size, self.overlap, self.roi)
+        placements = []
+        if self.mode == 'roi':
+            frames, placements = letterbox(images, self.tile_size)
+            batch = np.concatenate([frames, batch], axis=0)
+        detections = decode_detections(
+            *model(batch, threshold=threshold),
+            [self.tile_size] * batch.shape[0], num_classes)
+
+        parts: List[List[np.ndarray]] = [[] for _ in images]
+        for i, placement in enumerate(placements):
+            parts[i].append(unletterbox(detections.per_image[i], placement))
+        for tile, dets in zip(
+                tiles, detections.per_image[len(placements):]):
+            parts[tile.image].append(untile(dets, tile))
+        per_image = [
+            merge_duplicates(
+                np.concatenate(part) if part
+                else np.zeros(0, DETECTION_DTYPE),
+                self.iou_threshold, self.method, self.metric)
+            for part in parts]
+        return pack_detections(per_image, num_classes)
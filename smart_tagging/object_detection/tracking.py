@@ -0,0 +1,220 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+from smart_tagging.object_detection.utils import (
+    BOX_FIELDS,
+    DETECTION_DTYPE,
+    box_iou,
+    detection_boxes,
+)
+
+
+def assign(
+    iou: np.ndarray, threshold: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Matches rows and columns of an IoU matrix with maximum total IoU.
+
+    Uses the Hungarian method of scipy if it is installed and a greedy
+    assignment in order of decreasing IoU otherwise.
+
+    Args:
+        iou (np.ndarray): IoU matrix, shape (n, m)
+        threshold (float): Minimum IoU of a match
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Row and column indices of the
+            matches
+    """
+    if iou.size == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        linear_sum_assignment = None
+
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(-iou)
+    else:
+        order = np.argsort(-iou, axis=None, kind='stable')
+        order = order[iou.ravel()[order] >= threshold]
+        row_used = np.zeros(iou.shape[0], dtype=bool)
+        col_used = np.zeros(iou.shape[1], dtype=bool)
+        rows, cols = [], []
+        for row, col in zip(*np.unravel_index(order, iou.shape)):
+            if not row_used[row] and not col_used[col]:
+                row_used[row] = col_used[col] = True
+                rows.append(row)
+                cols.append(col)
+        rows, cols = np.asarray(rows, np.int64), np.asarray(cols, np.int64)
+    keep = iou[rows, cols] >= threshold
+    return rows[keep], cols[keep]
+
+
+class IoUTracker:
+    """
+    Tracks the detections of one image stream and counts unique objects.
+
+    Tracks move with a constant velocity per frame. Every frame, all tracks
+    are predicted forward and matched against the detections of their
+    class by IoU. A track is confirmed, and its object counted once, after
+    min_hits matched frames. It is dropped after max_age frames without a
+    match.
+
+    All track state lives in arrays, so a frame costs one IoU matrix and
+    one assignment regardless of the number of tracks.
+
+    Args:
+        num_classes (int): Number of classes known to the model
+        iou_threshold (float): Minimum IoU of a match
+        max_age (int): Frames a track is kept without a match
+        min_hits (int): Matched frames until a track is confirmed
+        smoothing (float): Weight of the prior velocity in [0, 1)
+    """
+    def __init__(
+        self,
+        num_classes: int,
+        iou_threshold: float = 0.3,
+        max_age: int = 5,
+        min_hits: int = 2,
+        smoothing: float = 0.5,
+    ):
+        self.num_classes = num_classes
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.min_hits = max(1, min_hits)
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Drops all tracks and unique counts, e.g. for a new recording.
+        """
+        self.boxes = np.zeros((0, 4), np.float32)
+        self.velocities = np.zeros((0, 4), np.float32)
+        self.scores = np.zeros(0, np.float32)
+        self.class_ids = np.zeros(0, np.int32)
+        self.ids = np.zeros(0, np.int64)
+        self.hits = np.zeros(0, np.int64)
+        self.ages = np.zeros(0, np.int64)
+        self.unique_counts = np.zeros(self.num_classes, np.int64)
+        self.next_id = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def predict(self) -> None:
+        """
+        Advances all tracks by one frame.
+        """
+        self.boxes += self.velocities
+        self.ages += 1
+        alive = self.ages <= self.max_age
+        if not alive.all():
+            for name in ('boxes', 'velocities', 'scores', 'class_ids',
+                         'ids', 'hits', 'ages'):
+                setattr(self, name, getattr(self, name)[alive])
+
+    def update(self, detections: np.ndarray) -> np.ndarray:
+        """
+        Matches the detections of the current frame with the predicted
+        tracks, call `predict` before.
+
+        Args:
+            detections (np.ndarray): DETECTION_DTYPE array
+
+        Returns:
+            np.ndarray: Track id of every detection
+        """
+        boxes = detection_boxes(detections).astype(np.float32)
+        class_ids = detections['class_id']
+        iou = box_iou(self.boxes, boxes)
+        iou[self.class_ids[:, np.newaxis] != class_ids[np.newaxis, :]] = 0.
+        rows, cols = assign(iou, self.iou_threshold)
+
+        # Matched tracks take over the detected boxes.
+        if len(rows):
+            gap = self.ages[rows, np.newaxis].astype(np.float32)
+            motion = (boxes[cols] - self.boxes[rows]
+                      + self.velocities[rows] * gap) / gap
+            self.velocities[rows] = (
+                self.smoothing * self.velocities[rows]
+                + (1 - self.smoothing) * motion)
+            self.boxes[rows] = boxes[cols]
+            self.scores[rows] = detections['score'][cols]
+            self.ages[rows] = 0
+            self.hits[rows] += 1
+            confirmed = rows[self.hits[rows] == self.min_hits]
+            np.add.at(self.unique_counts, self.class_ids[confirmed], 1)
+
+        track_ids = np.empty(len(detections), np.int64)
+        track_ids[cols] = self.ids[rows]
+
+        # Unmatched detections start new tracks.
+        new = np.ones(len(detections), dtype=bool)
+        new[cols] = False
+        num_new = int(new.sum())
+        if num_new:
+            ids = np.arange(self.next_id, self.next_id + num_new)
+            self.next_id += num_new
+            track_ids[new] = ids
+            self.boxes = np.concatenate([self.boxes, boxes[new]])
+            self.velocities = np.concatenate(
+                [self.velocities, np.zeros((num_new, 4), np.float32)])
+            self.scores = np.concatenate(
+                [self.scores, detections['score'][new]])
+            self.class_ids = np.concatenate(
+                [self.class_ids, class_ids[new].astype(np.int32)])
+            self.ids = np.concatenate([self.ids, ids])
+            self.hits = np.concatenate(
+                [self.hits, np.ones(num_new, np.int64)])
+            self.ages = np.concatenate(
+                [self.ages, np.zeros(num_new, np.int64)])
+            if self.min_hits == 1:
+                np.add.at(self.unique_counts, class_ids[new], 1)
+        return track_ids
+
+    def tracked(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: DETECTION_DTYPE array of the
+                current boxes of all confirmed tracks and their ids
+        """
+        confirmed = self.hits >= self.min_hits
+        detections = np.empty(int(confirmed.sum()), dtype=DETECTION_DTYPE)
+        for i, name in enumerate(BOX_FIELDS):
+            detections[name] = self.boxes[confirmed, i]
+        detections['score'] = self.scores[confirmed]
+        detections['class_id'] = self.class_ids[confirmed]
+        return detections, self.ids[confirmed]
+
+    def step(
+        self, detections: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Advances the tracker by one frame.
+
+        Args:
+            detections (np.ndarray): DETECTION_DTYPE array, or None on
+                frames without detection
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The detections and their track
+                ids, or on frames without detection the predicted boxes of
+                the confirmed tracks and their ids
+        """
+        self.predict()
+        if detections is None:
+            return self.tracked()
+        return detections, self.update(detections)
@@ -8,10 +8,16 @@
 # either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
-from typing import Tuple
+from typing import TYPE_CHECKING, List, NamedTuple, Sequence, Tuple
 
-import rtmaps.types
-import tensorflow as tf
+import numpy as np
+
+from smart_tagging.startup import lazy_import
+
+tf = lazy_import('tensorflow')
+
+if TYPE_CHECKING:
+    import rtmaps.types
 
 # color = red + (green * 256) + (blue * 65536)
 CLASS_IDS_TO_COLORS = {
@@ -24,10 +30,50 @@ CLASS_IDS_TO_COLORS = {
     6: 16717055   # tractor: purple
 }
 
+# Structured dtype of a single decoded detection in pixel coordinates.
+DETECTION_DTYPE = np.dtype([
+    ('xmin', np.float32),
+    ('ymin', np.float32),
+    ('xmax', np.float32),
+    ('ymax', np.float32),
+    ('score', np.float32),
+    ('class_id', np.int32),
+])
+
+
+# Box fields of DETECTION_DTYPE in (xmin, ymin, xmax, ymax) order.
+BOX_FIELDS = ['xmin', 'ymin', 'xmax', 'ymax']
+
+
+def detection_boxes(detections: np.ndarray) -> np.ndarray:
+    """
+    Args:
+        detections (np.ndarray): DETECTION_DTYPE array
+
+    Returns:
+        np.ndarray: Boxes (xmin, ymin, xmax, ymax), shape (n, 4)
+    """
+    return np.stack([detections[f] for f in BOX_FIELDS], axis=-1)
+
+
+class Detections(NamedTuple):
+    """
+    Decoded detections of a batch of images.
+
+    Attributes:
+        per_image (List[np.ndarray]): One DETECTION_DTYPE array per image
+        class_counts (np.ndarray): Detections per image and class,
+            shape (num_images, num_classes)
+        number (np.ndarray): Number of detections reported by the model
+    """
+    per_image: List[np.ndarray]
+    class_counts: np.ndarray
+    number: np.ndarray
+
 
 def mask_padding(
-    boxes: tf.Tensor, scores: tf.Tensor, classes: tf.Tensor
-) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    boxes: 'tf.Tensor', scores: 'tf.Tensor', classes: 'tf.Tensor'
+) -> Tuple['tf.Tensor', 'tf.Tensor', 'tf.Tensor', 'tf.Tensor']:
     """
     Mask zero paddings from model predictions.
 
@@ -46,9 +92,119 @@ def mask_padding(
     return boxes, scores, classes, box_count_per_batch
 
 
+def decode_detections(
+    boxes: 'tf.Tensor',
+    scores: 'tf.Tensor',
+    classes: 'tf.Tensor',
+    number: 'tf.Tensor',
+    resolutions: Sequence[Tuple[int, int]],
+    num_classes: int,
+) -> Detections:
+    """
+    Decodes raw model predictions into per-image structured arrays.
+
+    All outputs are packed into a single tensor on the device, so only one
+    device-to-host transfer takes place. Zero paddings are masked and boxes
+    are scaled to pixel space in one vectorized pass.
+
+    Args:
+        boxes (tf.Tensor): Normalized boxes, shape (batch, max_boxes, 4)
+        scores (tf.Tensor): Scores, shape (batch, max_boxes)
+        classes (tf.Tensor): Class ids, shape (batch, max_boxes)
+        number (tf.Tensor): Number of detections, shape (batch,)
+        resolutions (Sequence): (height, width) of every image in the batch
+        num_classes (int): Number of classes known to the model
+
+    Returns:
+        Detections: Decoded detections
+    """
+    batch_size = boxes.shape[0]
+    packed = tf.concat([
+        tf.cast(boxes, tf.float32),
+        tf.cast(scores, tf.float32)[..., tf.newaxis],
+        tf.cast(classes, tf.float32)[..., tf.newaxis],
+    ], axis=-1)
+    packed = tf.concat([
+        tf.reshape(packed, (batch_size, -1)),
+        tf.cast(number, tf.float32)[:, tf.newaxis],
+    ], axis=-1)
+    packed = np.asarray(packed)
+
+    number = packed[:, -1].astype(np.int32)
+    packed = packed[:, :-1].reshape(batch_size, -1, 6)
+
+    mask = packed[..., :4].sum(axis=-1) > 0
+    image_ids, _ = np.nonzero(mask)
+    valid = packed[mask]
+
+    # Scale (xmin, ymin, xmax, ymax) by (width, height, width, height).
+    resolutions = np.asarray(resolutions, dtype=np.float32).reshape(-1, 2)
+    scale = np.tile(resolutions[:, ::-1], 2)[image_ids]
+
+    detections = np.empty(valid.shape[0], dtype=DETECTION_DTYPE)
+    for i, name in enumerate(('xmin', 'ymin', 'xmax', 'ymax')):
+        detections[name] = valid[:, i] * scale[:, i]
+    detections['score'] = valid[:, 4]
+    detections['class_id'] = valid[:, 5]
+
+    box_count_per_batch = np.bincount(image_ids, minlength=batch_size)
+    per_image = np.split(detections, np.cumsum(box_count_per_batch)[:-1])
+    class_counts = np.bincount(
+        image_ids * num_classes + detections['class_id'],
+        minlength=batch_size * num_classes,
+    ).reshape(batch_size, num_classes)
+    return Detections(per_image, class_counts, number)
+
+
+def pack_detections(
+    per_image: Sequence[np.ndarray], num_classes: int
+) -> Detections:
+    """
+    Creates Detections from decoded per-image arrays, e.g. of a tracker.
+
+    Args:
+        per_image (Sequence[np.ndarray]): DETECTION_DTYPE arrays per image
+        num_classes (int): Number of classes known to the model
+
+    Returns:
+        Detections: Detections of all images
+    """
+    number = np.array([len(dets) for dets in per_image], dtype=np.int32)
+    image_ids = np.repeat(np.arange(len(per_image)), number)
+    class_ids = np.concatenate(
+        [dets['class_id'] for dets in per_image] or [np.zeros(0, np.int32)])
+    class_counts = np.bincount(
+        image_ids * num_classes + class_ids,
+        minlength=len(per_image) * num_classes,
+    ).reshape(len(per_image), num_classes)
+    return Detections(list(per_image), class_counts, number)
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Computes the pairwise intersection over union of two sets of boxes.
+
+    Args:
+        a (np.ndarray): Boxes (xmin, ymin, xmax, ymax), shape (n, 4)
+        b (np.ndarray): Boxes (xmin, ymin, xmax, ymax), shape (m, 4)
+
+    Returns:
+        np.ndarray: IoU matrix, shape (n, m)
+    """
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    top_left = np.maximum(a[:, np.newaxis, :2], b[np.newaxis, :, :2])
+    bottom_right = np.minimum(a[:, np.newaxis, 2:], b[np.newaxis, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=-1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=-1)
+    union = area_a[:, np.newaxis] + area_b[np.newaxis, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0.)
+
+
 def get_rtmaps_bbox(
     xmin: float, ymin: float, xmax: float, ymax: float, color: int = 255
-) -> rtmaps.types.DrawingObject:
+) -> 'rtmaps.types.DrawingObject':
     """
     Creates RTMaps bboxes for the OverlayDrawing block
 
@@ -62,6 +218,8 @@ def get_rtmaps_bbox(
     Returns:
         Drawing Object: Rectangle
     """
+    import rtmaps.types
+
     bbox = rtmaps.types.DrawingObject()
     bbox.kind = 2
     bbox.color = color
@@ -75,12 +233,12 @@ def get_rtmaps_bbox(
 
 
 def get_bbox_annotation(
-    x: tf.Tensor,
-    y: tf.Tensor,
-    label: tf.Tensor,
-    score: tf.Tensor,
+    x: 'tf.Tensor',
+    y: 'tf.Tensor',
+    label: 'tf.Tensor',
+    score: 'tf.Tensor',
     color: int = 255,
-) -> rtmaps.types.DrawingObject:
+) -> 'rtmaps.types.DrawingObject':
     """
     Creates annotations for the bboxes like class names, score.
 
@@ -94,6 +252,8 @@ def get_bbox_annotation(
     Returns:
         Drawing Object: Text
     """
+    import rtmaps.types
+
     text = f'{label} - {str(int(score * 100))}'
     annotation = rtmaps.types.DrawingObject()
     annotation.kind = 5
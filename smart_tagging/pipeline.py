@@ -0,0 +1,188 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import queue
+import threading
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+OVERLOAD_POLICIES = ('latest', 'block')
+
+_STOP = object()
+
+
+class Pipeline:
+    """
+    Runs a sequence of stages on worker threads joined by bounded queues.
+
+    Every submitted item is tagged with its timestamp, which is handed
+    through all stages unchanged. Finished items are collected and can be
+    fetched from the calling thread with `results`, so RTMaps outputs are
+    only ever written from the component thread.
+
+    With the 'latest' overload policy the oldest queued item is dropped if
+    the first stage cannot keep up, with 'block' the caller waits. The
+    input of a dropped item is passed to on_drop, e.g. to release its
+    buffers. Likewise, if a stage raises, its input is passed to on_error
+    and the error is raised by the next call of submit or results.
+
+    If batch_size is greater than one, the first stage is called with a
+    list of up to batch_size queued items and has to return a list of
+    outputs of the same length.
+    """
+    def __init__(
+        self,
+        stages: Sequence[Callable[[Any], Any]],
+        maxsize: int = 2,
+        policy: str = 'latest',
+        batch_size: int = 1,
+        on_drop: Optional[Callable[[Any], None]] = None,
+        on_error: Optional[Callable[[Any], None]] = None,
+    ):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(
+                f'Unknown overload policy {policy!r}, '
+                f'expected one of {OVERLOAD_POLICIES}')
+        self.stages = list(stages)
+        self.policy = policy
+        self.batch_size = max(1, batch_size)
+        self.on_drop = on_drop
+        self.on_error = on_error
+        self.num_dropped = 0
+        self._queues = [
+            queue.Queue(maxsize=max(1, maxsize))
+            for _ in range(len(self.stages))]
+        self._done = queue.Queue()
+        self._error = None
+        self._threads = []
+
+    def start(self) -> None:
+        """
+        Starts one worker thread per stage.
+        """
+        for i, stage in enumerate(self.stages):
+            out = (self._queues[i + 1]
+                   if i + 1 < len(self.stages) else self._done)
+            run = self._run_batched if i == 0 and self.batch_size > 1 \
+                else self._run
+            thread = threading.Thread(
+                target=run, args=(stage, self._queues[i], out),
+                daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self, stage: Callable, inp: queue.Queue, out: queue.Queue):
+        while True:
+            item = inp.get()
+            if item is _STOP:
+                out.put(_STOP)
+                return
+            timestamp, data = item
+            try:
+                out.put((timestamp, stage(data)))
+            except Exception as e:
+                self._fail(e, [data])
+
+    def _run_batched(
+        self, stage: Callable, inp: queue.Queue, out: queue.Queue
+    ):
+        stop = False
+        while not stop:
+            items = [inp.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(inp.get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is _STOP:
+                items.pop()
+                stop = True
+            if items:
+                timestamps = [timestamp for timestamp, _ in items]
+                batch = [data for _, data in items]
+                try:
+                    outputs = stage(batch)
+                except Exception as e:
+                    self._fail(e, batch)
+                    continue
+                for item in zip(timestamps, outputs):
+                    out.put(item)
+        out.put(_STOP)
+
+    def submit(self, timestamp: int, data: Any) -> None:
+        """
+        Feeds an item into the first stage.
+
+        Args:
+            timestamp (int): Timestamp of the input ioelt
+            data (Any): Input of the first stage
+        """
+        self._raise_error()
+        first = self._queues[0]
+        if self.policy == 'block':
+            first.put((timestamp, data))
+            return
+        while True:
+            try:
+                first.put_nowait((timestamp, data))
+                return
+            except queue.Full:
+                try:
+                    _, dropped = first.get_nowait()
+                except queue.Empty:
+                    continue
+                self.num_dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop(dropped)
+
+    def results(self) -> List[Tuple[int, Any]]:
+        """
+        Returns all finished items without waiting.
+
+        Returns:
+            List[Tuple[int, Any]]: (timestamp, output of the last stage)
+        """
+        self._raise_error()
+        finished = []
+        while True:
+            try:
+                item = self._done.get_nowait()
+            except queue.Empty:
+                return finished
+            if item is not _STOP:
+                finished.append(item)
+
+    def stop(self, timeout: float = None) -> List[Tuple[int, Any]]:
+        """
+        Drains the pipeline and stops all worker threads.
+
+        Args:
+            timeout (float): Maximum time to wait for every thread
+
+        Returns:
+            List[Tuple[int, Any]]: Items that finished while draining
+        """
+        if self._threads:
+            self._queues[0].put(_STOP)
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
+        return self.results()
+
+    def _fail(self, error: Exception, inputs: List[Any]) -> None:
+        self._error = error
+        if self.on_error is not None:
+            for data in inputs:
+                self.on_error(data)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -0,0 +1,457 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+CPU execution profiles: thread counts, CPU affinity and batch size of a
+model, and an auto-tuner which benchmarks a grid of settings and stores
+the best one next to the init.json of the model.
+
+Usage:
+    python -m smart_tagging.profiles <model dir> --resolution 1208x1920
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union,
+)
+
+import numpy as np
+
+from smart_tagging.startup import declared_resolution, parse_resolution
+from smart_tagging.utils import load_config
+
+PROFILE_FILE = 'execution_profile.json'
+
+# Values of the "execution_profile" block property.
+PROFILE_MODES = ('', 'saved', 'tune')
+
+BATCH_SIZES = (1, 2, 4, 8, 16)
+
+
+class ExecutionProfile(NamedTuple):
+    """
+    How a model instance runs on the CPU, zero or empty for the default.
+
+    TensorFlow only has one set of thread pools per process, so the thread
+    counts of saved models apply to the whole process and are set by the
+    first model loaded. TFLite and ONNX models get their own threads per
+    instance. Threads started while loading a model, including the
+    TensorFlow pools if it is the first model, are pinned to cpus.
+
+    Args:
+        intra_op_threads (int): Threads within an op
+        inter_op_threads (int): Ops run in parallel
+        batch_size (int): Images per model call
+        cpus (Tuple[int, ...]): CPU affinity
+    """
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    batch_size: int = 0
+    cpus: Tuple[int, ...] = ()
+
+    def merge(self, **overrides) -> 'ExecutionProfile':
+        """
+        Returns:
+            ExecutionProfile: Copy with all overrides which are set
+        """
+        return self._replace(**{
+            key: value for key, value in overrides.items()
+            if value not in (None, 0, (), '')})
+
+
+def parse_ranges(ranges: str) -> Tuple[int, ...]:
+    """
+    Parses a list of integers and ranges, e.g. the CPU list "0-3,8".
+
+    Args:
+        ranges (str): Comma separated integers and ranges, empty for none
+
+    Returns:
+        Tuple[int, ...]: Sorted integers
+    """
+    ids = set()
+    for part in ranges.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        ids.update(range(int(first), int(last or first) + 1))
+    return tuple(sorted(ids))
+
+
+def available_cpus() -> Tuple[int, ...]:
+    if hasattr(os, 'sched_getaffinity'):
+        return tuple(sorted(os.sched_getaffinity(0)))
+    return tuple(range(os.cpu_count() or 1))
+
+
+def machine_key() -> str:
+    """
+    Identifies the hardware a profile was tuned on, so profiles can be
+    shared between identical nodes.
+    """
+    return f'{platform.machine()}-{len(available_cpus())}cpus'
+
+
+def profile_path(model_dir: Union[str, Path]) -> Path:
+    return Path(model_dir) / PROFILE_FILE
+
+
+def load_profile(model_dir: Union[str, Path]) -> Optional[ExecutionProfile]:
+    """
+    Reads the profile tuned for this machine.
+
+    Args:
+        model_dir (str/Path): Exported model directory
+
+    Returns:
+        ExecutionProfile: Profile or None if there is none for this machine
+    """
+    path = profile_path(model_dir)
+    if not path.exists():
+        return None
+    with path.open() as f:
+        entry = json.load(f).get(machine_key())
+    if entry is None:
+        return None
+    # Fields of older versions are ignored.
+    profile = {
+        key: value for key, value in entry['profile'].items()
+        if key in ExecutionProfile._fields}
+    profile['cpus'] = tuple(profile.get('cpus', ()))
+    return ExecutionProfile(**profile)
+
+
+def save_profile(
+    model_dir: Union[str, Path],
+    profile: ExecutionProfile,
+    results: Optional[List[Dict]] = None,
+) -> Path:
+    """
+    Stores the profile of this machine next to init.json, keeping the
+    profiles of other machines.
+
+    Args:
+        model_dir (str/Path): Exported model directory
+        profile (ExecutionProfile): Profile
+        results (List[Dict]): Benchmark results the profile was chosen from
+
+    Returns:
+        Path: Profile file
+    """
+    path = profile_path(model_dir)
+    profiles = {}
+    if path.exists():
+        with path.open() as f:
+            profiles = json.load(f)
+    profiles[machine_key()] = {
+        'profile': profile._asdict(),
+        'results': results or [],
+        'tuned_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with path.open('w') as f:
+        json.dump(profiles, f, indent=2)
+    return path
+
+
+def configure_tensorflow(profile: ExecutionProfile) -> bool:
+    """
+    Applies the thread counts to TensorFlow.
+
+    Returns:
+        bool: False if TensorFlow was already initialized with other
+            settings, which then stay in effect
+    """
+    if not (profile.intra_op_threads or profile.inter_op_threads):
+        return True
+
+    import tensorflow as tf
+    threading = tf.config.threading
+    try:
+        if profile.intra_op_threads:
+            threading.set_intra_op_parallelism_threads(
+                profile.intra_op_threads)
+        if profile.inter_op_threads:
+            threading.set_inter_op_parallelism_threads(
+                profile.inter_op_threads)
+    except RuntimeError:
+        # Raised once the runtime is initialized, unless nothing changes.
+        return False
+    return True
+
+
+def apply_profile(
+    profile: ExecutionProfile, model_path: Union[str, Path] = ''
+) -> Dict[str, int]:
+    """
+    Configures TensorFlow for a model instance which is about to be
+    loaded.
+
+    Returns:
+        Dict[str, int]: Thread options of the backend
+    """
+    if not configure_tensorflow(profile):
+        print(f'TensorFlow is already initialized, the thread counts of '
+              f'the execution profile of {model_path} do not apply to saved '
+              f'models')
+    return {
+        key: getattr(profile, key)
+        for key in ('intra_op_threads', 'inter_op_threads')
+        if getattr(profile, key)}
+
+
+@contextmanager
+def pinned(cpus: Sequence[int]) -> Iterator[None]:
+    """
+    Restricts the calling thread, and all threads it starts in the
+    enclosed block, to cpus. Threads started before keep their affinity.
+    Has no effect on platforms without sched_setaffinity.
+    """
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        yield
+        return
+    # On Linux, pid 0 refers to the calling thread only.
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def model_kind(config: Dict) -> str:
+    """
+    Returns:
+        str: 'object_detection' or 'novelty_detection'
+    """
+    if 'dict_class_names_to_ids' in config.get('model', {}):
+        return 'object_detection'
+    return 'novelty_detection'
+
+
+def thread_grid(num_cpus: int) -> Tuple[int, ...]:
+    """
+    Returns:
+        Tuple[int, ...]: Powers of two up to num_cpus, and num_cpus
+    """
+    grid = [1]
+    while grid[-1] * 2 < num_cpus:
+        grid.append(grid[-1] * 2)
+    if grid[-1] != num_cpus:
+        grid.append(num_cpus)
+    return tuple(grid)
+
+
+def tune(
+    model_dir: Union[str, Path],
+    resolution: Tuple[int, int],
+    threads: Optional[Sequence[int]] = None,
+    batch_sizes: Sequence[int] = BATCH_SIZES,
+    repeat: int = 5,
+    max_latency_ms: Optional[float] = None,
+    cpus: Sequence[int] = (),
+    options: Optional[Dict] = None,
+    executable: Optional[str] = None,
+    log=sys.stdout,
+) -> Tuple[ExecutionProfile, List[Dict]]:
+    """
+    Benchmarks the model for every combination of thread count and batch
+    size and returns the one with the highest throughput.
+
+    Every thread count is measured in a fresh worker process of
+    smart_tagging.engine, as TensorFlow cannot change the thread counts of
+    a running process. The inter-op threads are set to two, or one for a
+    single thread.
+
+    Args:
+        model_dir (str/Path): Exported model directory
+        resolution (Tuple[int, int]): Input (height, width)
+        threads (Sequence[int]): Intra-op thread counts, powers of two up
+            to the number of CPUs by default
+        batch_sizes (Sequence[int]): Batch sizes
+        repeat (int): Timed model calls per setting
+        max_latency_ms (float): Only consider settings whose median batch
+            latency stays below this bound, e.g. for real-time use
+        cpus (Sequence[int]): CPUs the profile is pinned to, all by default
+        options (Dict): Keyword arguments of the model class, e.g.
+            precision or backend
+        executable (str): Python interpreter of the worker processes
+        log: Stream for progress messages, None for quiet
+
+    Returns:
+        Tuple[ExecutionProfile, List[Dict]]: Best profile and the results
+            of all settings
+    """
+    from smart_tagging.engine import ShardedEngine
+
+    kind = model_kind(load_config(Path(model_dir) / 'init.json'))
+    cpus = tuple(cpus)
+    threads = threads or thread_grid(len(cpus or available_cpus()))
+    rng = np.random.default_rng(0)
+    results = []
+    for num_threads in threads:
+        profile = ExecutionProfile(
+            num_threads, min(2, num_threads), cpus=cpus)
+        engine = ShardedEngine(
+            kind, model_dir, options, num_workers=1, depth=1,
+            profile=profile, executable=executable)
+        try:
+            for batch_size in batch_sizes:
+                x = rng.integers(
+                    0, 256, (batch_size, *resolution, 3), dtype=np.uint8)
+                kwargs = ({'threshold': 0.5}
+                          if kind == 'object_detection' else {})
+                engine.run(x, **kwargs)
+                times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    engine.run(x, **kwargs)
+                    times.append(time.perf_counter() - start)
+                latency = float(np.median(times))
+                results.append({
+                    'intra_op_threads': num_threads,
+                    'inter_op_threads': profile.inter_op_threads,
+                    'batch_size': batch_size,
+                    'latency_ms': latency * 1e3,
+                    'frames_per_s': batch_size / latency,
+                })
+                if log is not None:
+                    print(f'threads {num_threads:3d}, batch {batch_size:3d}: '
+                          f'{batch_size / latency:8.1f} frames/s, '
+                          f'{latency * 1e3:8.1f} ms', file=log, flush=True)
+        finally:
+            engine.close()
+
+    candidates = [
+        r for r in results
+        if max_latency_ms is None or r['latency_ms'] <= max_latency_ms]
+    if not candidates:
+        raise ValueError(
+            f'No setting stays below {max_latency_ms} ms per batch')
+    # Prefer fewer threads among settings within 5% of the best throughput.
+    best_rate = max(r['frames_per_s'] for r in candidates)
+    best = min(
+        (r for r in candidates if r['frames_per_s'] >= 0.95 * best_rate),
+        key=lambda r: (r['intra_op_threads'], -r['frames_per_s']))
+    profile = ExecutionProfile(
+        best['intra_op_threads'], best['inter_op_threads'],
+        best['batch_size'], cpus)
+    return profile, results
+
+
+def resolve_profile(
+    mode: str,
+    model_dir: Union[str, Path],
+    resolution: Optional[Tuple[int, int]] = None,
+    batch_sizes: Sequence[int] = BATCH_SIZES,
+    options: Optional[Dict] = None,
+    executable: Optional[str] = None,
+    **overrides,
+) -> Optional[ExecutionProfile]:
+    """
+    Determines the profile of a model instance, as configured by the block
+    properties.
+
+    Args:
+        mode (str): One of PROFILE_MODES: '' for none, 'saved' to read the
+            profile stored next to init.json, 'tune' to tune and store it
+        model_dir (str/Path): Exported model directory
+        resolution (Tuple[int, int]): Input (height, width) to tune with,
+            the one declared in init.json by default
+        batch_sizes (Sequence[int]): Batch sizes to tune
+        options (Dict): Keyword arguments of the model class
+        executable (str): Python interpreter of the tuning processes
+        **overrides: ExecutionProfile fields which take precedence
+
+    Returns:
+        ExecutionProfile: Profile, None if nothing is set
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(
+            f'Unknown execution profile mode {mode!r}, '
+            f'expected one of {PROFILE_MODES}')
+    profile = None
+    if mode == 'saved':
+        profile = load_profile(model_dir)
+        if profile is None:
+            print(f'No execution profile for {machine_key()} in '
+                  f'{profile_path(model_dir)}, using the defaults')
+    elif mode == 'tune':
+        resolution = resolution or declared_resolution(
+            load_config(Path(model_dir) / 'init.json'))
+        if resolution is None:
+            raise ValueError(
+                'Tuning requires a warm-up resolution or an input shape '
+                'declared in init.json')
+        profile, results = tune(
+            model_dir, resolution, batch_sizes=batch_sizes,
+            cpus=overrides.get('cpus') or (), options=options,
+            executable=executable)
+        save_profile(model_dir, profile, results)
+    profile = (profile or ExecutionProfile()).merge(**overrides)
+    return None if profile == ExecutionProfile() else profile
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m smart_tagging.profiles',
+        description='Tunes the thread counts and batch size of a model on '
+                    'this machine and stores the best profile next to its '
+                    'init.json.')
+    parser.add_argument('model_dir', type=Path, help='exported model')
+    parser.add_argument(
+        '--resolution', type=parse_resolution,
+        help='input <height>x<width>, declared in init.json by default')
+    parser.add_argument(
+        '--threads', type=parse_ranges,
+        help='intra-op thread counts, e.g. 1,2,4-8, powers of two by '
+             'default')
+    parser.add_argument(
+        '--batch-sizes', type=parse_ranges, default=BATCH_SIZES,
+        help='batch sizes, e.g. 1,2,4,8')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--max-latency-ms', type=float,
+        help='only consider settings with a lower batch latency')
+    parser.add_argument(
+        '--cpus', type=parse_ranges, default=(),
+        help='CPUs to pin the model to, e.g. 0-7')
+    parser.add_argument('--precision', default='float32')
+    parser.add_argument('--backend')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='print the best profile without storing it')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    resolution = args.resolution or declared_resolution(
+        load_config(args.model_dir / 'init.json'))
+    if resolution is None:
+        raise SystemExit('No input shape in init.json, use --resolution')
+    profile, results = tune(
+        args.model_dir, resolution, args.threads, args.batch_sizes,
+        args.repeat, args.max_latency_ms, args.cpus,
+        {'precision': args.precision, 'backend': args.backend})
+    print(json.dumps(profile._asdict(), indent=2))
+    if not args.dry_run:
+        path = save_profile(args.model_dir, profile, results)
+        print(f'Stored in {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Converts the saved models into float16 and int8 TFLite variants and
+reports their accuracy and latency against the float32 model.
+
+Usage:
+    python -m smart_tagging.quantize [--precisions float16 int8]
+"""
+
+import argparse
+import json
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import tensorflow as tf
+
+from smart_tagging import project_root
+from smart_tagging.novelty_detection.model import PairwiseFilter
+from smart_tagging.object_detection.metrics import mean_average_precision
+from smart_tagging.object_detection.model import ObjectDetection
+from smart_tagging.object_detection.utils import decode_detections
+from smart_tagging.readers import IMAGE_SUFFIXES, VIDEO_SUFFIXES, read_frames
+from smart_tagging.tflite import PRECISIONS, tflite_path
+
+MODELS = {
+    'object_detection': 'bboxes',
+    'novelty_detection': 'features',
+}
+
+
+def iter_dataset_frames(root: Path) -> Iterator[np.ndarray]:
+    """
+    Reads all frames of the image directories and videos below a directory,
+    e.g. the downloaded example datasets.
+
+    Args:
+        root (Path): Dataset directory
+
+    Yields:
+        np.ndarray: RGB image
+    """
+    for path in sorted(Path(root).rglob('*')):
+        is_image_dir = path.is_dir() and any(
+            f.suffix.lower() in IMAGE_SUFFIXES for f in path.iterdir())
+        if is_image_dir or path.suffix.lower() in VIDEO_SUFFIXES:
+            for _, image in read_frames(path):
+                yield image
+
+
+def convert(
+    export_dir: Path,
+    signature: str,
+    precision: str,
+    calibration: Sequence[np.ndarray],
+) -> Path:
+    """
+    Converts a saved model signature into a reduced-precision TFLite model.
+
+    Args:
+        export_dir (Path): Path to saved model
+        signature (str): Signature key
+        precision (str): 'float16' or 'int8'
+        calibration (Sequence[np.ndarray]): Images for int8 calibration
+
+    Returns:
+        Path: Written .tflite file
+    """
+    converter = tf.lite.TFLiteConverter.from_saved_model(
+        str(export_dir), signature_keys=[signature])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    # Ops without a TFLite kernel, e.g. the NMS, fall back to TensorFlow.
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if precision == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        def representative_dataset():
+            for image in calibration:
+                h = image[np.newaxis].astype(np.float32) / 255.
+                # Inputs in sorted name order: image, threshold.
+                if signature == 'bboxes':
+                    yield [h, np.float32(0.5)]
+                else:
+                    yield [h]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS,
+            tf.lite.OpsSet.SELECT_TF_OPS,
+        ]
+
+    path = tflite_path(export_dir, precision)
+    path.write_bytes(converter.convert())
+    return path
+
+
+def evaluate_detection(
+    export_dir: Path,
+    precisions: Sequence[str],
+    frames: Sequence[np.ndarray],
+    threshold: float = 0.3,
+) -> Dict[str, Dict]:
+    """
+    Compares the variants of the object detection with the float32 model,
+    whose predictions serve as ground truth for the box mAP.
+    """
+    predictions = {}
+    latencies = {}
+    for precision in ('float32', *precisions):
+        model = ObjectDetection(export_dir, precision=precision)
+        num_classes = max(
+            model.config['model']['dict_class_names_to_ids'].values()) + 1
+        model(frames[0][np.newaxis], threshold)
+        predictions[precision] = []
+        start = time.perf_counter()
+        for image in frames:
+            outputs = model(image[np.newaxis], threshold)
+            predictions[precision].extend(decode_detections(
+                *outputs, [image.shape[:2]], num_classes).per_image)
+        latencies[precision] = (time.perf_counter() - start) / len(frames)
+
+    report = {}
+    for precision in ('float32', *precisions):
+        aps = mean_average_precision(
+            predictions[precision], predictions['float32'], num_classes)
+        report[precision] = {
+            'latency_ms': latencies[precision] * 1000,
+            'speedup': latencies['float32'] / latencies[precision],
+            'box_mAP': aps['mAP'],
+        }
+    return report
+
+
+def evaluate_novelty(
+    export_dir: Path,
+    precisions: Sequence[str],
+    frames: Sequence[np.ndarray],
+) -> Dict[str, Dict]:
+    """
+    Compares the similarities of the variants of the novelty detection with
+    the float32 model.
+    """
+    sims = {}
+    latencies = {}
+    for precision in ('float32', *precisions):
+        model = PairwiseFilter(export_dir, precision=precision)
+        model.warm_up(frames[0][np.newaxis].shape)
+        start = time.perf_counter()
+        sims[precision] = model.batch(frames, batch_size=1).numpy()
+        latencies[precision] = (time.perf_counter() - start) / len(frames)
+
+    report = {}
+    for precision in ('float32', *precisions):
+        # The first frame has no prior one to be compared with.
+        deviation = np.abs(sims[precision] - sims['float32'])[1:]
+        report[precision] = {
+            'latency_ms': latencies[precision] * 1000,
+            'speedup': latencies['float32'] / latencies[precision],
+            'similarity_mean_abs_dev': (
+                float(deviation.mean()) if deviation.size else np.nan),
+            'similarity_max_abs_dev': (
+                float(deviation.max()) if deviation.size else np.nan),
+        }
+    return report
+
+
+EVALUATE = {
+    'object_detection': evaluate_detection,
+    'novelty_detection': evaluate_novelty,
+}
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m smart_tagging.quantize',
+        description='Creates float16 and int8 TFLite variants of the models '
+                    'and reports their accuracy and latency.')
+    parser.add_argument(
+        '--models', nargs='+', choices=sorted(MODELS), default=sorted(MODELS))
+    parser.add_argument(
+        '--precisions', nargs='+', choices=PRECISIONS[1:],
+        default=list(PRECISIONS[1:]))
+    parser.add_argument(
+        '--calibration-frames', type=int, default=100,
+        help='number of example frames used for int8 calibration')
+    parser.add_argument(
+        '--eval-frames', type=int, default=50,
+        help='number of example frames used for the report, at least 2')
+    parser.add_argument(
+        '--report', type=Path,
+        help='write the report to this .json file')
+    args = parser.parse_args(argv)
+    if args.eval_frames < 2:
+        parser.error('--eval-frames must be at least 2, as similarities '
+                     'are rated between consecutive frames')
+    return args
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    report = {}
+    for name in args.models:
+        export_dir = project_root / name / 'saved_model'
+        datasets = project_root / 'examples' / name / 'datasets'
+        frames: List[np.ndarray] = list(islice(
+            iter_dataset_frames(datasets),
+            args.calibration_frames + args.eval_frames))
+        if len(frames) < 2:
+            raise SystemExit(
+                f'No example data in {datasets}, run '
+                f'"python -m smart_tagging.examples.download_examples"')
+        calibration = frames[:args.calibration_frames]
+        evaluation = frames[args.calibration_frames:] or frames
+
+        for precision in args.precisions:
+            path = convert(export_dir, MODELS[name], precision, calibration)
+            print(f'Wrote {path}')
+        report[name] = EVALUATE[name](export_dir, args.precisions, evaluation)
+
+    print(json.dumps(report, indent=2))
+    if args.report is not None:
+        with args.report.open('w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
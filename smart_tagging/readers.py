@@ -0,0 +1,192 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+VIDEO_SUFFIXES = ('.mp4', '.avi', '.mkv', '.mov', '.webm')
+
+_END = object()
+
+
+class Batch(NamedTuple):
+    """
+    Batch of frames of equal resolution.
+
+    Attributes:
+        timestamps (np.ndarray): Timestamps in microseconds, shape (batch,)
+        images (np.ndarray): RGB images, shape (batch, height, width, 3)
+    """
+    timestamps: np.ndarray
+    images: np.ndarray
+
+
+def _file_order(path: Path) -> Tuple[bool, int, str]:
+    # Integer names in numeric order, i.e. "99" before "100", then the
+    # other names.
+    numeric = path.stem.isdigit()
+    return not numeric, int(path.stem) if numeric else 0, path.name
+
+
+def read_image_directory(
+    path: Union[str, Path],
+    fps: float = 30.,
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Reads the images of a directory in file name order.
+
+    Files named by an integer, as written by RTMaps recorders, use this
+    integer as timestamp in microseconds, all other files a timestamp
+    derived from their position in the directory and the frame rate.
+
+    Args:
+        path (str/Path): Image directory
+        fps (float): Frame rate of the files without timestamp
+
+    Yields:
+        Tuple[int, np.ndarray]: Timestamp in microseconds and RGB image
+    """
+    if fps <= 0:
+        raise ValueError(f'Expected a positive frame rate, got {fps}')
+    files = sorted(
+        (f for f in Path(path).iterdir()
+         if f.suffix.lower() in IMAGE_SUFFIXES),
+        key=_file_order)
+    for i, f in enumerate(files):
+        image = tf.io.decode_image(
+            tf.io.read_file(str(f)), channels=3, expand_animations=False)
+        timestamp = int(f.stem) if f.stem.isdigit() else round(i * 1e6 / fps)
+        yield timestamp, image.numpy()
+
+
+def read_video(path: Union[str, Path]) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Reads the frames of a video file. Requires opencv-python.
+
+    Args:
+        path (str/Path): Video file
+
+    Yields:
+        Tuple[int, np.ndarray]: Timestamp in microseconds and RGB image
+    """
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError(
+            'Reading video files requires opencv-python, '
+            'install it with "pip install opencv-python".') from None
+
+    capture = cv2.VideoCapture(str(path))
+    if not capture.isOpened():
+        raise IOError(f'Cannot open video file {path}')
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            timestamp = int(capture.get(cv2.CAP_PROP_POS_MSEC) * 1000)
+            yield timestamp, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+
+def read_frames(
+    path: Union[str, Path],
+    fps: float = 30.,
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Reads the frames of an image directory or a video file.
+
+    Args:
+        path (str/Path): Image directory or video file
+        fps (float): Frame rate of images without timestamp in their file
+            name
+
+    Returns:
+        Iterator[Tuple[int, np.ndarray]]: Timestamps in microseconds and
+            RGB images
+    """
+    path = Path(path)
+    if path.is_dir():
+        return read_image_directory(path, fps)
+    if path.suffix.lower() in VIDEO_SUFFIXES:
+        return read_video(path)
+    raise ValueError(f'{path} is neither a directory nor a video file')
+
+
+class BatchReader:
+    """
+    Groups frames into batches and prefetches them on a background thread.
+
+    A batch is closed early if the resolution changes, so every batch can
+    be stacked into a single array. `read_time` accumulates the time spent
+    reading and decoding on the background thread.
+    """
+    def __init__(
+        self,
+        frames: Iterable[Tuple[int, np.ndarray]],
+        batch_size: int = 8,
+        prefetch: int = 2,
+    ):
+        self.frames = frames
+        self.batch_size = max(1, batch_size)
+        self.prefetch = max(1, prefetch)
+        self.read_time = 0.
+
+    def _batches(self) -> Iterator[Batch]:
+        timestamps, images = [], []
+        start = time.perf_counter()
+        for timestamp, image in self.frames:
+            if images and image.shape != images[0].shape:
+                yield self._stack(timestamps, images, start)
+                timestamps, images = [], []
+                start = time.perf_counter()
+            timestamps.append(timestamp)
+            images.append(image)
+            if len(images) == self.batch_size:
+                yield self._stack(timestamps, images, start)
+                timestamps, images = [], []
+                start = time.perf_counter()
+        if images:
+            yield self._stack(timestamps, images, start)
+
+    def _stack(self, timestamps, images, start) -> Batch:
+        batch = Batch(
+            np.asarray(timestamps, dtype=np.int64), np.stack(images, axis=0))
+        self.read_time += time.perf_counter() - start
+        return batch
+
+    def _produce(self, batches: queue.Queue) -> None:
+        try:
+            for batch in self._batches():
+                batches.put(batch)
+        except Exception as e:
+            batches.put(e)
+        batches.put(_END)
+
+    def __iter__(self) -> Iterator[Batch]:
+        batches = queue.Queue(maxsize=self.prefetch)
+        threading.Thread(
+            target=self._produce, args=(batches,), daemon=True).start()
+        while True:
+            batch = batches.get()
+            if batch is _END:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
@@ -0,0 +1,199 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import importlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+PHASES = ('import', 'load', 'warmup', 'first_inference')
+
+
+class StartupReport:
+    """
+    Collects the time spent in the startup phases import, load, warmup and
+    first_inference, broken down by name, e.g. module or model.
+    """
+    def __init__(self):
+        self.times = OrderedDict((phase, OrderedDict()) for phase in PHASES)
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, name: str, seconds: float) -> None:
+        """
+        Adds a duration to a phase.
+
+        Args:
+            phase (str): One of PHASES
+            name (str): Name of the timed step
+            seconds (float): Duration in seconds
+        """
+        with self._lock:
+            steps = self.times.setdefault(phase, OrderedDict())
+            steps[name] = steps.get(name, 0.) + seconds
+
+    @contextmanager
+    def timed(self, phase: str, name: str) -> Iterator[None]:
+        """
+        Times the enclosed block.
+
+        Args:
+            phase (str): One of PHASES
+            name (str): Name of the timed step
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, name, time.perf_counter() - start)
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns:
+            Dict: Seconds per phase and step
+        """
+        with self._lock:
+            return {phase: dict(steps) for phase, steps in self.times.items()}
+
+    def summary(self) -> str:
+        """
+        Returns:
+            str: Human readable breakdown of the startup time
+        """
+        lines = ['Startup time:']
+        for phase, steps in self.as_dict().items():
+            lines.append(f'  {phase}: {sum(steps.values()):.3f} s')
+            for name, seconds in steps.items():
+                lines.append(f'    {name}: {seconds:.3f} s')
+        return '\n'.join(lines)
+
+
+# Process-wide report, shared by all blocks and tools.
+startup_report = StartupReport()
+
+
+class LazyModule(ModuleType):
+    """
+    Module proxy that imports the module on first attribute access and
+    records the import time in the startup report.
+    """
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module = None
+
+    def _load(self) -> ModuleType:
+        if self._module is None:
+            with startup_report.timed('import', self.__name__):
+                self._module = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Defers the import of a heavy module until it is used.
+
+    Args:
+        name (str): Module name, e.g. 'tensorflow'
+
+    Returns:
+        ModuleType: Proxy of the module
+    """
+    return LazyModule(name)
+
+
+class BackgroundLoader:
+    """
+    Runs a model factory on a background thread, so RTMaps can keep the
+    diagram running while the model loads.
+
+    Args:
+        factory (Callable): Creates the model
+        name (str): Name used in error messages
+    """
+    def __init__(self, factory: Callable[[], Any], name: str = 'model'):
+        self.factory = factory
+        self.name = name
+        self.model = None
+        self.error = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._load, daemon=True)
+        self._thread.start()
+
+    def _load(self) -> None:
+        try:
+            self.model = self.factory()
+        except Exception as e:
+            self.error = e
+        self._ready.set()
+
+    @property
+    def ready(self) -> bool:
+        """
+        True once the model is loaded.
+        """
+        if self._ready.is_set() and self.error is not None:
+            raise self.error
+        return self._ready.is_set()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """
+        Waits for the model.
+
+        Args:
+            timeout (float): Maximum waiting time in seconds
+
+        Returns:
+            Any: Loaded model
+        """
+        self._ready.wait(timeout)
+        if not self.ready:
+            raise TimeoutError(f'{self.name} is not loaded yet')
+        return self.model
+
+
+def parse_resolution(resolution: str) -> Optional[Tuple[int, int]]:
+    """
+    Parses a "<height>x<width>" property, e.g. "1208x1920".
+
+    Args:
+        resolution (str): Resolution, empty for none
+
+    Returns:
+        Tuple[int, int]: (height, width) or None
+    """
+    if not resolution:
+        return None
+    height, width = resolution.lower().split('x')
+    return int(height), int(width)
+
+
+def declared_resolution(config: Dict) -> Optional[Tuple[int, int]]:
+    """
+    Reads the input resolution declared in the init.json of a model.
+
+    Args:
+        config (Dict): Model configuration
+
+    Returns:
+        Tuple[int, int]: (height, width) or None if not declared
+    """
+    model = config.get('model', {})
+    for key in ('input_shape', 'image_shape', 'input_size'):
+        shape = model.get(key, config.get(key))
+        if shape:
+            # Accept (height, width) as well as (height, width, channels).
+            return int(shape[0]), int(shape[1])
+    return None
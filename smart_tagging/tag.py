@@ -0,0 +1,660 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Headless batch tagging of recorded data without RTMaps.
+
+Usage:
+    python -m smart_tagging.tag <recording> [<recording> ...] -o tags.jsonl
+"""
+
+import argparse
+import json
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from smart_tagging import project_root
+from smart_tagging.backends import BACKENDS
+from smart_tagging.gating import NoveltyGate
+from smart_tagging.novelty_detection.feature_store import (
+    FeatureStore,
+    store_name,
+)
+from smart_tagging.novelty_detection.memory_bank import MemoryBank
+from smart_tagging.novelty_detection.model import (
+    PairwiseFilter,
+    ShardedPairwiseFilter,
+)
+from smart_tagging.novelty_detection.segmentation import StreamingSegmenter
+from smart_tagging.novelty_detection.utils import similarity_to_rating
+from smart_tagging.object_detection.batching import MixedResolutionBatcher
+from smart_tagging.object_detection.cache import (
+    CachedDetector,
+    DetectionCache,
+    model_fingerprint,
+)
+from smart_tagging.object_detection.model import (
+    ObjectDetection,
+    ShardedObjectDetection,
+)
+from smart_tagging.object_detection.statistics import DetectionStatistics
+from smart_tagging.object_detection.tiling import (
+    MERGE_METHODS,
+    TILING_MODES,
+    TiledDetector,
+    parse_roi,
+)
+from smart_tagging.object_detection.tracking import IoUTracker
+from smart_tagging.object_detection.utils import DETECTION_DTYPE
+from smart_tagging.profiles import (
+    ExecutionProfile,
+    parse_ranges,
+    resolve_profile,
+)
+from smart_tagging.readers import Batch, BatchReader, read_frames
+from smart_tagging.startup import parse_resolution, startup_report
+from smart_tagging.taglog import TagLog
+from smart_tagging.tflite import PRECISIONS
+
+
+class JsonlWriter:
+    """
+    Writes one JSON record per frame.
+    """
+    def __init__(self, path: Path):
+        self.file = Path(path).open('w')
+
+    def write(self, record: Dict) -> None:
+        self.file.write(json.dumps(record) + '\n')
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class NpzWriter:
+    """
+    Collects the records column by column and stores them as .npz file with
+    a frame table and a detection table, which references its frame by
+    the row index in the frame table.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.frames = defaultdict(list)
+        self.detections = defaultdict(list)
+
+    def write(self, record: Dict) -> None:
+        frame_id = len(self.frames['timestamp'])
+        self.frames['source'].append(record['source'])
+        self.frames['timestamp'].append(record['timestamp'])
+        self.frames['similarity'].append(record.get('similarity', np.nan))
+        self.frames['segment'].append(record.get('segment', -1))
+        self.frames['keyframe'].append(record.get('keyframe', False))
+        for det in record.get('detections', []):
+            self.detections['frame_id'].append(frame_id)
+            self.detections['class_id'].append(det['class_id'])
+            self.detections['score'].append(det['score'])
+            self.detections['box'].append(det['box'])
+
+    def close(self) -> None:
+        np.savez(
+            self.path,
+            frame_source=np.asarray(self.frames['source'], dtype=str),
+            frame_timestamp=np.asarray(
+                self.frames['timestamp'], dtype=np.int64),
+            frame_similarity=np.asarray(
+                self.frames['similarity'], dtype=np.float32),
+            frame_segment=np.asarray(self.frames['segment'], dtype=np.int64),
+            frame_keyframe=np.asarray(self.frames['keyframe'], dtype=bool),
+            detection_frame_id=np.asarray(
+                self.detections['frame_id'], dtype=np.int64),
+            detection_class_id=np.asarray(
+                self.detections['class_id'], dtype=np.int32),
+            detection_score=np.asarray(
+                self.detections['score'], dtype=np.float32),
+            detection_box=np.asarray(
+                self.detections['box'], dtype=np.float32).reshape(-1, 4),
+        )
+
+
+class TagLogWriter:
+    """
+    Appends the records to a tag log directory, which can be queried by
+    time range, class and count, see smart_tagging.taglog.
+    """
+    def __init__(self, path: Path, labels: Optional[Dict[int, str]] = None):
+        self.log = TagLog(path, labels or {})
+
+    def write(self, record: Dict) -> None:
+        dets = record.get('detections', [])
+        detections = np.empty(len(dets), DETECTION_DTYPE)
+        for i, det in enumerate(dets):
+            detections[i] = (*det['box'], det['score'], det['class_id'])
+        self.log.append(
+            record['timestamp'], detections,
+            similarity=record.get('similarity', np.nan),
+            source=record['source'],
+            track_ids=[det.get('track_id', -1) for det in dets])
+
+    def close(self) -> None:
+        self.log.close()
+
+
+WRITERS = {
+    'jsonl': JsonlWriter,
+    'npz': NpzWriter,
+    'taglog': TagLogWriter,
+}
+
+
+class Tagger:
+    """
+    Runs the object detection and the novelty detection over recordings.
+
+    Args:
+        detection_model (Path): Object detection saved model, None to skip
+        novelty_model (Path): Novelty detection saved model, None to skip
+        threshold (float): Score threshold of the object detection
+        batch_size (int): Number of frames per model call
+        prefetch (int): Number of batches read ahead
+        memory_bank (MemoryBank): Compare frames against a memory bank
+            instead of the prior frame
+        feature_store (Path): Directory of a feature store which caches
+            the novelty features per recording path and model settings
+        jit_compile (bool): Compile the object detection with XLA
+        precision (str): 'float32' or one of the TFLite variants 'float16'
+            and 'int8' created by smart_tagging.quantize
+        backend (str): Inference backend, see smart_tagging.backends
+        track (bool): Track the detections, adds a track id to every
+            detection and counts unique objects
+        gate (NoveltyGate): Only run the object detection on frames the
+            gate selects from the novelty features, all other frames
+            re-use the detections of the last detected frame. Requires
+            both models.
+        workers (int): Run each model on this many worker processes, see
+            smart_tagging.engine, 0 to run them in this process
+        detection_profile (ExecutionProfile): Thread counts and CPU
+            affinity of the object detection, see smart_tagging.profiles
+        novelty_profile (ExecutionProfile): Same for the novelty detection
+        tiler (TiledDetector): Detect overlapping tiles of every frame
+            instead of the whole frame
+        cache (DetectionCache): Re-use the detections of frames seen
+            before, e.g. frozen frames or in a re-run
+        segmenter (StreamingSegmenter): Split every recording into scene
+            segments from the novelty ratings, adds the segment index and
+            keyframe flag to every record. Requires the novelty model.
+        fps (float): Frame rate of image directories whose file names are
+            no timestamps
+    """
+    def __init__(
+        self,
+        detection_model: Optional[Path],
+        novelty_model: Optional[Path],
+        threshold: float = 0.3,
+        batch_size: int = 8,
+        prefetch: int = 2,
+        memory_bank: Optional[MemoryBank] = None,
+        feature_store: Optional[Path] = None,
+        jit_compile: bool = False,
+        precision: str = 'float32',
+        backend: Optional[str] = None,
+        track: bool = False,
+        gate: Optional[NoveltyGate] = None,
+        workers: int = 0,
+        detection_profile: Optional[ExecutionProfile] = None,
+        novelty_profile: Optional[ExecutionProfile] = None,
+        tiler: Optional[TiledDetector] = None,
+        cache: Optional[DetectionCache] = None,
+        segmenter: Optional[StreamingSegmenter] = None,
+        fps: float = 30.,
+    ):
+        if gate is not None and (
+                detection_model is None or novelty_model is None):
+            raise ValueError(
+                'The novelty gate requires both the object detection and '
+                'the novelty detection model')
+        if segmenter is not None and novelty_model is None:
+            raise ValueError('Segmentation requires the novelty model')
+        self.objects = None
+        self.tracker = None
+        self.novelty_module = None
+        engine_options = {}
+        detection_class, novelty_class = ObjectDetection, PairwiseFilter
+        if workers > 0:
+            engine_options['num_workers'] = workers
+            detection_class = ShardedObjectDetection
+            novelty_class = ShardedPairwiseFilter
+        if detection_model is not None:
+            self.objects = detection_class(
+                detection_model, jit_compile=jit_compile,
+                precision=precision, backend=backend,
+                profile=detection_profile, **engine_options)
+            self.labels = {
+                v: k.lower()
+                for k, v in self.objects.config['model'][
+                    'dict_class_names_to_ids'].items()}
+            self.num_classes = max(self.labels) + 1
+            self.statistics = DetectionStatistics(self.labels)
+            if track:
+                self.tracker = IoUTracker(self.num_classes)
+                self.unique_counts = np.zeros(self.num_classes, np.int64)
+        if novelty_model is not None:
+            self.novelty_module = novelty_class(
+                novelty_model, memory_bank=memory_bank, precision=precision,
+                backend=backend, profile=novelty_profile, **engine_options)
+        self.gate = gate
+        self.segmenter = segmenter
+        self.detector = tiler or MixedResolutionBatcher('stack')
+        self.cache = cache
+        if cache is not None:
+            self.detector = CachedDetector(self.detector, cache)
+        self.previous = None
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.fps = fps
+        self.feature_store = feature_store
+        self.novelty_model = novelty_model
+        self.precision = precision
+        self.backend = backend
+        self.stage_times = defaultdict(float)
+        self.num_frames = 0
+
+    def tag(self, source: Path, writer) -> None:
+        """
+        Tags all frames of a recording.
+
+        Args:
+            source (Path): Image directory or video file
+            writer: JsonlWriter or NpzWriter
+        """
+        if self.objects is not None:
+            self.statistics.reset(window_only=True)
+        if self.tracker is not None:
+            self.unique_counts += self.tracker.unique_counts
+            self.tracker.reset()
+        if self.gate is not None:
+            self.gate.reset()
+        if self.segmenter is not None:
+            self.segmenter.reset()
+        if self.novelty_module is not None:
+            self.novelty_module.reset()
+            if self.feature_store is not None:
+                self.novelty_module.feature_store = FeatureStore(
+                    self.feature_store, store_name(
+                        Path(source).resolve(), self.novelty_model,
+                        self.precision, self.backend))
+        reader = BatchReader(
+            read_frames(source, self.fps), self.batch_size, self.prefetch)
+        for batch in reader:
+            records = [
+                {'source': str(source), 'timestamp': int(ts)}
+                for ts in batch.timestamps]
+            detect = None
+            if self.novelty_module is not None:
+                start = time.perf_counter()
+                detect = self._novelty(batch, records)
+                self.stage_times['novelty'] += time.perf_counter() - start
+            if self.objects is not None:
+                start = time.perf_counter()
+                self._detect(batch.images, records, detect)
+                self.stage_times['detection'] += time.perf_counter() - start
+            start = time.perf_counter()
+            for record in records:
+                writer.write(record)
+            self.stage_times['write'] += time.perf_counter() - start
+            self.num_frames += len(records)
+        self.stage_times['read'] += reader.read_time
+
+    def _detect(
+        self,
+        images: np.ndarray,
+        records: List[Dict],
+        detect: Optional[np.ndarray] = None,
+    ) -> None:
+        if detect is not None:
+            images = images[detect]
+        detected = iter(())
+        if images.shape[0]:
+            detections = self.detector(
+                self.objects, images, self.threshold, self.num_classes)
+            detected = zip(detections.per_image, detections.class_counts)
+        for i, record in enumerate(records):
+            # Frames skipped by the gate re-use the last detections.
+            if detect is None or detect[i]:
+                self.previous = next(detected)
+            dets, counts = self.previous
+            self.statistics.update(counts[np.newaxis], record['timestamp'])
+            record['detections'] = [
+                {
+                    'class': self.labels[c],
+                    'class_id': c,
+                    'score': score,
+                    'box': [xmin, ymin, xmax, ymax],
+                }
+                for xmin, ymin, xmax, ymax, score, c in dets.tolist()]
+            if self.tracker is not None:
+                _, track_ids = self.tracker.step(dets)
+                for det, track_id in zip(
+                        record['detections'], track_ids.tolist()):
+                    det['track_id'] = track_id
+
+    def _novelty(
+        self, batch: Batch, records: List[Dict]
+    ) -> Optional[np.ndarray]:
+        if self.gate is None:
+            sims = self.novelty_module.batch(
+                batch.images, self.batch_size, keys=batch.timestamps)
+            detect = None
+        else:
+            features = self.novelty_module.extract_features(
+                batch.images, keys=batch.timestamps)
+            sims = self.novelty_module.score_features(features)
+            detect, _ = self.gate(features.numpy(), batch.timestamps)
+        for record, sim in zip(records, similarity_to_rating(sims.numpy())):
+            record['similarity'] = float(sim)
+            if self.segmenter is not None:
+                kinds = {event.kind for event in self.segmenter.update(
+                    record['similarity'], record['timestamp'])}
+                record['segment'] = self.segmenter.segment
+                record['boundary'] = 'boundary' in kinds
+                record['keyframe'] = 'keyframe' in kinds
+        return detect
+
+    def close(self) -> None:
+        """
+        Stops the worker processes of the models, if any.
+        """
+        for module in (self.objects, self.novelty_module):
+            if hasattr(module, 'close'):
+                module.close()
+
+    def report(self, elapsed: float) -> Dict:
+        """
+        Summarizes the throughput of the processed recordings.
+
+        Args:
+            elapsed (float): Wall-clock time in seconds
+
+        Returns:
+            Dict: Frames, frames/s, the time per stage, the startup time
+                per phase in seconds, the detection statistics and the
+                share of frames skipped by the novelty gate, and the
+                counters of the detection cache
+        """
+        report = {
+            'frames': self.num_frames,
+            'elapsed_s': elapsed,
+            'frames_per_s': self.num_frames / elapsed if elapsed else 0.,
+            'stage_s': dict(self.stage_times),
+            'startup_s': startup_report.as_dict(),
+        }
+        if self.objects is not None:
+            report['detections'] = self.statistics.as_dict()
+        if self.tracker is not None:
+            unique = self.unique_counts + self.tracker.unique_counts
+            report['unique_objects'] = {
+                label: int(unique[c]) for c, label in self.labels.items()}
+        if self.gate is not None:
+            report['detected_frames'] = self.gate.num_detected
+            report['skip_ratio'] = self.gate.skip_ratio
+        if self.cache is not None:
+            report['detection_cache'] = self.cache.stats()
+        if self.segmenter is not None:
+            report['segments'] = self.segmenter.num_segments
+            report['keyframes'] = self.segmenter.num_keyframes
+            report['data_reduction'] = self.segmenter.data_reduction
+        return report
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m smart_tagging.tag',
+        description='Tags recorded image directories and video files.')
+    parser.add_argument(
+        'sources', nargs='+', type=Path,
+        help='image directories or video files')
+    parser.add_argument(
+        '-o', '--output', type=Path, required=True,
+        help='output file, .jsonl or .npz, or .taglog directory')
+    parser.add_argument(
+        '--format', choices=sorted(WRITERS),
+        help='output format, derived from the output suffix by default')
+    parser.add_argument(
+        '--detection-model', type=Path,
+        default=project_root / 'object_detection' / 'saved_model')
+    parser.add_argument(
+        '--novelty-model', type=Path,
+        default=project_root / 'novelty_detection' / 'saved_model')
+    parser.add_argument(
+        '--no-detection', action='store_true',
+        help='skip the object detection')
+    parser.add_argument(
+        '--no-novelty', action='store_true',
+        help='skip the novelty detection')
+    parser.add_argument(
+        '--fps', type=float, default=30.,
+        help='frame rate of image directories whose file names are no '
+             'timestamps, default 30')
+    parser.add_argument(
+        '--threshold', type=float, default=0.3,
+        help='score threshold of the object detection in [0, 1]')
+    parser.add_argument(
+        '--track', action='store_true',
+        help='track detections over frames and count unique objects')
+    parser.add_argument(
+        '--novelty-gate', type=float, metavar='THRESHOLD',
+        help='only detect frames whose similarity rating to the last '
+             'detected frame is below this threshold in [-1, 1], all other '
+             'frames re-use its detections')
+    parser.add_argument(
+        '--max-staleness', type=float, default=1.,
+        help='with --novelty-gate, seconds after which a frame is detected '
+             'in any case, 0 to disable')
+    parser.add_argument(
+        '--segments', action='store_true',
+        help='split the recordings into scene segments from the novelty '
+             'ratings and mark a keyframe per segment')
+    parser.add_argument(
+        '--segment-min-length', type=float, default=1.,
+        help='with --segments, minimum segment length in seconds')
+    parser.add_argument(
+        '--keyframe-interval', type=float, default=0.,
+        help='with --segments, seconds between further keyframes of long '
+             'segments, 0 for one keyframe per segment')
+    parser.add_argument(
+        '--tiling', choices=TILING_MODES,
+        help='detect overlapping tiles of every frame, or with roi the '
+             'whole frame and tiles of the region of interest only')
+    parser.add_argument(
+        '--tile-size', type=parse_resolution, default=(512, 512),
+        help='tile resolution <height>x<width>, default 512x512')
+    parser.add_argument(
+        '--tile-overlap', type=float, default=0.2,
+        help='overlap of adjacent tiles as fraction of the tile size')
+    parser.add_argument(
+        '--tile-roi', type=parse_roi,
+        help='tiled region xmin,ymin,xmax,ymax as fractions of the frame '
+             'size with --tiling roi, the road region by default')
+    parser.add_argument(
+        '--tile-merge', choices=MERGE_METHODS, default='nms',
+        help='how duplicate detections of overlapping tiles are merged')
+    parser.add_argument(
+        '--cache-size', type=int, default=0, metavar='MB',
+        help='cache the detections of up to this many MB of frames by their '
+             'content, so repeated frames skip the model, 0 to disable')
+    parser.add_argument(
+        '--cache-dir', type=Path,
+        help='with --cache-size, also store the detection cache in this '
+             'directory for later runs')
+    parser.add_argument(
+        '--perceptual-cache', action='store_true',
+        help='key the detection cache by a coarse perceptual hash, so '
+             'near-duplicate frames hit as well')
+    parser.add_argument(
+        '--jit-compile', action='store_true',
+        help='compile the object detection with XLA')
+    parser.add_argument(
+        '--precision', choices=PRECISIONS, default='float32',
+        help='model variant, see python -m smart_tagging.quantize')
+    parser.add_argument(
+        '--backend', choices=sorted(BACKENDS),
+        help='inference backend, defaults to the one declared in init.json')
+    parser.add_argument(
+        '--batch-size', type=int,
+        help='frames per model call, 8 or the batch size of the execution '
+             'profile by default')
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='run each model on this many worker processes, which share '
+             'the CPU cores, instead of in the main process')
+    parser.add_argument(
+        '--execution-profile', choices=['saved', 'tune'],
+        help='use the execution profiles stored next to the models, or '
+             'tune and store them first, see python -m '
+             'smart_tagging.profiles')
+    parser.add_argument(
+        '--intra-op-threads', type=int, default=0,
+        help='threads within an op, overrides the execution profile')
+    parser.add_argument(
+        '--inter-op-threads', type=int, default=0,
+        help='ops run in parallel, overrides the execution profile')
+    parser.add_argument(
+        '--cpus', type=parse_ranges, default=(),
+        help='CPUs to pin the models to, e.g. 0-7')
+    parser.add_argument(
+        '--prefetch', type=int, default=2,
+        help='number of batches read ahead')
+    parser.add_argument(
+        '--memory-size', type=int, default=0,
+        help='compare frames against a memory bank of this many past '
+             'frames instead of the prior frame only')
+    parser.add_argument(
+        '--memory-top-k', type=int, default=1,
+        help='number of most similar memory bank entries to average')
+    parser.add_argument(
+        '--memory-policy', choices=['ring', 'reservoir'], default='ring')
+    parser.add_argument(
+        '--memory-bank', type=Path,
+        help='.npz file to resume the memory bank from and to export it to')
+    parser.add_argument(
+        '--feature-store', type=Path,
+        help='directory that caches the novelty features per recording')
+    parser.add_argument(
+        '--report', type=Path,
+        help='write the throughput report to this .json file')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    fmt = args.format or args.output.suffix.lstrip('.')
+    if fmt not in WRITERS:
+        raise SystemExit(f'Unknown output format {fmt!r}, use --format')
+
+    # Tuned for the declared input shape of each model.
+    profiles = {}
+    for name, path, skip in (
+            ('detection', args.detection_model, args.no_detection),
+            ('novelty', args.novelty_model, args.no_novelty)):
+        profiles[name] = None if skip else resolve_profile(
+            args.execution_profile or '', path,
+            options={'precision': args.precision, 'backend': args.backend},
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads, cpus=args.cpus)
+    batch_size = args.batch_size or next(
+        (profile.batch_size for profile in profiles.values()
+         if profile is not None and profile.batch_size), 8)
+
+    gate = None
+    if args.novelty_gate is not None:
+        if args.no_detection or args.no_novelty:
+            raise SystemExit(
+                '--novelty-gate requires the object and novelty detection')
+        gate = NoveltyGate(args.novelty_gate, args.max_staleness)
+
+    segmenter = None
+    if args.segments:
+        if args.no_novelty:
+            raise SystemExit('--segments requires the novelty detection')
+        segmenter = StreamingSegmenter(
+            min_length=args.segment_min_length,
+            keyframe_interval=args.keyframe_interval)
+
+    tiler = None
+    if args.tiling is not None:
+        tiler = TiledDetector(
+            args.tiling, args.tile_size, args.tile_overlap, args.tile_roi,
+            method=args.tile_merge)
+
+    cache = None
+    if args.cache_size > 0:
+        cache = DetectionCache(
+            args.cache_size << 20, args.cache_dir, args.perceptual_cache,
+            '|'.join(str(option) for option in (
+                model_fingerprint(args.detection_model), args.precision,
+                args.backend, args.jit_compile, args.tiling, args.tile_size,
+                args.tile_overlap, args.tile_roi, args.tile_merge)))
+
+    memory_bank = None
+    if args.memory_bank is not None and args.memory_bank.exists():
+        memory_bank = MemoryBank.load(args.memory_bank)
+    elif args.memory_size > 0:
+        memory_bank = MemoryBank(
+            args.memory_size, args.memory_top_k, args.memory_policy)
+
+    tagger = Tagger(
+        None if args.no_detection else args.detection_model,
+        None if args.no_novelty else args.novelty_model,
+        threshold=args.threshold,
+        batch_size=batch_size,
+        prefetch=args.prefetch,
+        memory_bank=memory_bank,
+        feature_store=args.feature_store,
+        jit_compile=args.jit_compile,
+        precision=args.precision,
+        backend=args.backend,
+        track=args.track,
+        gate=gate,
+        workers=args.workers,
+        detection_profile=profiles['detection'],
+        novelty_profile=profiles['novelty'],
+        tiler=tiler,
+        cache=cache,
+        segmenter=segmenter,
+        fps=args.fps,
+    )
+    if fmt == 'taglog':
+        writer = TagLogWriter(args.output, getattr(tagger, 'labels', None))
+    else:
+        writer = WRITERS[fmt](args.output)
+    start = time.perf_counter()
+    try:
+        for source in args.sources:
+            tagger.tag(source, writer)
+    finally:
+        writer.close()
+        tagger.close()
+    if memory_bank is not None and args.memory_bank is not None:
+        memory_bank.save(args.memory_bank)
+    report = tagger.report(time.perf_counter() - start)
+
+    print(json.dumps(report, indent=2), file=sys.stderr)
+    if args.report is not None:
+        with args.report.open('w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
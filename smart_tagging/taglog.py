@@ -0,0 +1,541 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Columnar, time-indexed log of the tags of every frame: the decoded
+detections and the novelty similarity, and a query API over it which
+reads only the queried time range through memory maps.
+
+Usage:
+    python -m smart_tagging.taglog <log> --class pedestrian --min-count 5
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import (
+    Dict, Iterator, List, Optional, Sequence, Tuple, Union,
+)
+
+import numpy as np
+
+from smart_tagging.object_detection.utils import DETECTION_DTYPE
+
+# One row per frame and image. The detections of a row are
+# detections[first:first + count].
+FRAME_DTYPE = np.dtype([
+    ('timestamp', np.int64),
+    ('source', np.int32),
+    ('image', np.int32),
+    ('similarity', np.float32),
+    ('first', np.int64),
+    ('count', np.int32),
+])
+
+# DETECTION_DTYPE with the track id, -1 if untracked, and the frame row.
+LOG_DETECTION_DTYPE = np.dtype(
+    DETECTION_DTYPE.descr + [('track_id', np.int64), ('frame', np.int64)])
+
+# Detections per frame and class, which answer count queries without
+# reading the detections.
+COUNT_DTYPE = np.dtype(np.uint16)
+
+# Frames read at once by a query.
+CHUNK_SIZE = 1 << 20
+
+FILES = {
+    'frames': ('frames.bin', FRAME_DTYPE),
+    'detections': ('detections.bin', LOG_DETECTION_DTYPE),
+    'counts': ('counts.bin', COUNT_DTYPE),
+}
+
+
+class TagLog:
+    """
+    Append-only log of the tags of every frame, stored column-wise in a
+    directory:
+
+        frames.bin: FRAME_DTYPE rows in write order
+        detections.bin: LOG_DETECTION_DTYPE rows of all frames
+        counts.bin: uint16 detections per frame and class
+        header.json: class labels and sources
+
+    All files are read through memory maps, so the log may be much larger
+    than the memory. As long as timestamps are appended in non-decreasing
+    order, the frame timestamps are the time index and a time range is
+    found by binary search, otherwise queries scan the log chunk-wise.
+
+    Frames are written last, so after a crash all files are cut to the
+    last complete frame when the log is opened again.
+
+    Args:
+        root (str/Path): Directory of the log
+        labels (Dict[int, str]): Class names by class id, required to
+            create a log, read from the header otherwise
+    """
+    def __init__(
+        self,
+        root: Union[str, Path],
+        labels: Optional[Dict[int, str]] = None,
+    ):
+        self.root = Path(root)
+        self.header_path = self.root / 'header.json'
+        if self.header_path.exists():
+            with self.header_path.open('r') as f:
+                header = json.load(f)
+            self.labels = {int(k): v for k, v in header['labels'].items()}
+            self.sources = header['sources']
+            monotonic = header['monotonic']
+            num_rows = header['frames']
+        elif labels is None:
+            raise ValueError(f'No tag log at {self.root}, labels required')
+        else:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.labels = dict(labels)
+            self.sources = []
+            monotonic, num_rows = True, 0
+        self.num_classes = max(self.labels, default=-1) + 1
+        self.class_ids = {v: k for k, v in self.labels.items()}
+
+        self.paths = {
+            name: self.root / filename
+            for name, (filename, _) in FILES.items()}
+        self.num_rows = self._size('frames') // FRAME_DTYPE.itemsize
+        frames = self._read('frames', max(0, self.num_rows - 1))
+        self.num_detections = int(
+            frames['first'][0] + frames['count'][0]) if len(frames) else 0
+        # Drop a partially written frame and the data written without its
+        # frame, e.g. after a crash, so later appends stay aligned.
+        for name, size in (
+            ('frames', self.num_rows),
+            ('detections', self.num_detections),
+            ('counts', self.num_rows * self.num_classes),
+        ):
+            size *= FILES[name][1].itemsize
+            if self._size(name) > size:
+                with self.paths[name].open('r+b') as f:
+                    f.truncate(size)
+        self.last_timestamp = (
+            int(frames['timestamp'][0]) if len(frames) else None)
+        self._files = None
+        self._maps: Dict[str, np.ndarray] = {}
+        self.monotonic = monotonic
+        if num_rows != self.num_rows:
+            # The header is stale, e.g. after a crash.
+            self.monotonic = self._is_monotonic()
+
+    def _size(self, name: str) -> int:
+        path = self.paths[name]
+        return path.stat().st_size if path.exists() else 0
+
+    def _read(self, name: str, start: int, count: int = 1) -> np.ndarray:
+        dtype = FILES[name][1]
+        if self._size(name) < (start + count) * dtype.itemsize:
+            return np.zeros(0, dtype)
+        return np.fromfile(
+            self.paths[name], dtype=dtype, count=count,
+            offset=start * dtype.itemsize)
+
+    def _is_monotonic(self) -> bool:
+        previous = None
+        for start in range(0, self.num_rows, CHUNK_SIZE):
+            ts = self.frames['timestamp'][start:start + CHUNK_SIZE]
+            if np.any(np.diff(ts) < 0) or (
+                    previous is not None and ts[0] < previous):
+                return False
+            previous = ts[-1]
+        return True
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __enter__(self) -> 'TagLog':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def append(
+        self,
+        timestamp: int,
+        detections: np.ndarray,
+        similarity: float = np.nan,
+        image: int = 0,
+        source: str = '',
+        track_ids: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Appends the tags of one image of a frame.
+
+        Args:
+            timestamp (int): Timestamp of the frame
+            detections (np.ndarray): DETECTION_DTYPE array
+            similarity (float): Novelty similarity rating, NaN if unknown
+            image (int): Index of the camera image in the frame
+            source (str): Name of the recording
+            track_ids (np.ndarray): Track id of every detection
+        """
+        if self._files is None:
+            self._maps.clear()
+            self._files = {
+                name: path.open('ab') for name, path in self.paths.items()}
+        if source not in self.sources:
+            self.sources.append(source)
+            self.write_header()
+        timestamp = int(timestamp)
+        if (self.last_timestamp is not None
+                and timestamp < self.last_timestamp):
+            self.monotonic = False
+        self.last_timestamp = timestamp
+
+        rows = np.empty(len(detections), LOG_DETECTION_DTYPE)
+        for name in DETECTION_DTYPE.names:
+            rows[name] = detections[name]
+        rows['track_id'] = -1 if track_ids is None else track_ids
+        rows['frame'] = self.num_rows
+        counts = np.bincount(
+            detections['class_id'], minlength=self.num_classes)
+        frame = np.array([(
+            timestamp, self.sources.index(source), image, similarity,
+            self.num_detections, len(detections))], FRAME_DTYPE)
+
+        self._files['detections'].write(rows.tobytes())
+        self._files['counts'].write(
+            np.minimum(counts, np.iinfo(COUNT_DTYPE).max)
+            .astype(COUNT_DTYPE).tobytes())
+        self._files['frames'].write(frame.tobytes())
+        self.num_rows += 1
+        self.num_detections += len(detections)
+
+    def write_header(self) -> None:
+        with self.header_path.open('w') as f:
+            json.dump({
+                'labels': {str(k): v for k, v in self.labels.items()},
+                'sources': self.sources,
+                'monotonic': self.monotonic,
+                'frames': self.num_rows,
+            }, f, indent=2)
+
+    def flush(self) -> None:
+        """
+        Writes the appended frames to disk, so queries see them.
+        """
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+            self.write_header()
+
+    def close(self) -> None:
+        self.flush()
+        self._maps.clear()
+
+    def _map(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        self.flush()
+        array = self._maps.get(name)
+        if array is None or array.shape != shape:
+            if shape[0] == 0:
+                array = np.zeros(shape, FILES[name][1])
+            else:
+                array = np.memmap(
+                    self.paths[name], dtype=FILES[name][1], mode='r',
+                    shape=shape)
+            self._maps[name] = array
+        return array
+
+    @property
+    def frames(self) -> np.ndarray:
+        """
+        Memory map of all frames, FRAME_DTYPE.
+        """
+        return self._map('frames', (self.num_rows,))
+
+    @property
+    def detections(self) -> np.ndarray:
+        """
+        Memory map of all detections, LOG_DETECTION_DTYPE.
+        """
+        return self._map('detections', (self.num_detections,))
+
+    @property
+    def counts(self) -> np.ndarray:
+        """
+        Memory map of the detections per frame and class,
+        shape (frames, num_classes).
+        """
+        return self._map('counts', (self.num_rows, self.num_classes))
+
+    def frame_detections(self, row: int) -> np.ndarray:
+        """
+        Args:
+            row (int): Frame row
+
+        Returns:
+            np.ndarray: LOG_DETECTION_DTYPE array of the frame
+        """
+        frame = self.frames[row]
+        first = int(frame['first'])
+        return np.asarray(self.detections[first:first + frame['count']])
+
+    def time_range(
+        self, start: Optional[int] = None, stop: Optional[int] = None
+    ) -> Tuple[int, int]:
+        """
+        Finds the frame rows of a time range by binary search.
+
+        Args:
+            start (int): First timestamp, None for the beginning
+            stop (int): End timestamp, exclusive, None for the end
+
+        Returns:
+            Tuple[int, int]: First row and end row of the range, all rows
+                if the timestamps are not monotonic
+        """
+        if not self.monotonic:
+            return 0, self.num_rows
+        timestamps = self.frames['timestamp']
+        lo = 0 if start is None else int(
+            np.searchsorted(timestamps, start, 'left'))
+        hi = self.num_rows if stop is None else int(
+            np.searchsorted(timestamps, stop, 'left'))
+        return lo, max(lo, hi)
+
+    def class_ids_of(
+        self, classes: Optional[Sequence[Union[int, str]]]
+    ) -> np.ndarray:
+        """
+        Args:
+            classes (Sequence): Class names or ids, None for all classes
+
+        Returns:
+            np.ndarray: Class ids
+        """
+        if classes is None:
+            return np.arange(self.num_classes)
+        ids = []
+        for c in classes:
+            if isinstance(c, str) and not c.isdigit():
+                if c.lower() not in self.class_ids:
+                    raise ValueError(
+                        f'Unknown class {c!r}, expected one of '
+                        f'{sorted(self.class_ids)}')
+                ids.append(self.class_ids[c.lower()])
+            else:
+                ids.append(int(c))
+        return np.asarray(ids, dtype=np.int64)
+
+    def query(
+        self,
+        start: Optional[int] = None,
+        stop: Optional[int] = None,
+        classes: Optional[Sequence[Union[int, str]]] = None,
+        min_count: Optional[int] = None,
+        max_count: Optional[int] = None,
+        min_score: Optional[float] = None,
+        source: Optional[str] = None,
+        image: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        Finds the frames matching all given filters. Only the chunks of the
+        time range are read.
+
+        Args:
+            start (int): First timestamp
+            stop (int): End timestamp, exclusive
+            classes (Sequence): Class names or ids which are counted, all
+                classes by default
+            min_count (int): Minimum number of detections of the classes,
+                1 if classes are given and no count
+            max_count (int): Maximum number of detections of the classes
+            min_score (float): Only count detections with at least this
+                score, which reads the detections of the range
+            source (str): Name of the recording
+            image (int): Index of the camera image
+
+        Returns:
+            np.ndarray: Frame rows in write order
+        """
+        class_ids = self.class_ids_of(classes)
+        if classes is not None and min_count is None and max_count is None:
+            min_count = 1
+        count_filter = min_count is not None or max_count is not None
+        if source is not None and source not in self.sources:
+            return np.zeros(0, np.int64)
+
+        lo, hi = self.time_range(start, stop)
+        matches = [np.zeros(0, np.int64)]
+        for chunk_start in range(lo, hi, CHUNK_SIZE):
+            chunk_stop = min(hi, chunk_start + CHUNK_SIZE)
+            frames = self.frames[chunk_start:chunk_stop]
+            mask = np.ones(len(frames), dtype=bool)
+            if not self.monotonic:
+                if start is not None:
+                    mask &= frames['timestamp'] >= start
+                if stop is not None:
+                    mask &= frames['timestamp'] < stop
+            if source is not None:
+                mask &= frames['source'] == self.sources.index(source)
+            if image is not None:
+                mask &= frames['image'] == image
+            if count_filter:
+                counts = self._count(
+                    frames, chunk_start, class_ids, min_score)
+                if min_count is not None:
+                    mask &= counts >= min_count
+                if max_count is not None:
+                    mask &= counts <= max_count
+            matches.append(np.flatnonzero(mask) + chunk_start)
+        return np.concatenate(matches)
+
+    def _count(
+        self,
+        frames: np.ndarray,
+        chunk_start: int,
+        class_ids: np.ndarray,
+        min_score: Optional[float],
+    ) -> np.ndarray:
+        if min_score is None:
+            counts = self.counts[chunk_start:chunk_start + len(frames)]
+            return counts[:, class_ids].sum(axis=1, dtype=np.int64)
+        first = int(frames['first'][0])
+        stop = int(frames['first'][-1] + frames['count'][-1])
+        detections = self.detections[first:stop]
+        selected = np.isin(detections['class_id'], class_ids) & (
+            detections['score'] >= min_score)
+        return np.bincount(
+            detections['frame'][selected] - chunk_start,
+            minlength=len(frames))
+
+    def segments(
+        self, rows: np.ndarray, max_gap: int = 0
+    ) -> List[Tuple[str, int, int, int]]:
+        """
+        Groups frame rows into segments of consecutive frames.
+
+        Args:
+            rows (np.ndarray): Frame rows, e.g. of a query
+            max_gap (int): Maximum time between two frames of a segment,
+                0 to only group frames without another timestamp of the
+                log in between, which requires monotonic timestamps
+
+        Returns:
+            List[Tuple[str, int, int, int]]: Source, first and last
+                timestamp and number of frames of every segment
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return []
+        frames = self.frames[rows]
+        breaks = frames['source'][1:] != frames['source'][:-1]
+        if max_gap > 0:
+            gaps = np.diff(frames['timestamp'])
+            breaks |= (gaps > max_gap) | (gaps < 0)
+        elif not self.monotonic:
+            raise ValueError(
+                'The timestamps of the log are not monotonic, a max_gap is '
+                'required')
+        else:
+            # Split where the log has a timestamp between two rows.
+            timestamps = self.frames['timestamp']
+            after = np.searchsorted(
+                timestamps, frames['timestamp'][:-1], 'right')
+            after = np.minimum(after, self.num_rows - 1)
+            breaks |= timestamps[after] < frames['timestamp'][1:]
+        bounds = np.concatenate([[0], np.flatnonzero(breaks) + 1, [len(rows)]])
+        return [
+            (self.sources[frames['source'][a]],
+             int(frames['timestamp'][a]), int(frames['timestamp'][b - 1]),
+             b - a)
+            for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+    def iter_frames(
+        self, rows: np.ndarray
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Args:
+            rows (np.ndarray): Frame rows
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray]: FRAME_DTYPE record and its
+                LOG_DETECTION_DTYPE detections
+        """
+        for row in rows:
+            yield self.frames[row], self.frame_detections(row)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m smart_tagging.taglog',
+        description='Queries a tag log for frames or segments.')
+    parser.add_argument('log', type=Path, help='tag log directory')
+    parser.add_argument('--start', type=int, help='first timestamp')
+    parser.add_argument('--stop', type=int, help='end timestamp, exclusive')
+    parser.add_argument(
+        '--class', dest='classes', action='append',
+        help='class name or id to count, can be repeated')
+    parser.add_argument('--min-count', type=int)
+    parser.add_argument('--max-count', type=int)
+    parser.add_argument('--min-score', type=float)
+    parser.add_argument('--source', help='name of the recording')
+    parser.add_argument('--image', type=int, help='index of the camera')
+    parser.add_argument(
+        '--segments', action='store_true',
+        help='print segments of consecutive matching frames instead of '
+             'the frames')
+    parser.add_argument(
+        '--max-gap', type=int, default=0,
+        help='with --segments, maximum time between two frames of a '
+             'segment, by default adjacent frames only')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    if not (args.log / 'header.json').exists():
+        raise SystemExit(f'No tag log at {args.log}')
+    log = TagLog(args.log)
+    try:
+        rows = log.query(
+            args.start, args.stop, args.classes, args.min_count,
+            args.max_count, args.min_score, args.source, args.image)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if args.segments:
+        try:
+            segments = log.segments(rows, args.max_gap)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        for source, first, last, count in segments:
+            print(json.dumps({
+                'source': source, 'start': first, 'end': last,
+                'frames': count}))
+        return
+    for frame, detections in log.iter_frames(rows):
+        similarity = float(frame['similarity'])
+        print(json.dumps({
+            'source': log.sources[frame['source']],
+            'timestamp': int(frame['timestamp']),
+            'image': int(frame['image']),
+            'similarity': None if np.isnan(similarity) else similarity,
+            'detections': [
+                {
+                    'class': log.labels.get(c, str(c)),
+                    'score': score,
+                    'box': [xmin, ymin, xmax, ymax],
+                    'track_id': track_id,
+                }
+                for xmin, ymin, xmax, ymax, score, c, track_id, _
+                in detections.tolist()],
+        }), file=sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from smart_tagging.startup import lazy_import, startup_report
+
+tf = lazy_import('tensorflow')
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+
+def tflite_path(export_dir: Union[str, Path], precision: str) -> Path:
+    """
+    Location of a reduced-precision variant of an exported model.
+
+    Args:
+        export_dir (str/Path): Path to saved model
+        precision (str): 'float16' or 'int8'
+
+    Returns:
+        Path: .tflite file next to the saved model
+    """
+    return Path(export_dir) / f'model_{precision}.tflite'
+
+
+def _match(name: str, keys: Iterable[str]) -> Optional[str]:
+    """
+    Returns the key a tensor name ends in, e.g. 'image' for
+    'serving_default_image:0', the longest if several do, None if none.
+    """
+    name = name.rpartition(':')[0] or name
+    found = [k for k in keys if name == k or name.endswith('_' + k)]
+    return max(found, key=len) if found else None
+
+
+class TFLiteSignature:
+    """
+    Runs a converted model with the call contract of a saved model
+    signature: keyword inputs, dict of tf.Tensor outputs.
+
+    Input tensors are resized whenever the input shape changes. With
+    TensorFlow < 2.5, which has no signature runner, tensors are matched
+    by the input or output name their name ends in. Outputs named after
+    the call op instead, e.g. StatefulPartitionedCall:1, are matched by
+    their output number, which counts the signature outputs in sorted
+    order of output_keys, as the converter flattens them.
+
+    Args:
+        path (str/Path): .tflite file
+        signature (str): Signature key, e.g. 'bboxes'
+        output_keys (Sequence[str]): Output names of the signature
+        num_threads (int): Interpreter threads, 0 for the default
+    """
+    def __init__(
+        self,
+        path: Union[str, Path],
+        signature: str,
+        output_keys: Sequence[str],
+        num_threads: int = 0,
+    ):
+        with startup_report.timed('load', Path(path).name):
+            self.interpreter = tf.lite.Interpreter(
+                model_path=str(path), num_threads=num_threads or None)
+        self.signature = signature
+        self.output_keys = sorted(output_keys)
+        self._runner = None
+        if hasattr(self.interpreter, 'get_signature_runner'):
+            self._runner = self.interpreter.get_signature_runner(signature)
+        self._shapes = {}
+        self._allocated = False
+        self._output_indices: Optional[Dict[str, int]] = None
+
+    def input_shape(self, key: str) -> Optional[Tuple[int, ...]]:
+        """
+        Returns the declared shape of an input, dynamic dimensions as -1,
+        None if unknown.
+
+        Args:
+            key (str): Input name of the signature, e.g. 'image'
+        """
+        for detail in self.interpreter.get_input_details():
+            if _match(detail['name'], [key]) == key:
+                # TensorFlow < 2.3 only reports the current shape.
+                shape = detail.get('shape_signature')
+                return None if shape is None else tuple(shape.tolist())
+        return None
+
+    def __call__(self, **inputs) -> Dict[str, 'tf.Tensor']:
+        inputs = {k: np.asarray(v) for k, v in inputs.items()}
+        if self._runner is not None:
+            outputs = self._runner(**inputs)
+            return {k: tf.constant(outputs[k]) for k in self.output_keys}
+
+        details = self.interpreter.get_input_details()
+        names = [_match(detail['name'], inputs) for detail in details]
+        if None in names:
+            raise ValueError(
+                f'Cannot match the tensors '
+                f'{[detail["name"] for detail in details]} to the inputs '
+                f'{sorted(inputs)}')
+        resized = False
+        for detail, name in zip(details, names):
+            shape = inputs[name].shape
+            if self._shapes.get(name) != shape:
+                self.interpreter.resize_tensor_input(detail['index'], shape)
+                self._shapes[name] = shape
+                resized = True
+        if resized or not self._allocated:
+            self.interpreter.allocate_tensors()
+            self._allocated = True
+        for detail, name in zip(details, names):
+            self.interpreter.set_tensor(
+                detail['index'], inputs[name].astype(detail['dtype']))
+        self.interpreter.invoke()
+        if self._output_indices is None:
+            self._output_indices = self._match_outputs()
+        return {
+            key: tf.constant(self.interpreter.get_tensor(index))
+            for key, index in self._output_indices.items()}
+
+    def _match_outputs(self) -> Dict[str, int]:
+        details = self.interpreter.get_output_details()
+        indices = {}
+        for detail in details:
+            key = _match(detail['name'], self.output_keys)
+            if key is not None:
+                indices[key] = detail['index']
+        if len(indices) < len(self.output_keys):
+            indices = {}
+            for detail in details:
+                number = detail['name'].rpartition(':')[2]
+                if number.isdigit() and int(number) < len(self.output_keys):
+                    indices[self.output_keys[int(number)]] = detail['index']
+        if len(indices) < len(self.output_keys):
+            raise ValueError(
+                f'Cannot match the tensors '
+                f'{[detail["name"] for detail in details]} to the outputs '
+                f'{self.output_keys}')
+        return indices
+
@@ -11,10 +11,14 @@
 
 import json
 from pathlib import Path
-from typing import Any, Callable, Dict, Tuple, Union
+from typing import TYPE_CHECKING, Any, Callable, Dict, Tuple, Union
 
-import rtmaps.types
-import tensorflow as tf
+from smart_tagging.startup import lazy_import, startup_report
+
+tf = lazy_import('tensorflow')
+
+if TYPE_CHECKING:
+    import rtmaps.types
 
 
 def load_config(path: Path) -> Dict:
@@ -46,17 +50,21 @@ def load_exported_model(
     export_dir = Path(export_dir)
     init = load_config(export_dir / 'init.json')
 
-    return tf.saved_model.load(str(export_dir)), init
+    with startup_report.timed('load', export_dir.parent.name):
+        return tf.saved_model.load(str(export_dir)), init
 
 
 def get_ioelt(
     timestamp: int, data: Any
-) -> rtmaps.types.Ioelt:
+) -> 'rtmaps.types.Ioelt':
     """
     Args:
         timestamp (ts): Input timestamp
         data (dict, scalar): Any data
     """
+    # rtmaps is only available inside the RTMaps python bridge.
+    import rtmaps.types
+
     e = rtmaps.types.Ioelt()
     e.ts = timestamp
     e.data = data
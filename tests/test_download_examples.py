@@ -0,0 +1,123 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import hashlib
+import io
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from smart_tagging.examples import download_examples
+from smart_tagging.examples.download_examples import (
+    Asset,
+    check_and_install_exdata,
+    download,
+)
+
+
+def make_zip() -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as zf:
+        zf.writestr('saved_model.pb', b'model' * 1000)
+        zf.writestr('variables/variables.index', b'index')
+    return data.getvalue()
+
+
+ARCHIVE = make_zip()
+SHA256 = hashlib.sha256(ARCHIVE).hexdigest()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves ARCHIVE at /<any name>.zip, with range requests, and records
+    the Range header of every request.
+    """
+    requests = []
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        self.requests.append((self.path, header))
+        if not self.path.endswith('.zip'):
+            self.send_error(404)
+            return
+        start = int(header[len('bytes='):-1]) if header else 0
+        if start >= len(ARCHIVE):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = ARCHIVE[start:]
+        self.send_response(206 if header else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), RangeHandler)
+    RangeHandler.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_mirror_download(server, tmp_path, monkeypatch):
+    asset = Asset('model', 'model', 'https://invalid.example/model',
+                  'model', 'saved_model.pb')
+    monkeypatch.setattr(download_examples, 'base_dir', tmp_path)
+    monkeypatch.setattr(download_examples, 'ASSETS', (asset,))
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(f'{{"model": {{"sha256": "{SHA256}"}}}}')
+
+    digests = check_and_install_exdata(
+        server, manifest, download_dir=tmp_path / 'downloads')
+
+    assert digests == {'model': SHA256}
+    assert RangeHandler.requests == [('/model.zip', None)]
+    assert (tmp_path / 'model' / 'saved_model.pb').read_bytes() == (
+        b'model' * 1000)
+    assert not list((tmp_path / 'downloads').iterdir())
+
+
+def test_resume_from_part_file(server, tmp_path):
+    path = tmp_path / 'model.zip'
+    (tmp_path / 'model.zip.part').write_bytes(ARCHIVE[:1000])
+
+    assert download(f'{server}/model.zip', path, SHA256) == SHA256
+
+    assert RangeHandler.requests == [('/model.zip', 'bytes=1000-')]
+    assert path.read_bytes() == ARCHIVE
+    assert not (tmp_path / 'model.zip.part').exists()
+
+
+def test_complete_part_file(server, tmp_path):
+    path = tmp_path / 'model.zip'
+    (tmp_path / 'model.zip.part').write_bytes(ARCHIVE)
+
+    assert download(f'{server}/model.zip', path, SHA256) == SHA256
+    assert path.read_bytes() == ARCHIVE
+
+
+def test_digest_mismatch_is_rejected(server, tmp_path):
+    path = tmp_path / 'model.zip'
+
+    with pytest.raises(IOError, match='SHA-256'):
+        download(f'{server}/model.zip', path, '0' * 64)
+
+    assert not path.exists()
+    assert not (tmp_path / 'model.zip.part').exists()
@@ -0,0 +1,78 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import numpy as np
+import pytest
+
+from smart_tagging.novelty_detection.feature_store import (
+    FeatureStore,
+    store_name,
+)
+
+
+def features(*values):
+    return np.repeat(np.float32(values)[:, np.newaxis], 4, axis=1)
+
+
+def test_features_persist_across_reopening(tmp_path):
+    store = FeatureStore(tmp_path, 'rec')
+    store.put([10, 20], features(1, 2))
+    store.put([20, 30], features(9, 3))
+
+    store = FeatureStore(tmp_path, 'rec')
+    assert len(store) == 3
+    assert store.keys.tolist() == [10, 20, 30]
+    found, hits = store.get([30, 40, 20])
+    assert hits.tolist() == [True, False, True]
+    np.testing.assert_array_equal(found, features(3, 2))
+
+
+def test_reopen_drops_features_without_key(tmp_path):
+    store = FeatureStore(tmp_path, 'rec')
+    store.put([10], features(1))
+    # A crash after the features, before the key was written.
+    with store.features_path.open('ab') as f:
+        f.write(features(2).tobytes()[:10])
+
+    store = FeatureStore(tmp_path, 'rec')
+    store.put([20], features(3))
+    store = FeatureStore(tmp_path, 'rec')
+    assert store.keys.tolist() == [10, 20]
+    np.testing.assert_array_equal(store.features, features(1, 3))
+
+
+def test_reopen_drops_partially_written_key(tmp_path):
+    store = FeatureStore(tmp_path, 'rec')
+    store.put([10], features(1))
+    with store.index_path.open('ab') as f:
+        f.write(b'\xff' * 3)
+
+    store = FeatureStore(tmp_path, 'rec')
+    assert len(store) == 1
+    store.put([20], features(2))
+    store = FeatureStore(tmp_path, 'rec')
+    assert store.keys.tolist() == [10, 20]
+    np.testing.assert_array_equal(store.get([20])[0], features(2))
+
+
+def test_feature_size_mismatch_is_rejected(tmp_path):
+    store = FeatureStore(tmp_path, 'rec')
+    store.put([10], features(1))
+    with pytest.raises(ValueError):
+        store.put([20], np.zeros((1, 3), np.float32))
+
+
+def test_store_name_depends_on_recording_and_model(tmp_path):
+    name = store_name('/data/rec1', tmp_path / 'model')
+    assert name.startswith('rec1-')
+    assert name == store_name('/data/rec1', tmp_path / 'model')
+    assert name != store_name('/other/rec1', tmp_path / 'model')
+    assert name != store_name('/data/rec1', tmp_path / 'other')
+    assert name != store_name('/data/rec1', tmp_path / 'model', 'int8')
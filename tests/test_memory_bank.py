@@ -0,0 +1,83 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import numpy as np
+import pytest
+
+from smart_tagging.novelty_detection.memory_bank import MemoryBank
+
+
+def unit(i, dim=4):
+    feature = np.zeros(dim, np.float32)
+    feature[i] = 1.
+    return feature
+
+
+def test_score_averages_the_top_k_similarities():
+    bank = MemoryBank(capacity=4, top_k=2)
+    assert bank.score(unit(0)) == 0.
+    for feature in ([1, 0, 0, 0], [1, 1, 0, 0], [0, 0, 1, 0]):
+        bank.insert(np.float32(feature))
+    assert bank.score(np.float32([2, 0, 0, 0])) == pytest.approx(
+        (1 + 0.5 ** 0.5) / 2)
+
+
+def test_ring_overwrites_the_oldest_feature():
+    bank = MemoryBank(capacity=2)
+    for i in range(3):
+        bank.insert(unit(i))
+    assert bank.size == 2
+    assert bank.score(unit(0)) == 0.
+    assert bank.score(unit(2)) == 1.
+
+
+def test_reservoir_keeps_a_sample_of_all_features():
+    bank = MemoryBank(capacity=8, policy='reservoir', seed=0)
+    for i in range(1000):
+        bank.insert(np.float32([1, i]))
+    assert bank.size == 8
+    assert bank.num_seen == 1000
+    # A uniform sample, not the latest features.
+    assert (np.abs(bank.features[:, 1]) < 0.999).any()
+
+
+def test_keyframe_threshold_skips_similar_frames():
+    bank = MemoryBank(capacity=4, keyframe_threshold=0.9)
+    bank.update(unit(0))
+    bank.update(np.float32([1, 0.1, 0, 0]))
+    bank.update(unit(1))
+    assert bank.size == 2
+
+
+def test_saved_bank_resumes_where_it_stopped(tmp_path):
+    bank = MemoryBank(capacity=3, top_k=2, keyframe_threshold=0.5)
+    for i in range(4):
+        bank.insert(unit(i))
+    bank.save(tmp_path / 'bank.npz')
+
+    loaded = MemoryBank.load(tmp_path / 'bank.npz')
+    assert (loaded.capacity, loaded.top_k, loaded.policy) == (3, 2, 'ring')
+    assert loaded.keyframe_threshold == 0.5
+    assert (loaded.size, loaded.position, loaded.num_seen) == (3, 1, 4)
+    np.testing.assert_array_equal(loaded.features, bank.features)
+    # The next feature overwrites the oldest one, unit(1).
+    bank.insert(unit(0))
+    loaded.insert(unit(0))
+    np.testing.assert_array_equal(loaded.features, bank.features)
+    assert loaded.score(unit(1)) == 0.
+
+
+def test_empty_bank_round_trip(tmp_path):
+    MemoryBank(capacity=5).save(tmp_path / 'bank.npz')
+    loaded = MemoryBank.load(tmp_path / 'bank.npz')
+    assert loaded.size == 0
+    assert loaded.keyframe_threshold is None
+    loaded.insert(unit(0))
+    assert loaded.score(unit(0)) == 1.
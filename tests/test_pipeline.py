@@ -0,0 +1,66 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import pytest
+
+from smart_tagging.pipeline import Pipeline
+
+
+def fail_on(value):
+    def stage(data):
+        if data == value:
+            raise RuntimeError(f'failed on {data}')
+        return data
+    return stage
+
+
+def test_failed_item_is_passed_to_on_error():
+    failed = []
+    pipeline = Pipeline(
+        [lambda x: x * 10, fail_on(20)], maxsize=4, policy='block',
+        on_error=failed.append)
+    pipeline.start()
+    for i in range(4):
+        pipeline.submit(i, i)
+    with pytest.raises(RuntimeError, match='failed on 20'):
+        pipeline.stop()
+    assert failed == [20]
+    # The other items are still handed out.
+    assert pipeline.results() == [(0, 0), (1, 10), (3, 30)]
+
+
+def test_failed_batch_is_passed_to_on_error():
+    failed = []
+
+    def stage(batch):
+        if 2 in batch:
+            raise RuntimeError('failed')
+        return batch
+
+    pipeline = Pipeline(
+        [stage], maxsize=8, policy='block', batch_size=8,
+        on_error=failed.append)
+    for i in range(4):
+        pipeline.submit(i, i)
+    pipeline.start()
+    with pytest.raises(RuntimeError):
+        pipeline.stop()
+    assert failed == [0, 1, 2, 3]
+
+
+def test_dropped_item_is_passed_to_on_drop():
+    dropped = []
+    pipeline = Pipeline([lambda x: x], maxsize=2, on_drop=dropped.append)
+    for i in range(5):
+        pipeline.submit(i, i)
+    pipeline.start()
+    assert [data for _, data in pipeline.stop()] == [3, 4]
+    assert dropped == [0, 1, 2]
+    assert pipeline.num_dropped == 3
@@ -0,0 +1,87 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import math
+
+import pytest
+
+from smart_tagging.novelty_detection.segmentation import (
+    SegmentEvent,
+    StreamingSegmenter,
+)
+
+# 10 frames per second, in microseconds.
+STEP = 100_000
+
+
+def timestamps(n):
+    return [i * STEP for i in range(n)]
+
+
+def cut_at(frame, n=40):
+    return [0. if i == frame else 1. for i in range(n)]
+
+
+def test_static_stream_is_one_segment_with_one_keyframe():
+    segmenter = StreamingSegmenter()
+    events = segmenter([1.] * 30, timestamps(30))
+    assert events == [
+        SegmentEvent('boundary', 0, 0, 0), SegmentEvent('keyframe', 0, 0)]
+    assert segmenter.data_reduction == pytest.approx(29 / 30)
+
+
+def test_hard_cut_starts_a_segment_keyframed_once_settled():
+    segmenter = StreamingSegmenter()
+    events = segmenter(cut_at(20), timestamps(40))
+    boundaries = [e for e in events if e.kind == 'boundary']
+    keyframes = [e for e in events if e.kind == 'keyframe']
+    assert boundaries[1] == SegmentEvent('boundary', 20 * STEP, 1, 20)
+    assert len(keyframes) == 2
+    # The keyframe follows the cut once the statistic decayed below low.
+    assert keyframes[1].segment == 1
+    assert 20 * STEP < keyframes[1].timestamp < 40 * STEP
+
+
+def test_cut_within_min_length_is_suppressed():
+    segmenter = StreamingSegmenter(min_length=1.)
+    events = segmenter(cut_at(5), timestamps(40))
+    assert [e.kind for e in events] == ['boundary', 'keyframe']
+    assert segmenter.num_segments == 1
+
+
+def test_keyframe_interval_repeats_keyframes():
+    segmenter = StreamingSegmenter(keyframe_interval=1.)
+    events = segmenter([1.] * 25, timestamps(25))
+    assert [e.timestamp for e in events if e.kind == 'keyframe'] == [
+        0, 10 * STEP, 20 * STEP]
+
+
+def test_nan_ratings_are_ignored():
+    segmenter = StreamingSegmenter()
+    ratings = [1.] * 10 + [math.nan] * 5 + [1.] * 10
+    events = segmenter(ratings, timestamps(25))
+    assert [e.kind for e in events] == ['boundary', 'keyframe']
+    assert segmenter.statistic == 0.
+
+
+def test_reset_starts_a_new_stream():
+    segmenter = StreamingSegmenter()
+    segmenter([1.] * 10, timestamps(10))
+    segmenter.reset()
+    events = segmenter.update(1., 0)
+    assert events == [
+        SegmentEvent('boundary', 0, 0, 0), SegmentEvent('keyframe', 0, 0)]
+    assert segmenter.num_frames == 11
+    assert segmenter.num_segments == 2
+
+
+def test_invalid_hysteresis_is_rejected():
+    with pytest.raises(ValueError):
+        StreamingSegmenter(high=0.1, low=0.2)
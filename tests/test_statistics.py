@@ -0,0 +1,67 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import numpy as np
+
+from smart_tagging.object_detection.statistics import DetectionStatistics
+
+LABELS = {0: 'car', 1: 'truck', 2: 'person'}
+
+
+def counts(*per_image):
+    # (images, classes), as Detections.class_counts
+    return np.array(per_image, dtype=np.int64)
+
+
+def test_totals_and_current_counts():
+    stats = DetectionStatistics(LABELS, num_images=2)
+    stats.update(counts([1, 0, 2], [0, 1, 0]), 0)
+    stats.update(counts([3, 0, 0], [0, 0, 0]), 10)
+    assert stats.totals.tolist() == [[4, 0], [0, 1], [2, 0]]
+    assert stats.current.tolist() == [[3, 0], [0, 0], [0, 0]]
+    assert stats.num_frames == 2
+
+
+def test_rates_over_the_sliding_window():
+    stats = DetectionStatistics(LABELS, window=3)
+    for i, car in enumerate([8, 1, 2, 4]):
+        stats.update(counts([car, 0, 0]), i * 1_000_000)
+    # The window holds frames 1 to 3; frame 1 precedes the 2 s span.
+    assert stats.window_seconds == 2.
+    np.testing.assert_allclose(stats.rates()[:, 0], [3., 0., 0.])
+    assert stats.totals[0, 0] == 15
+
+
+def test_rates_are_zero_until_the_window_spans_time():
+    stats = DetectionStatistics(LABELS)
+    assert not stats.rates().any()
+    stats.update(counts([1, 0, 0]), 0)
+    assert not stats.rates().any()
+
+
+def test_shares_of_the_window():
+    stats = DetectionStatistics(LABELS, num_images=2)
+    stats.update(counts([3, 1, 0], [0, 0, 0]), 0)
+    np.testing.assert_allclose(stats.shares(), [[0.75, 0], [0.25, 0], [0, 0]])
+    exported = stats.as_dict()
+    assert exported['objects']['share'] == [1., 0.]
+    assert exported['car']['total'] == [3, 0]
+
+
+def test_reset_window_only_keeps_totals():
+    stats = DetectionStatistics(LABELS)
+    stats.update(counts([2, 0, 0]), 0)
+    stats.update(counts([2, 0, 0]), 1_000_000)
+    stats.reset(window_only=True)
+    assert stats.totals[0, 0] == 4
+    assert not stats.window_totals.any()
+    assert stats.window_seconds == 0.
+    stats.reset()
+    assert not stats.totals.any()
@@ -0,0 +1,51 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import numpy as np
+
+from smart_tagging.object_detection.utils import DETECTION_DTYPE
+from smart_tagging.taglog import TagLog
+
+LABELS = {0: 'car', 1: 'truck'}
+
+
+def detections(*class_ids):
+    dets = np.zeros(len(class_ids), DETECTION_DTYPE)
+    dets['class_id'] = class_ids
+    dets['score'] = 0.9
+    return dets
+
+
+def test_reopen_cuts_partially_written_frame(tmp_path):
+    with TagLog(tmp_path, LABELS) as log:
+        log.append(0, detections(0))
+        log.append(10, detections(0, 1))
+        log.append(20, detections())
+    # A crash while writing the next frame leaves its data behind.
+    for name, num_bytes in (
+            ('detections.bin', 37), ('counts.bin', 2), ('frames.bin', 10)):
+        with (tmp_path / name).open('ab') as f:
+            f.write(b'\xff' * num_bytes)
+
+    with TagLog(tmp_path) as log:
+        assert len(log) == 3
+        log.append(30, detections(1))
+        log.append(40, detections(0))
+
+    log = TagLog(tmp_path)
+    frames = log.frames
+    assert frames['timestamp'].tolist() == [0, 10, 20, 30, 40]
+    assert frames['first'].tolist() == [0, 1, 3, 3, 4]
+    assert frames['count'].tolist() == [1, 2, 0, 1, 1]
+    assert log.detections['class_id'].tolist() == [0, 0, 1, 1, 0]
+    assert log.detections['frame'].tolist() == [0, 1, 1, 3, 4]
+    assert log.counts.reshape(5, 2).tolist() == [
+        [1, 0], [1, 1], [0, 0], [0, 1], [1, 0]]
+    assert log.monotonic
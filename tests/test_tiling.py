@@ -0,0 +1,53 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import numpy as np
+import pytest
+
+from smart_tagging.object_detection.tiling import merge_duplicates
+from smart_tagging.object_detection.utils import DETECTION_DTYPE
+
+
+def detections(boxes, scores, class_ids=None):
+    dets = np.zeros(len(boxes), DETECTION_DTYPE)
+    for name, column in zip(('xmin', 'ymin', 'xmax', 'ymax'),
+                            np.asarray(boxes, dtype=np.float32).T):
+        dets[name] = column
+    dets['score'] = scores
+    dets['class_id'] = 0 if class_ids is None else class_ids
+    return dets
+
+
+# A overlaps B and B overlaps C by IoU 0.54, C overlaps A by 0.25 only.
+CHAIN = detections(
+    [[0, 6, 10, 16], [0, 0, 10, 10], [0, 3, 10, 13]], [0.7, 0.9, 0.8])
+
+
+def test_nms_keeps_box_overlapping_only_a_duplicate():
+    merged = merge_duplicates(CHAIN, 0.5, 'nms')
+    np.testing.assert_allclose(merged['score'], [0.9, 0.7])
+    np.testing.assert_allclose(merged['ymin'], [0, 6])
+
+
+def test_fusion_keeps_box_overlapping_only_a_duplicate():
+    merged = merge_duplicates(CHAIN, 0.5, 'fusion')
+    np.testing.assert_allclose(merged['score'], [0.9, 0.7])
+    # B is fused into A, C is kept as it is.
+    np.testing.assert_allclose(merged['ymin'], [0.8 * 3 / 1.7, 6], rtol=1e-5)
+    np.testing.assert_allclose(
+        merged['ymax'], [10 + 0.8 * 3 / 1.7, 16], rtol=1e-5)
+
+
+@pytest.mark.parametrize('method', ['nms', 'fusion'])
+def test_other_classes_are_not_merged(method):
+    dets = detections(
+        [[0, 0, 10, 10], [0, 0, 10, 10]], [0.9, 0.8], class_ids=[0, 1])
+    merged = merge_duplicates(dets, 0.5, method)
+    assert merged['class_id'].tolist() == [0, 1]
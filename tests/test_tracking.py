@@ -0,0 +1,95 @@
+# Copyright 2022, dSPACE GmbH. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you must not use this software except in compliance with the License. This
+# software is not fully developed or tested. It is distributed free of charge
+# and without any consideration. The software is provided "as is" in the hope
+# that it may be useful to other users, but without any warranty of any kind,
+# either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import sys
+
+import numpy as np
+import pytest
+
+from smart_tagging.object_detection.tracking import IoUTracker, assign
+from smart_tagging.object_detection.utils import DETECTION_DTYPE
+
+
+def detections(boxes, class_ids=None):
+    dets = np.zeros(len(boxes), DETECTION_DTYPE)
+    for name, column in zip(('xmin', 'ymin', 'xmax', 'ymax'),
+                            np.asarray(boxes, dtype=np.float32).reshape(
+                                -1, 4).T):
+        dets[name] = column
+    dets['score'] = 0.9
+    dets['class_id'] = 0 if class_ids is None else class_ids
+    return dets
+
+
+def box(x):
+    return [x, 0, x + 10, 10]
+
+
+def test_moving_object_keeps_its_id_and_is_counted_once():
+    tracker = IoUTracker(num_classes=2, min_hits=2)
+    ids = [tracker.step(detections([box(x)]))[1].tolist()
+           for x in range(0, 10, 2)]
+    assert ids == [[0]] * 5
+    assert tracker.unique_counts.tolist() == [1, 0]
+
+
+def test_unconfirmed_object_is_not_counted():
+    tracker = IoUTracker(num_classes=1, min_hits=2)
+    tracker.step(detections([box(0)]))
+    assert tracker.unique_counts.tolist() == [0]
+    assert len(tracker.tracked()[0]) == 0
+
+
+def test_tracks_are_predicted_between_detections():
+    tracker = IoUTracker(num_classes=1, min_hits=2, smoothing=0.)
+    tracker.step(detections([box(0)]))
+    tracker.step(detections([box(2)]))
+    predicted, ids = tracker.step()
+    assert ids.tolist() == [0]
+    assert predicted['xmin'].tolist() == [4.]
+    # After the skipped frame, the velocity is still per frame.
+    tracker.step(detections([box(6)]))
+    np.testing.assert_allclose(tracker.velocities[0], [2, 0, 2, 0])
+
+
+def test_other_class_starts_a_new_track():
+    tracker = IoUTracker(num_classes=2, min_hits=1)
+    tracker.step(detections([box(0)], [0]))
+    _, ids = tracker.step(detections([box(0)], [1]))
+    assert ids.tolist() == [1]
+    assert tracker.unique_counts.tolist() == [1, 1]
+
+
+def test_lost_track_is_dropped_after_max_age():
+    tracker = IoUTracker(num_classes=1, max_age=2, min_hits=1)
+    tracker.step(detections([box(0)]))
+    for _ in range(3):
+        tracker.step(detections([]))
+    assert len(tracker) == 0
+    _, ids = tracker.step(detections([box(0)]))
+    assert ids.tolist() == [1]
+    assert tracker.unique_counts.tolist() == [2]
+
+
+@pytest.mark.parametrize('scipy', [True, False])
+def test_assign_maximizes_matches_above_threshold(scipy, monkeypatch):
+    if scipy:
+        pytest.importorskip('scipy')
+    else:
+        monkeypatch.setitem(sys.modules, 'scipy.optimize', None)
+    iou = np.array([[0.9, 0.5], [0.6, 0.1], [0.2, 0.]])
+    rows, cols = assign(iou, threshold=0.3)
+    matches = sorted(zip(rows.tolist(), cols.tolist()))
+    if scipy:
+        # 0.5 + 0.6 beats 0.9 + 0.1.
+        assert matches == [(0, 1), (1, 0)]
+    else:
+        # Greedy in order of decreasing IoU.
+        assert matches == [(0, 0)]